@@ -1,42 +1,103 @@
 """Flask App for Flask Cafe."""
 
+import itertools
+import json
 import os
 
-from flask import Flask, render_template, redirect, flash, g, session, request
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from flask import (Flask, Blueprint, render_template, redirect, flash, g,
+                   session, request, abort, make_response, stream_with_context,
+                   current_app, send_from_directory)
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy.exc import IntegrityError
 
-from models import (db, connect_db, Cafe, City, User, Like,
+from models import (db, connect_db, Cafe, City, User, Like, CurrentUser,
+                    user_summary_cache, password_hasher, utcnow, MAX_ID,
                     DEFAULT_CAFE_IMG_PATH, DEFAULT_USER_IMG_PATH)
 from forms import CafeForm, SignupForm, LoginForm, CSRFForm, ProfileEditForm
 
-from support import set_dropdown_choices, ultra_print
+from support import (set_dropdown_choices, paginate_keyset, keyset_query,
+                     encode_cursor, make_etag, not_modified, add_validators,
+                     ultra_print)
+from cache import AppCache
+from hashing import HasherBusy
+from throttle import LoginThrottle
+from config import configs
+from pool import pool_status
+from metrics import RequestMetrics, format_metric, CONTENT_TYPE
+from replicas import ReplicaRouter, read_replica
+from images import image_store, BadImage
+from jobs import job_queue
+import importer
+
+
+fragment_cache = AppCache(config_prefix='FRAGMENT_CACHE')
+login_throttle = LoginThrottle()
+request_metrics = RequestMetrics()
+replica_router = ReplicaRouter()
+
+bp = Blueprint('cafe', __name__, cli_group=None)
+
+
+def create_app(config_name=None):
+    """Create and configure the app.
+    config_name is a key of config.configs; defaults to $FLASK_CONFIG or
+    "development"."""
+
+    config_name = config_name or os.environ.get('FLASK_CONFIG', 'development')
+
+    app = Flask(__name__)
+    app.config.from_object(configs[config_name])
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError('Set FLASK_SECRET_KEY to run in production.')
+
+    proxies = app.config['TRUSTED_PROXY_COUNT']
+    if proxies:
+        # Take the client's address and scheme from the X-Forwarded-*
+        # headers the proxies add, e.g. for login throttling by IP.
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    connect_db(app)
+    request_metrics.init_app(app)
+    replica_router.init_app(app)
+    fragment_cache.init_app(app)
+    user_summary_cache.init_app(app)
+    password_hasher.init_app(app)
+    login_throttle.init_app(app)
+    image_store.init_app(app)
+    job_queue.init_app(app)
+
+    if app.config['DEBUG_TB_ENABLED']:
+        # Only pay for importing the toolbar where it's used.
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    app.register_blueprint(bp)
+    return app
 
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-    "DATABASE_URL", 'postgresql:///flask_cafe')
-app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "shhhh")
-app.config['SQLALCHEMY_ECHO'] = True
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
-
 #######################################
 # auth & auth routes
 
 CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
+BUSY_MSG = "We're very busy right now. Please try again in a moment."
+THROTTLED_MSG = "Too many login attempts. Please wait a minute and retry."
+DUPLICATE_CAFE_MSG = "There's already a cafe with this name and address."
+CAFE_IDS_MSG = "cafe_id must be a comma-separated list of ids."
+TOO_MANY_CAFE_IDS_MSG = "cafe_id may list at most {} ids."
+NO_CAFE_ID_MSG = "JSON body needs a valid cafe_id."
+NO_SUCH_CAFE_MSG = "Cafe not found."
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+    The user is only loaded from the database if a page needs it."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = CurrentUser(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -55,10 +116,57 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def page_etag(*parts):
+    """Return an ETag for a page built from `parts`. Also folds in who is
+    viewing, since the navbar changes with the logged-in user."""
+
+    viewer = (g.user.id, g.user.first_name, g.user.last_name) if g.user \
+        else None
+    return make_etag(current_app.config['ETAG_SALT'], viewer, *parts)
+
+
+def can_use_conditional_get():
+    """Pending flash messages make a page one-off; never answer 304."""
+
+    return '_flashes' not in session
+
+
+#######################################
+# uploads
+
+
+@bp.get('/uploads/<path:filename>')
+def uploaded_file(filename):
+    """Serve an uploaded image. Upload URLs never change content, so
+    browsers may keep them for a year."""
+
+    return send_from_directory(
+        image_store.folder, filename, max_age=365 * 24 * 60 * 60)
+
+
+def apply_image_fields(form, obj, default_url):
+    """Set obj.image_url from the form's image fields: an uploaded file wins
+    over a URL, and a blank URL keeps an earlier upload.
+    Returns whether a file was uploaded, whose variants should be made once
+    obj is saved. Raises BadImage if the file isn't an image."""
+
+    old_url = obj.image_url
+    new_url = (form.image_url.data or '').strip()
+    if form.image_file.data:
+        obj.image_url = image_store.save(form.image_file.data)
+    elif new_url or not image_store.is_upload(old_url):
+        obj.image_url = new_url or default_url
+
+    if obj.image_url != old_url:
+        obj.image_variants = None
+    return bool(form.image_file.data)
+
+
 #######################################
 # homepage
 
-@app.get("/")
+@bp.get("/")
+@read_replica
 def homepage():
     """Show homepage."""
 
@@ -69,20 +177,64 @@ def homepage():
 # cafes
 
 
-@app.get('/cafes')
-def cafe_list():
-    """Return list of all cafes."""
+@bp.app_template_global()
+def cafe_fragment(template_name, cafe):
+    """Render a template that depends only on `cafe`, reusing the cached
+    HTML while the cafe's version is unchanged."""
 
-    cafes = Cafe.query.order_by('name').all()
+    key = (template_name, cafe.id, cafe.version)
+    html = fragment_cache.get(key)
+    if html is None:
+        template = current_app.jinja_env.get_template(template_name)
+        html = Markup(template.render(cafe=cafe))
+        fragment_cache.set(key, html)
+    return html
 
-    return render_template(
+
+@bp.get('/cafes')
+@read_replica
+def cafe_list():
+    """Return one page of cafes, ordered by name.
+        Takes optional q-string ?after=<cursor> or ?before=<cursor> """
+
+    def get_page(query):
+        try:
+            return paginate_keyset(
+                query,
+                [Cafe.name, Cafe.id],
+                per_page=current_app.config['CAFES_PER_PAGE'],
+                after=request.args.get('after'),
+                before=request.args.get('before'))
+        except ValueError:
+            abort(400)
+
+    # Check the client's copy against just the versions on this page first.
+    # No Last-Modified: a cafe can move onto the page without anything on
+    # it getting newer, so only the ETag (ids and versions) is reliable.
+    meta, prev_cursor, next_cursor = get_page(
+        db.session.query(Cafe.name, Cafe.id, Cafe.version))
+    etag = page_etag(
+        'cafes', prev_cursor, next_cursor, *[(m.id, m.version) for m in meta])
+
+    if can_use_conditional_get():
+        response = not_modified(etag, None)
+        if response:
+            return response
+
+    cafes, prev_cursor, next_cursor = get_page(
+        Cafe.query.options(db.joinedload(Cafe.city)))
+
+    response = make_response(render_template(
         'cafe/list.html',
         cafes=cafes,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
         category='success'
-    )
+    ))
+    return add_validators(response, etag, None)
 
 
-@app.route('/cafes/add', methods=['GET', 'POST'])
+@bp.route('/cafes/add', methods=['GET', 'POST'])
 def cafe_add():
     """Show form to add cafe"""
 
@@ -100,24 +252,40 @@ def cafe_add():
             url=form.url.data,
             address=form.address.data,
             city_code=form.city_code.data,
-            image_url=form.image_url.data or DEFAULT_CAFE_IMG_PATH)
-
-        db.session.add(cafe)
-        db.session.commit()
-        flash(f'{cafe.name} added.')
-        return redirect(f'/cafes/{cafe.id}')
+            latitude=form.latitude.data,
+            longitude=form.longitude.data)
+
+        try:
+            uploaded = apply_image_fields(form, cafe, DEFAULT_CAFE_IMG_PATH)
+            db.session.add(cafe)
+            if uploaded:
+                db.session.flush()
+                image_store.make_variants_later(cafe, 'card', 'detail')
+            db.session.commit()
+        except BadImage as exc:
+            db.session.rollback()
+            form.image_file.errors.append(str(exc))
+        except IntegrityError:
+            if uploaded:
+                image_store.delete(cafe.image_url)
+            db.session.rollback()
+            form.name.errors.append(DUPLICATE_CAFE_MSG)
+        else:
+            flash(f'{cafe.name} added.')
+            return redirect(f'/cafes/{cafe.id}')
 
     return render_template('cafe/add-form.html', form=form)
 
 
-@app.route('/cafes/<int:cafe_id>/edit/', methods=['GET', 'POST'])
+@bp.route('/cafes/<int:cafe_id>/edit/', methods=['GET', 'POST'])
 def cafe_edit(cafe_id):
     """Show form to edit cafe"""
 
     cafe = Cafe.query.get_or_404(cafe_id)
     form = CafeForm(obj=cafe)
     # Is this an acceptable way to handle the default image?
-    if form.image_url.data == DEFAULT_CAFE_IMG_PATH:
+    if (form.image_url.data == DEFAULT_CAFE_IMG_PATH
+            or image_store.is_upload(form.image_url.data)):
         form.image_url.data = ''
 
     form.city_code.choices = set_dropdown_choices(
@@ -129,46 +297,207 @@ def cafe_edit(cafe_id):
         cafe.url = form.url.data,
         cafe.address = form.address.data,
         cafe.city_code = form.city_code.data,
-        cafe.image_url = form.image_url.data.strip() or DEFAULT_CAFE_IMG_PATH
-
-        db.session.commit()
-        flash(f'{cafe.name} edited.')
-        return redirect(f'/cafes/{cafe.id}')
+        cafe.latitude = form.latitude.data
+        cafe.longitude = form.longitude.data
+        cafe.version = Cafe.version + 1
+        cafe.updated_at = utcnow()
+
+        try:
+            uploaded = apply_image_fields(form, cafe, DEFAULT_CAFE_IMG_PATH)
+            if uploaded:
+                image_store.make_variants_later(cafe, 'card', 'detail')
+            db.session.commit()
+        except BadImage as exc:
+            db.session.rollback()
+            form.image_file.errors.append(str(exc))
+        except IntegrityError:
+            if uploaded:
+                image_store.delete(cafe.image_url)
+            db.session.rollback()
+            form.name.errors.append(DUPLICATE_CAFE_MSG)
+        else:
+            flash(f'{cafe.name} edited.')
+            return redirect(f'/cafes/{cafe.id}')
 
     return render_template(
         'cafe/edit-form.html', form=form, cafe_name=cafe.name, cafe_id=cafe.id)
 
 
-@app.get('/cafes/<int:cafe_id>')
+@bp.get('/cafes/<int:cafe_id>')
+@read_replica
 def cafe_detail(cafe_id):
-    """Show detail for cafe."""
+    """Show detail for cafe. The like star is rendered filled or empty
+    here, so the page needs no call to /api/likes."""
+
+    # Whether the viewer likes the cafe rides along with the version check.
+    liked = Like.exists_stmt(g.user.id, cafe_id).scalar_subquery() \
+        if g.user else db.false()
+    meta = db.session.query(
+        Cafe.version, Cafe.updated_at, liked.label('liked')).filter(
+        Cafe.id == cafe_id).first_or_404()
+    etag = page_etag('cafe', cafe_id, meta.version, meta.liked)
+    # Liking doesn't change updated_at, so only the ETag can tell a
+    # logged-in viewer's page is stale.
+    last_modified = None if g.user else meta.updated_at
+
+    if can_use_conditional_get():
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+    cafe = Cafe.query.options(db.joinedload(Cafe.city)).get_or_404(cafe_id)
+
+    response = make_response(render_template(
+        'cafe/detail.html',
+        cafe=cafe,
+        liked=meta.liked,
+    ))
+    return add_validators(response, etag, last_modified)
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+
+def get_list_limit(default):
+    """Return how many cafes to list from ?limit= (`default` if it's not
+    given), within sane bounds. Raises ValueError if it isn't a number."""
+
+    limit = request.args.get('limit')
+    if limit is None:
+        limit = default
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('limit must be a whole number') from None
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+@bp.get('/cafes/popular')
+@read_replica
+def cafe_popular():
+    """Show the most-liked cafes."""
+
+    try:
+        limit = get_list_limit(current_app.config['POPULAR_CAFES_LIMIT'])
+    except ValueError:
+        abort(400)
+    cafes = (Cafe.query
+             .options(db.joinedload(Cafe.city))
+             .order_by(Cafe.like_count.desc(), Cafe.id.desc())
+             .limit(limit)
+             .all())
+
+    return render_template('cafe/popular.html', cafes=cafes)
+
+
+def get_location_args():
+    """Return (lat, lng, radius_km) from ?lat=&lng=&radius=.
+    Raises ValueError if they're missing or out of range."""
+
+    config = current_app.config
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius', config['NEAR_RADIUS_KM'], type=float)
+
+    if lat is None or lng is None:
+        raise ValueError('lat and lng are required')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180
+            and 0 < radius <= config['NEAR_MAX_RADIUS_KM']):
+        raise ValueError('lat, lng or radius out of range')
+    return lat, lng, radius
+
+
+def near_cafes_query(query=None):
+    """Return a query for the cafes near ?lat=&lng=, nearest first, and the
+    distance expression. Raises ValueError for bad arguments."""
+
+    lat, lng, radius = get_location_args()
+    query, distance = Cafe.near(lat, lng, radius, query)
+    limit = get_list_limit(current_app.config['NEAR_CAFES_LIMIT'])
+    return query.order_by(distance, Cafe.id).limit(limit), distance
+
+
+@bp.get('/cafes/near')
+@read_replica
+def cafe_near():
+    """Show the cafes nearest a point, nearest first.
+        Takes q-string ?lat=<deg>&lng=<deg> and optional ?radius=<km>"""
+
+    cafes = None
+    if 'lat' in request.args or 'lng' in request.args:
+        try:
+            query, distance = near_cafes_query()
+        except ValueError:
+            abort(400)
+        cafes = query.options(
+            db.with_expression(Cafe.distance_km, distance),
+            db.joinedload(Cafe.city)).all()
 
     return render_template(
-        'cafe/detail.html',
-        cafe=cafe,
+        'cafe/near.html',
+        cafes=cafes,
+        lat=request.args.get('lat', ''),
+        lng=request.args.get('lng', ''),
+        radius=request.args.get(
+            'radius', current_app.config['NEAR_RADIUS_KM']),
     )
 
 
-@app.route('/signup', methods=['GET', 'POST'])
+@bp.get('/cafes/search')
+@read_replica
+def cafe_search():
+    """Search cafes by name, description and address, best matches first.
+        Takes q-string ?q=<terms> and optional ?after= or ?before=<cursor>"""
+
+    terms = request.args.get('q', '').strip()
+    cafes, prev_cursor, next_cursor = [], None, None
+
+    if terms:
+        query, rank = Cafe.search(terms)
+        query = query.options(
+            db.with_expression(Cafe.search_rank, rank),
+            db.joinedload(Cafe.city))
+        try:
+            cafes, prev_cursor, next_cursor = paginate_keyset(
+                query,
+                [rank, Cafe.id],
+                per_page=current_app.config['CAFES_PER_PAGE'],
+                after=request.args.get('after'),
+                before=request.args.get('before'),
+                descending=True)
+        except ValueError:
+            abort(400)
+
+    return render_template(
+        'cafe/search.html',
+        terms=terms,
+        cafes=cafes,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+    )
+
+
+@bp.route('/signup', methods=['GET', 'POST'])
 def signup():
     form = SignupForm()
 
     if form.validate_on_submit():
 
-        user = User.register(
-            username=form.username.data,
-            first_name=form.first_name.data,
-            last_name=form.last_name.data,
-            description=form.description.data,
-            email=form.email.data,
-            password=form.password.data,
-            image_url=form.image_url.data or DEFAULT_USER_IMG_PATH
-        )
+        try:
+            user = User.register(
+                username=form.username.data,
+                first_name=form.first_name.data,
+                last_name=form.last_name.data,
+                description=form.description.data,
+                email=form.email.data,
+                password=form.password.data,
+                image_url=form.image_url.data or DEFAULT_USER_IMG_PATH
+            )
+        except HasherBusy:
+            flash(BUSY_MSG)
+            return render_template('auth/signup-form.html', form=form), 503
         if not user:
             flash('Username already taken.')
             return redirect('/signup')
+        login_throttle.succeeded(user.username, request.remote_addr)
         do_login(user)
         flash('You are signed up and logged in.')
         return redirect('/cafes')
@@ -176,24 +505,40 @@ def signup():
     return render_template('auth/signup-form.html', form=form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data, form.password.data)
+        username, password = form.username.data, form.password.data
+
+        if not login_throttle.allow(username, request.remote_addr):
+            flash(THROTTLED_MSG)
+            return render_template('auth/login-form.html', form=form), 429
+
+        if login_throttle.recently_failed(username, password):
+            user = False
+        else:
+            try:
+                user = User.authenticate(username, password)
+            except HasherBusy:
+                flash(BUSY_MSG)
+                return render_template('auth/login-form.html', form=form), 503
+
         if user:
+            login_throttle.succeeded(username, request.remote_addr)
             do_login(user)
             flash(f"Hello, {user.username}!")
             return redirect('/cafes')
         else:
+            login_throttle.record_failure(username, password)
             flash("Invalid credentials.")
             return redirect('/login')
 
     return render_template('auth/login-form.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
 
     if g.user:
@@ -207,20 +552,25 @@ def logout():
 # users
 
 
-@app.get('/profile')
+@bp.get('/profile')
+@read_replica
 def show_profile():
     """ Show the profile page. """
 
     if g.user:
-        likes = User.query.filter(
-            User.username == g.user.username).first().liked_cafes
+        likes = (Cafe.query
+                 .join(Like, Like.cafe_id == Cafe.id)
+                 .filter(Like.user_id == g.user.id)
+                 .options(db.joinedload(Cafe.city))
+                 .order_by(Cafe.name, Cafe.id)
+                 .all())
         return render_template('profile/detail.html', likes=likes)
     else:
         flash(NOT_LOGGED_IN_MSG)
         return redirect('/login')
 
 
-@app.route('/profile/edit', methods=['GET', 'POST'])
+@bp.route('/profile/edit', methods=['GET', 'POST'])
 def edit_profile():
     """ Show and process the profile edit form. """
 
@@ -229,65 +579,482 @@ def edit_profile():
         return redirect('/cafes')
 
     form = ProfileEditForm(obj=g.user)
-    if form.image_url.data == DEFAULT_USER_IMG_PATH:
+    if (form.image_url.data == DEFAULT_USER_IMG_PATH
+            or image_store.is_upload(form.image_url.data)):
         form.image_url.data = ''
     if form.validate_on_submit():
         g.user.first_name = form.first_name.data
         g.user.last_name = form.last_name.data
         g.user.description = form.description.data
         g.user.email = form.email.data
-        g.user.image_url = form.image_url.data.strip() or DEFAULT_USER_IMG_PATH
 
-        db.session.commit()
-        flash('Profile edited')
-        return redirect('/profile')
+        try:
+            uploaded = apply_image_fields(form, g.user, DEFAULT_USER_IMG_PATH)
+        except BadImage as exc:
+            db.session.rollback()
+            form.image_file.errors.append(str(exc))
+        else:
+            if uploaded:
+                image_store.make_variants_later(
+                    db.session.get(User, g.user.id), 'avatar')
+            db.session.commit()
+            CurrentUser.forget(g.user.id)
+            flash('Profile edited')
+            return redirect('/profile')
+
+    return render_template('profile/edit-form.html', form=form)
+
+
+#######################################
+# cafes API
+
+CAFE_API_FIELDS = ("id", "name", "description", "url", "address",
+                   "city_code", "image_url", "like_count", "latitude",
+                   "longitude", "city")
+
+
+def get_api_fields():
+    """Return the cafe fields asked for in ?fields=a,b,c (all by default).
+    Aborts with a 400 for unknown field names."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return CAFE_API_FIELDS
+
+    fields = tuple(f.strip() for f in fields.split(',') if f.strip())
+    if not fields:
+        return CAFE_API_FIELDS
+    unknown = set(fields) - set(CAFE_API_FIELDS)
+    if unknown:
+        abort(make_response(
+            {"error": f"Unknown fields: {', '.join(sorted(unknown))}"}, 400))
+    return fields
+
+
+def cafe_api_query(fields):
+    """Return a query selecting only the columns needed for `fields`, plus
+    name and id for the keyset cursor."""
+
+    names = dict.fromkeys(['name', 'id', *fields])
+    if 'city' in names:
+        del names['city']
+        names['city_code'] = None  # the nested city includes its code
+    query = db.session.query(*[getattr(Cafe, n) for n in names])
+
+    if 'city' in fields:
+        query = query.add_columns(
+            City.name.label('city_name'),
+            City.state.label('city_state')).join(City)
+    return query
+
+
+def serialize_cafe_row(row, fields):
+    """Serialize a row from cafe_api_query, like Cafe.serialize() but with
+    just `fields`. "city" nests the cafe's City.serialize()."""
+
+    cafe = {}
+    for field in fields:
+        if field == 'city':
+            cafe['city'] = {
+                "code": row.city_code,
+                "name": row.city_name,
+                "state": row.city_state,
+            }
+        else:
+            cafe[field] = getattr(row, field)
+    return cafe
+
+
+@bp.get('/api/cafes')
+@read_replica
+def api_cafe_list():
+    """ Return a page of cafes as JSON, ordered by name.
+        Takes optional q-string ?after=<cursor>&limit=<n>&fields=<a,b,c>
+            --> {"cafes": [{...}, ...], "next": <cursor>|null}
+        The response is streamed a row at a time from a server-side cursor.
+    """
+
+    fields = get_api_fields()
+    try:
+        per_page = get_list_limit(current_app.config['CAFES_PER_PAGE'])
+        query = keyset_query(
+            cafe_api_query(fields),
+            [Cafe.name, Cafe.id],
+            after=request.args.get('after'))
+    except ValueError:
+        abort(make_response({"error": "Bad limit or cursor."}, 400))
+
+    # Run the query and fetch the first row now, so a failure is an error
+    # response and not a 200 with a cut-off body.
+    rows = iter(query.limit(per_page + 1).execution_options(yield_per=100))
+    first = next(rows, None)
+    if first is not None:
+        rows = itertools.chain([first], rows)
+
+    def generate():
+        yield '{"cafes":['
+        last = None
+        for count, row in enumerate(rows):
+            if count == per_page:
+                break
+            yield (',' if count else '') + json.dumps(
+                serialize_cafe_row(row, fields))
+            last = row
+        else:
+            last = None  # the loop ran out, so this is the last page
+
+        next_cursor = encode_cursor([last.name, last.id]) if last else None
+        yield '],"next":' + json.dumps(next_cursor) + '}'
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype='application/json')
+
+
+@bp.get('/api/cafes/popular')
+@read_replica
+def api_cafe_popular():
+    """ Return the most-liked cafes as JSON, most liked first.
+        Takes optional q-string ?limit=<n>&fields=<a,b,c>
+            --> {"cafes": [{...}, ...]} """
+
+    fields = get_api_fields()
+    try:
+        limit = get_list_limit(current_app.config['POPULAR_CAFES_LIMIT'])
+    except ValueError as exc:
+        return {"error": str(exc).capitalize() + "."}, 400
+    rows = (cafe_api_query(fields)
+            .order_by(Cafe.like_count.desc(), Cafe.id.desc())
+            .limit(limit))
+
+    return {"cafes": [serialize_cafe_row(row, fields) for row in rows]}
+
+
+@bp.get('/api/cafes/near')
+@read_replica
+def api_cafe_near():
+    """ Return the cafes nearest a point as JSON, nearest first.
+        Takes q-string ?lat=<deg>&lng=<deg> and optional ?radius=<km>
+        &limit=<n>&fields=<a,b,c>
+            --> {"cafes": [{..., "distance_km": <km>}, ...]} """
+
+    fields = get_api_fields()
+    try:
+        query, distance = near_cafes_query(cafe_api_query(fields))
+    except ValueError as exc:
+        return {"error": str(exc).capitalize() + "."}, 400
+
+    cafes = []
+    for row in query.add_columns(distance):
+        cafe = serialize_cafe_row(row, fields)
+        cafe["distance_km"] = round(row.distance_km, 3)
+        cafes.append(cafe)
+    return {"cafes": cafes}
+
+
+@bp.get('/api/cafes/search')
+@read_replica
+def api_cafe_search():
+    """ Return a page of cafes matching a search as JSON, best first.
+        Takes q-string ?q=<terms> and optional ?after=<cursor>&limit=<n>
+        &fields=<a,b,c>
+            --> {"cafes": [{...}, ...], "next": <cursor>|null} """
+
+    terms = request.args.get('q', '').strip()
+    if not terms:
+        return {"error": "Missing search terms."}, 400
+
+    fields = get_api_fields()
+    query, rank = Cafe.search(terms, cafe_api_query(fields))
+    try:
+        per_page = get_list_limit(current_app.config['CAFES_PER_PAGE'])
+        rows, _, next_cursor = paginate_keyset(
+            query.add_columns(rank),
+            [rank, Cafe.id],
+            per_page,
+            after=request.args.get('after'),
+            descending=True)
+    except ValueError:
+        abort(make_response({"error": "Bad limit or cursor."}, 400))
+
+    return {
+        "cafes": [serialize_cafe_row(row, fields) for row in rows],
+        "next": next_cursor,
+    }
+
+
+@bp.get('/api/cafes/<int:cafe_id>')
+@read_replica
+def api_cafe_detail(cafe_id):
+    """ Return one cafe as JSON.
+        Takes optional q-string ?fields=<a,b,c> --> {"cafe": {...}} """
+
+    fields = get_api_fields()
+    row = cafe_api_query(fields).filter(Cafe.id == cafe_id).first()
+    if row is None:
+        return {"error": NO_SUCH_CAFE_MSG}, 404
+
+    return {"cafe": serialize_cafe_row(row, fields)}
+
+
+#######################################
+# status
+
+
+@bp.get('/status/db-pool')
+def db_pool_status():
+    """ Return this process's connection pool statistics as JSON, per bind
+        ("default" is the main database).
+            --> {"default": {"checked_out": 1, "overflow": 0, ...}} """
+
+    return {bind or "default": pool_status(engine)
+            for bind, engine in db.engines.items()}
+
+
+@bp.get('/metrics')
+def metrics():
+    """ Return this process's metrics in Prometheus text format: latency,
+        SQL statements and SQL time per endpoint, plus the connection pools,
+        caches, login throttle and job queue. """
+
+    pools = [({'bind': bind or 'default'}, pool_status(engine))
+             for bind, engine in db.engines.items()]
+    caches = [({'cache': 'fragment'}, fragment_cache.stats()),
+              ({'cache': 'user_summary'}, user_summary_cache.stats())]
+    throttle = login_throttle.stats()
+    jobs = job_queue.stats()
+
+    text = request_metrics.render() + ''.join([
+        format_metric(
+            'flask_cafe_db_pool_checked_out', 'gauge',
+            'Connections checked out of the pool.',
+            [(labels, s['checked_out']) for labels, s in pools]),
+        format_metric(
+            'flask_cafe_db_pool_checkouts_total', 'counter',
+            'Connections handed out by the pool.',
+            [(labels, s['checkouts']) for labels, s in pools]),
+        format_metric(
+            'flask_cafe_db_pool_timeouts_total', 'counter',
+            'Checkouts that gave up waiting for a connection.',
+            [(labels, s['timeouts']) for labels, s in pools]),
+        format_metric(
+            'flask_cafe_db_pool_wait_seconds_total', 'counter',
+            'Time spent waiting for a connection.',
+            [(labels, s['wait_seconds_total']) for labels, s in pools]),
+        format_metric(
+            'flask_cafe_cache_hits_total', 'counter', 'Cache hits.',
+            [(labels, s['hits']) for labels, s in caches]),
+        format_metric(
+            'flask_cafe_cache_misses_total', 'counter', 'Cache misses.',
+            [(labels, s['misses']) for labels, s in caches]),
+        format_metric(
+            'flask_cafe_cache_entries', 'gauge', 'Entries in the cache.',
+            [(labels, s['size']) for labels, s in caches]),
+        format_metric(
+            'flask_cafe_login_attempts_total', 'counter',
+            'Login attempts, throttled or not.',
+            [({}, throttle['attempts'])]),
+        format_metric(
+            'flask_cafe_login_shed_total', 'counter',
+            'Login attempts turned away without hashing.',
+            [({'reason': 'throttled'}, throttle['throttled']),
+             ({'reason': 'cached_failure'}, throttle['cached_failures'])]),
+        format_metric(
+            'flask_cafe_jobs', 'gauge', 'Jobs in the queue, by state.',
+            [({'state': state}, n) for state, n in jobs.items()]),
+    ])
+    return text, {'Content-Type': CONTENT_TYPE}
+
+
+#######################################
+# commands
+
+
+@bp.cli.command('backfill-like-counts')
+def backfill_like_counts():
+    """Recount every cafe's like_count from the likes table."""
+
+    changed = Like.backfill_like_counts()
+    print(f'Updated like counts for {changed} cafes.')
+
+
+def run_import(import_fn, source, fmt, batch_size, rejects):
+    """Stream records from source into import_fn, printing progress to
+    stderr and rejected rows as JSONL to `rejects`."""
+
+    if fmt is None:
+        fmt = 'csv' if source.name.endswith('.csv') else 'jsonl'
+
+    def on_reject(line_num, record, errors):
+        if rejects:
+            rejects.write(json.dumps(
+                {"line": line_num, "errors": errors, "record": record}) + '\n')
+
+    def on_batch(stats):
+        click.echo(str(stats), err=True)
+
+    stats = import_fn(
+        importer.read_records(source, fmt), batch_size=batch_size,
+        on_reject=on_reject, on_batch=on_batch)
+    click.echo(f'Done: {stats}')
+
+
+def import_command(name, import_fn, help):
+    """Register `flask <name>` to run import_fn over a CSV or JSONL file."""
+
+    @bp.cli.command(name, help=help)
+    @click.argument('source', type=click.File('r', encoding='utf-8'),
+                    default='-')
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+                  help='Input format; by default, from the file name.')
+    @click.option('--batch-size', default=importer.DEFAULT_BATCH_SIZE,
+                  show_default=True, help='Rows per insert.')
+    @click.option('--rejects', type=click.File('w', encoding='utf-8'),
+                  help='Write rejected rows here, as JSONL.')
+    def command(source, fmt, batch_size, rejects):
+        run_import(import_fn, source, fmt, batch_size, rejects)
+
+
+import_command(
+    'import-cities', importer.import_cities,
+    'Insert or update cities (code, name, state) from a CSV or JSONL file, '
+    'or stdin.')
+import_command(
+    'import-cafes', importer.import_cafes,
+    'Insert or update cafes from a CSV or JSONL file, or stdin, matching '
+    'existing cafes by name, address and city. Rows are checked like the '
+    'add-cafe form.')
+
+
+@bp.cli.command('worker')
+@click.option('--threads', default=1, show_default=True,
+              help='Jobs to run at once.')
+@click.option('--burst', is_flag=True,
+              help='Exit once no job is ready, instead of waiting for more.')
+def worker(threads, burst):
+    """Run queued background jobs until interrupted."""
+
+    ran = job_queue.work(
+        current_app._get_current_object(), threads=threads, burst=burst)
+    print(f'Ran {ran} jobs.')
 
-    else:
-        return render_template('profile/edit-form.html', form=form)
 
 #######################################
 # likes
 
 
-@app.get('/api/likes')
+@bp.get('/api/likes')
+@read_replica
 def does_user_like_cafe():
     """ For a GET request, return whether user likes the cafe in the
         query string as a boolean
-            Receive q-string ?cafe_id=1 --> return {"likes": true|false} """
+            Receive q-string ?cafe_id=1 --> return {"likes": true|false}
+        or, for a comma-separated list of cafes, a boolean per cafe
+            Receive q-string ?cafe_id=1,2 --> return
+                {"likes": {"1": true|false, "2": true|false}} """
+
+    if not g.user:
+        return {"error": NOT_LOGGED_IN_MSG}, 401
+
+    try:
+        cafe_ids = parse_cafe_ids(
+            request.args['cafe_id'], current_app.config['API_MAX_PAGE_SIZE'])
+    except KeyError:
+        return {"error": CAFE_IDS_MSG}, 400
+    except ValueError as exc:
+        return {"error": str(exc)}, 400
 
-    # TODO: Each of these API routes needs user login verification.
-    cafe_id = request.args['cafe_id']
-    return {"likes": int(cafe_id) in [cafe.id for cafe in g.user.liked_cafes]}
+    # Ids out of range can't be liked, and would overflow the query.
+    if len(cafe_ids) == 1:
+        cafe_id = cafe_ids[0]
+        return {"likes": is_cafe_id(cafe_id)
+                and Like.exists(g.user.id, cafe_id)}
 
+    liked = Like.liked_cafe_ids(
+        g.user.id, [c for c in cafe_ids if is_cafe_id(c)])
+    return {"likes": {str(c): c in liked for c in cafe_ids}}
 
-@app.post('/api/like')
+
+@bp.post('/api/like')
 def user_like_cafe():
     """ For a POST request, given JSON with a cafe_id, make the current
-        user like the cafe.
+        user like the cafe. Liking twice is harmless.
         E.g.,
-            Receive {"cafe_id": 1} --> user now likes cafe 1 """
+            Receive {"cafe_id": 1} --> user now likes cafe 1
+                --> return {"liked": 1, "likes": true} """
 
-    # TODO: Each of these API routes needs user login verification.
-    cafe_id = request.json['cafe_id']
-    liked_cafe = Cafe.query.get(cafe_id)
-    g.user.liked_cafes.append(liked_cafe)
-    db.session.commit()
-    return {"liked": cafe_id}
+    if not g.user:
+        return {"error": NOT_LOGGED_IN_MSG}, 401
+
+    cafe_id = get_json_cafe_id()
+    try:
+        Like.add(g.user.id, cafe_id)
+        db.session.commit()
+    except IntegrityError:  # no such cafe
+        db.session.rollback()
+        return {"error": NO_SUCH_CAFE_MSG}, 404
+    return {"liked": cafe_id, "likes": True}
 
 
-@app.post('/api/unlike')
+@bp.post('/api/unlike')
 def user_unlike_cafe():
     """ For a POST request, given JSON with a cafe_id, make the current
-        user un-like the cafe.
+        user un-like the cafe. Un-liking twice is harmless.
         E.g.,
-            Receive {"cafe_id": 1} --> user no longers likes cafe 1"""
+            Receive {"cafe_id": 1} --> user no longers likes cafe 1
+                --> return {"unliked": 1, "likes": false} """
+
+    if not g.user:
+        return {"error": NOT_LOGGED_IN_MSG}, 401
+
+    cafe_id = get_json_cafe_id()
+    Like.remove(g.user.id, cafe_id)
+    db.session.commit()
+    return {"unliked": cafe_id, "likes": False}
+
+
+def get_json_cafe_id():
+    """ Return the integer cafe_id from a JSON request body, or abort with
+        a 400 if there isn't one. """
+
+    try:
+        return parse_cafe_id(request.get_json(silent=True)['cafe_id'])
+    except (TypeError, KeyError, ValueError):
+        abort(make_response({"error": NO_CAFE_ID_MSG}, 400))
+
+
+def parse_cafe_id(value):
+    """ Return `value` as a cafe id. Raises ValueError if it isn't a
+        whole number, or is outside the range ids can have (1 to MAX_ID).
+        JSON true and 2.5 aren't ids, though int() would take them. """
+
+    if isinstance(value, bool) or (
+            isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f'Bad cafe id: {value!r}')
+    try:
+        cafe_id = int(value)
+    except OverflowError:  # int(float('inf'))
+        raise ValueError(f'Bad cafe id: {value!r}')
+    if not is_cafe_id(cafe_id):
+        raise ValueError(f'Bad cafe id: {value!r}')
+    return cafe_id
+
+
+def parse_cafe_ids(value, max_ids):
+    """ Return a comma-separated list of cafe ids as integers. Raises
+        ValueError, with a message for the client, if one isn't a number
+        or there are more than max_ids of them. Ids out of range are
+        returned; check them with is_cafe_id. """
+
+    ids = value.split(',')
+    if len(ids) > max_ids:
+        raise ValueError(TOO_MANY_CAFE_IDS_MSG.format(max_ids))
+    try:
+        return [int(c) for c in ids]
+    except ValueError:
+        raise ValueError(CAFE_IDS_MSG) from None
 
-    # TODO: Each of these API routes needs user login verification.
-    cafe_id = int(request.json['cafe_id'])
-    liked_cafe = Cafe.query.get(cafe_id)
-    if liked_cafe:
-        g.user.liked_cafes.remove(liked_cafe)
-        db.session.commit()
-    return {"unliked": cafe_id}
 
+def is_cafe_id(number):
+    """ Return whether an integer is in the range ids can have. """
 
+    return 1 <= number <= MAX_ID
@@ -0,0 +1,317 @@
+"""ASGI entry point for Flask Cafe, with async views for the likes API.
+
+Run it under an ASGI server:
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+GET /api/likes, POST /api/like and POST /api/unlike are answered here, on
+the event loop, by an async SQLAlchemy session over asyncpg: a request
+waiting on Postgres holds no thread. Every other request goes to the Flask
+app through a2wsgi's WSGIMiddleware, which runs it on a pool of
+WSGI_THREADS threads.
+"""
+
+import json
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie, parse_cookie
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app import (create_app, replica_router, parse_cafe_id, parse_cafe_ids,
+                 is_cafe_id, CURR_USER_KEY, NOT_LOGGED_IN_MSG, CAFE_IDS_MSG,
+                 NO_CAFE_ID_MSG, NO_SUCH_CAFE_MSG)
+from models import Like, CurrentUser, user_summary_cache
+from pool import engine_options
+from replicas import PRIMARY_UNTIL_KEY
+
+# Bigger JSON bodies than this are refused, unread.
+MAX_BODY_BYTES = 64 * 1024
+
+
+def async_database_uri(uri):
+    """ Return the database URI with its driver switched to asyncpg. """
+
+    url = make_url(uri).set(drivername='postgresql+asyncpg')
+    return url.render_as_string(hide_password=False)
+
+
+class Request:
+    """ The parts of an ASGI HTTP request the likes views need. """
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.args = {k: v[-1] for k, v in parse_qs(
+            scope['query_string'].decode('latin-1')).items()}
+        self.headers = {}
+        for key, value in scope['headers']:
+            key, value = key.decode('latin-1').lower(), value.decode('latin-1')
+            if key in self.headers:
+                # Browsers may split cookies over several Cookie headers.
+                joiner = '; ' if key == 'cookie' else ', '
+                value = self.headers[key] + joiner + value
+            self.headers[key] = value
+        self.session = None
+        self.set_cookie = None
+
+    def cookie(self, name):
+        """ Return a cookie's value, or None. Parses the Cookie header as
+            Flask does, skipping over cookies it can't make sense of. """
+
+        return parse_cookie(self.headers.get('cookie', '')).get(name)
+
+    async def json(self):
+        """ Return the JSON body, or None if there isn't a valid one, as
+            Flask's request.get_json(silent=True) does. """
+
+        mimetype = self.headers.get('content-type', '').split(';')[0].strip()
+        if not (mimetype == 'application/json' or mimetype.endswith('+json')):
+            return None
+
+        body = b''
+        more_body = True
+        while more_body:
+            message = await self.receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if len(body) > MAX_BODY_BYTES:
+                return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+
+class LikesApp:
+    """ An ASGI app that serves the likes API itself and hands every other
+        request to the Flask app.
+
+        The views behave like their sync versions in app.py: they read the
+        logged-in user from the Flask session cookie, run the same
+        statements (see Like.*_stmt), and answer with the same JSON. The
+        async engine takes its pool settings from the same DB_POOL_*
+        config, so plan connections for both pools. Requests served here
+        skip the Flask hooks, so they don't show up in /metrics. They
+        always use the primary, and, like ReplicaRouter, a like or unlike
+        keeps the visitor's Flask views on the primary for a while.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(
+            flask_app, workers=flask_app.config['WSGI_THREADS'])
+        interface = flask_app.session_interface
+        self.session_serializer = interface.get_signing_serializer(flask_app)
+        self.session_cookie = interface.get_cookie_name(flask_app)
+        self.session_max_age = int(
+            flask_app.permanent_session_lifetime.total_seconds())
+        self.cookie_options = {
+            'domain': interface.get_cookie_domain(flask_app),
+            'path': interface.get_cookie_path(flask_app),
+            'secure': interface.get_cookie_secure(flask_app),
+            'httponly': interface.get_cookie_httponly(flask_app),
+            'samesite': interface.get_cookie_samesite(flask_app),
+        }
+        self.engine = None
+        self.sessionmaker = None
+        self.views = {
+            ('GET', '/api/likes'): self.does_user_like_cafe,
+            ('POST', '/api/like'): self.user_like_cafe,
+            ('POST', '/api/unlike'): self.user_unlike_cafe,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        view = self.views.get((scope.get('method'), scope.get('path')))
+        if scope['type'] != 'http' or view is None:
+            return await self.wsgi(scope, receive, send)
+
+        request = Request(scope, receive)
+        status, body = await view(request)
+        payload = json.dumps(body).encode('utf8') + b'\n'
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(payload)).encode()),
+                   (b'vary', b'Cookie')]
+        if request.set_cookie:
+            headers.append((b'set-cookie', request.set_cookie.encode()))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def connect(self):
+        """ Make the async engine. Its connections belong to the running
+            event loop. """
+
+        config = self.flask_app.config
+        uri = async_database_uri(config['SQLALCHEMY_DATABASE_URI'])
+        options = engine_options(
+            {**config, 'SQLALCHEMY_DATABASE_URI': uri}, asyncio=True)
+        self.engine = create_async_engine(uri, **options)
+        self.sessionmaker = async_sessionmaker(
+            self.engine, expire_on_commit=False)
+
+    async def dispose(self):
+        """ Close the async engine's connections. """
+
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = self.sessionmaker = None
+
+    def session(self, begin=False):
+        if self.sessionmaker is None:
+            self.connect()
+        return self.sessionmaker.begin() if begin else self.sessionmaker()
+
+    def load_session(self, request):
+        """ Return the Flask session from the request's cookie: a dict,
+            empty if there's no valid cookie. """
+
+        if request.session is None:
+            request.session = {}
+            value = request.cookie(self.session_cookie)
+            try:
+                if value:
+                    request.session = self.session_serializer.loads(
+                        value, max_age=self.session_max_age)
+            except BadSignature:  # Flask ignores these, expired ones too
+                pass
+        return request.session
+
+    def user_summaries(self):
+        """ Return the Flask app's user summary LRUCache. """
+
+        return user_summary_cache.for_app(self.flask_app)
+
+    def user_id(self, request):
+        """ Return the logged-in user's id from the Flask session cookie,
+            or None. """
+
+        return self.load_session(request).get(CURR_USER_KEY)
+
+    async def current_user_id(self, request):
+        """ Return the logged-in user's id, or None if no one is logged in
+            or the user no longer exists; g.user is false then too. Uses
+            the same user summary cache as CurrentUser. """
+
+        user_id = self.user_id(request)
+        if user_id is None or self.user_summaries().get(user_id) is not None:
+            return user_id
+        async with self.session() as session:
+            row = (await session.execute(
+                CurrentUser.summary_stmt(user_id))).first()
+        if row is None:
+            return None
+        self.user_summaries().set(
+            user_id, CurrentUser.summary_from_row(row))
+        return user_id
+
+    def stick_to_primary(self, request):
+        """ After a write, set PRIMARY_UNTIL_KEY in the visitor's session
+            cookie, as ReplicaRouter does for the Flask views. """
+
+        if not replica_router.uses_replicas(self.flask_app):
+            return
+        session = {**self.load_session(request),
+                   PRIMARY_UNTIL_KEY: replica_router.primary_until(
+                       self.flask_app)}
+        request.set_cookie = dump_cookie(
+            self.session_cookie, self.session_serializer.dumps(session),
+            **self.cookie_options)
+
+    async def json_cafe_id(self, request):
+        try:
+            return parse_cafe_id((await request.json())['cafe_id'])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    async def does_user_like_cafe(self, request):
+        """ Async GET /api/likes; see app.does_user_like_cafe. """
+
+        user_id = await self.current_user_id(request)
+        if user_id is None:
+            return 401, {"error": NOT_LOGGED_IN_MSG}
+
+        try:
+            cafe_ids = parse_cafe_ids(
+                request.args['cafe_id'],
+                self.flask_app.config['API_MAX_PAGE_SIZE'])
+        except KeyError:
+            return 400, {"error": CAFE_IDS_MSG}
+        except ValueError as exc:
+            return 400, {"error": str(exc)}
+
+        valid_ids = [c for c in cafe_ids if is_cafe_id(c)]
+        async with self.session() as session:
+            if len(cafe_ids) == 1:
+                likes = bool(valid_ids) and await session.scalar(
+                    Like.exists_stmt(user_id, cafe_ids[0]))
+                return 200, {"likes": likes}
+
+            rows = await session.scalars(
+                Like.liked_cafe_ids_stmt(user_id, valid_ids))
+            liked = set(rows)
+        return 200, {"likes": {str(c): c in liked for c in cafe_ids}}
+
+    async def user_like_cafe(self, request):
+        """ Async POST /api/like; see app.user_like_cafe. """
+
+        user_id = await self.current_user_id(request)
+        if user_id is None:
+            return 401, {"error": NOT_LOGGED_IN_MSG}
+        cafe_id = await self.json_cafe_id(request)
+        if cafe_id is None:
+            return 400, {"error": NO_CAFE_ID_MSG}
+
+        try:
+            async with self.session(begin=True) as session:
+                result = await session.execute(Like.add_stmt(user_id, cafe_id))
+                if result.first() is not None:
+                    await session.execute(Like.like_count_stmt(cafe_id, 1))
+        except IntegrityError:  # no such cafe
+            return 404, {"error": NO_SUCH_CAFE_MSG}
+        self.stick_to_primary(request)
+        return 200, {"liked": cafe_id, "likes": True}
+
+    async def user_unlike_cafe(self, request):
+        """ Async POST /api/unlike; see app.user_unlike_cafe. """
+
+        user_id = await self.current_user_id(request)
+        if user_id is None:
+            return 401, {"error": NOT_LOGGED_IN_MSG}
+        cafe_id = await self.json_cafe_id(request)
+        if cafe_id is None:
+            return 400, {"error": NO_CAFE_ID_MSG}
+
+        async with self.session(begin=True) as session:
+            result = await session.execute(Like.remove_stmt(user_id, cafe_id))
+            if result.first() is not None:
+                await session.execute(Like.like_count_stmt(cafe_id, -1))
+        self.stick_to_primary(request)
+        return 200, {"unliked": cafe_id, "likes": False}
+
+
+def create_asgi_app(config_name=None):
+    """ Create the Flask app and wrap it for an ASGI server; see
+        app.create_app for config_name. """
+
+    return LikesApp(create_app(config_name))
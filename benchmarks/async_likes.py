@@ -0,0 +1,190 @@
+""" Sync vs async likes API benchmark.
+
+Serves the app under uvicorn twice, in a child process each time: first
+with every view on a pool of WSGI threads ("sync"), then through
+asgi.LikesApp, with the likes API on the event loop ("async"). Each time,
+many concurrent clients hammer GET /api/likes, POST /api/like and POST
+/api/unlike as random logged-in users, and it reports requests per second
+and p50/p95/p99 latency for each mode as JSON.
+
+Fill a database with benchmarks/generate.py first:
+
+    DATABASE_URL=postgresql:///flask_cafe_bench FLASK_SECRET_KEY=bench \\
+        python benchmarks/async_likes.py --concurrency 256 --duration 20
+
+--threads sets WSGI_THREADS, like the threads of a sync worker; both modes
+get the same DB_POOL_SIZE. --cafes and --users must not be more than
+generate.py made.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from common import use_app_modules, summarize, report
+
+use_app_modules()
+
+
+def serve(mode, port, threads):
+    """ Run the app under uvicorn until killed (in the child process). """
+
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+    from app import create_app
+    from asgi import LikesApp
+
+    flask_app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+    flask_app.config['WSGI_THREADS'] = threads
+    asgi_app = LikesApp(flask_app) if mode == 'async' \
+        else WSGIMiddleware(flask_app, workers=threads)
+    uvicorn.run(asgi_app, port=port, log_level='warning', backlog=4096)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def session_cookies(count, max_user_id):
+    """ Return Flask session cookie values for random users, signed as the
+        app would sign them. """
+
+    from app import create_app, CURR_USER_KEY
+
+    flask_app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    return [serializer.dumps({CURR_USER_KEY: random.randint(1, max_user_id)})
+            for _ in range(count)]
+
+
+async def drive(base_url, cookies, max_cafe_id, duration):
+    """ Run one client per cookie for `duration` seconds. Returns
+        ({route: [latencies]}, {route: errors}, elapsed seconds). """
+
+    latencies = {'api_likes': [], 'api_like': [], 'api_unlike': []}
+    errors = dict.fromkeys(latencies, 0)
+    limits = httpx.Limits(max_connections=len(cookies),
+                          max_keepalive_connections=len(cookies))
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=60) as client:
+        deadline = time.perf_counter() + duration
+
+        async def run(cookie):
+            headers = {'Cookie': f'session={cookie}'}
+            while time.perf_counter() < deadline:
+                route = random.choices(list(latencies), (5, 3, 2))[0]
+                cafe_id = random.randint(1, max_cafe_id)
+                start = time.perf_counter()
+                try:
+                    if route == 'api_likes':
+                        ids = ','.join(str(random.randint(1, max_cafe_id))
+                                       for _ in range(12))
+                        resp = await client.get(
+                            f'/api/likes?cafe_id={ids}', headers=headers)
+                    else:
+                        path = '/api/like' if route == 'api_like' \
+                            else '/api/unlike'
+                        resp = await client.post(
+                            path, json={'cafe_id': cafe_id},
+                            headers=headers)
+                    ok = resp.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                latencies[route].append(time.perf_counter() - start)
+                if not ok:
+                    errors[route] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run(cookie) for cookie in cookies))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def wait_for(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('the server exited')
+        try:
+            httpx.get(base_url + '/api/likes', timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError('the server did not start')
+
+
+def bench(mode, args, cookies):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, __file__, '--serve', mode, '--port', str(port),
+        '--threads', str(args.threads)])
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        wait_for(base_url, process)
+        # Warm up connections and the pools before measuring.
+        asyncio.run(drive(base_url, cookies, args.cafes, 1))
+        latencies, errors, elapsed = asyncio.run(
+            drive(base_url, cookies, args.cafes, args.duration))
+    finally:
+        process.terminate()
+        process.wait()
+
+    every = [s for samples in latencies.values() for s in samples]
+    return {
+        "total": {**summarize(every, elapsed),
+                  "errors": sum(errors.values())},
+        "routes": {route: {**summarize(samples, elapsed),
+                           "errors": errors[route]}
+                   for route, samples in latencies.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=20,
+                        help='Seconds to run each mode for.')
+    parser.add_argument('--concurrency', type=int, default=256,
+                        help='Concurrent clients.')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='WSGI threads for the Flask views.')
+    parser.add_argument('--cafes', type=int, default=1000000,
+                        help='Pick cafe ids from 1 to this.')
+    parser.add_argument('--users', type=int, default=100000,
+                        help='Act as users with ids from 1 to this.')
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--serve', choices=['sync', 'async'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port, args.threads)
+
+    random.seed(23)
+    cookies = session_cookies(args.concurrency, args.users)
+    results = {
+        "settings": {
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "threads": args.threads,
+            "cafes": args.cafes,
+            "users": args.users,
+        },
+    }
+    for mode in args.modes.split(','):
+        results[mode] = bench(mode, args, cookies)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+""" Helpers shared by the benchmark scripts. """
+
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_app_modules():
+    """ Make the app's top-level modules (app, models, ...) importable. """
+
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def percentile(sorted_samples, pct):
+    """ Return the pct-th percentile of an already sorted list. """
+
+    if not sorted_samples:
+        return None
+    index = round(pct / 100 * (len(sorted_samples) - 1))
+    return sorted_samples[index]
+
+
+def summarize(latencies, elapsed=None):
+    """ Summarize request latencies (in seconds) as milliseconds, with
+        throughput if the wall-clock elapsed time is given. """
+
+    samples = sorted(latencies)
+    summary = {
+        "count": len(samples),
+        "p50_ms": _ms(percentile(samples, 50)),
+        "p95_ms": _ms(percentile(samples, 95)),
+        "p99_ms": _ms(percentile(samples, 99)),
+        "max_ms": _ms(samples[-1] if samples else None),
+    }
+    if elapsed:
+        summary["per_second"] = round(len(samples) / elapsed, 1)
+    return summary
+
+
+def report(results):
+    """ Print results as JSON, for comparing runs across commits. """
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
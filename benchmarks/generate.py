@@ -0,0 +1,159 @@
+""" Synthetic dataset generator.
+
+Empties the database and fills it with cities, cafes, users and likes,
+generated inside Postgres with generate_series so even large volumes
+load in minutes:
+
+    DATABASE_URL=postgresql:///flask_cafe_bench FLASK_SECRET_KEY=bench \\
+        python benchmarks/generate.py --reset \\
+            --cafes 1000000 --users 100000 --likes 10000000
+
+Cafe names and descriptions are drawn from small word lists, so search
+has something to match, and likes favour a minority of cafes, as real
+likes do. Every user's password is "secret"; users are named user1,
+user2, ... Pair with benchmarks/load.py.
+"""
+
+import argparse
+import os
+import time
+
+from common import use_app_modules, report
+
+use_app_modules()
+
+from app import create_app  # noqa: E402
+from models import db, password_hasher, DEFAULT_USER_IMG_PATH  # noqa: E402
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+
+PASSWORD = "secret"
+WORDS = ("espresso latte mocha roast bean brew cozy quiet sunny corner "
+         "garden harbor mission market bakery pastry tea chai oat vinyl "
+         "study laptop wifi patio dog friendly vegan waffle bagel").split()
+# Roughly the continental US: (south, west, north, east).
+AREA = (24.5, -124.8, 49.4, -66.9)
+
+STEPS = {
+    'cities': """
+        INSERT INTO cities (code, name, state)
+        SELECT 'c' || i, 'City ' || i,
+               chr(65 + i % 26) || chr(65 + i / 26 % 26)
+        FROM generate_series(1, :count) AS i
+    """,
+    # Words are picked from the row number, so reruns match.
+    'cafes': """
+        INSERT INTO cafes (name, description, url, address, city_code,
+                           image_url, version, like_count, updated_at,
+                           latitude, longitude)
+        SELECT initcap(w[1 + i % n] || ' ' || w[1 + (i / n) % n])
+                   || ' ' || i,
+               'A ' || w[1 + (i * 7) % n] || ' ' || w[1 + (i * 13) % n]
+                   || ' place with ' || w[1 + (i * 17) % n] || '.',
+               'https://cafe' || i || '.example.com/',
+               i || ' Main St',
+               'c' || (1 + i % :cities),
+               :image_url, 1, 0, now(),
+               :south + random() * (:north - :south),
+               :west + random() * (:east - :west)
+        FROM generate_series(1, :count) AS i,
+             (SELECT CAST(:words AS text[]) AS w,
+                     cardinality(CAST(:words AS text[])) AS n) AS words
+    """,
+    'users': """
+        INSERT INTO users (username, admin, first_name, last_name, email,
+                           description, image_url, hashed_password)
+        SELECT 'user' || i, false, 'User', 'Number ' || i,
+               'user' || i || '@example.com', '', :user_image, :hash
+        FROM generate_series(1, :count) AS i
+    """,
+    # Cubing a uniform random number skews likes toward low cafe ids.
+    'likes': """
+        INSERT INTO likes (user_id, cafe_id)
+        SELECT 1 + floor(random() * :users)::int,
+               1 + floor(power(random(), 3) * :cafes)::int
+        FROM generate_series(1, :count)
+        ON CONFLICT DO NOTHING
+    """,
+}
+
+RECOUNT_LIKES = """
+    UPDATE cafes SET like_count = counts.n
+    FROM (SELECT cafe_id, count(*) AS n FROM likes GROUP BY cafe_id)
+        AS counts
+    WHERE cafes.id = counts.cafe_id
+"""
+
+
+def run_step(name, sql, **params):
+    """ Run one statement, committing and timing it. Returns seconds. """
+
+    start = time.perf_counter()
+    result = db.session.execute(db.text(sql), params)
+    db.session.commit()
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {result.rowcount} rows in {elapsed:.1f}s", flush=True)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cities', type=int, default=1000)
+    parser.add_argument('--cafes', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--likes', type=int, default=10000000)
+    parser.add_argument('--likes-per-batch', type=int, default=1000000)
+    parser.add_argument('--reset', action='store_true',
+                        help='Empty every table first (required if any '
+                             'cafes exist).')
+    args = parser.parse_args()
+
+    app.app_context().push()
+    db.create_all()
+    if args.reset:
+        db.session.execute(db.text(
+            "TRUNCATE likes, jobs, cafes, users, cities RESTART IDENTITY"))
+        db.session.commit()
+    elif db.session.execute(db.text("SELECT 1 FROM cafes LIMIT 1")).first():
+        parser.error('the database has cafes already; pass --reset')
+
+    timings = {}
+    south, west, north, east = AREA
+    timings['cities'] = run_step(
+        'cities', STEPS['cities'], count=args.cities)
+    timings['cafes'] = run_step(
+        'cafes', STEPS['cafes'], count=args.cafes, cities=args.cities,
+        words=list(WORDS), image_url='/static/images/default-store.png',
+        south=south, west=west, north=north, east=east)
+    timings['users'] = run_step(
+        'users', STEPS['users'], count=args.users,
+        user_image=DEFAULT_USER_IMG_PATH,
+        hash=password_hasher.hash(PASSWORD))
+
+    # Likes go in batches so progress shows; duplicates are dropped, so
+    # slightly fewer than --likes rows result.
+    timings['likes'] = 0
+    for start in range(0, args.likes, args.likes_per_batch):
+        timings['likes'] += run_step(
+            f'likes {start}+', STEPS['likes'],
+            count=min(args.likes_per_batch, args.likes - start),
+            users=args.users, cafes=args.cafes)
+    timings['like_counts'] = run_step('like counts', RECOUNT_LIKES)
+
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        start = time.perf_counter()
+        conn.execute(db.text("VACUUM ANALYZE"))
+        timings['vacuum_analyze'] = time.perf_counter() - start
+
+    counts = {table: db.session.execute(db.text(
+        f"SELECT count(*) FROM {table}")).scalar()
+        for table in ('cities', 'cafes', 'users', 'likes')}
+    report({
+        "counts": counts,
+        "seconds": {k: round(v, 1) for k, v in timings.items()},
+    })
+
+
+if __name__ == '__main__':
+    main()
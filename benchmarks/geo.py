@@ -0,0 +1,125 @@
+""" Nearby-cafe lookup benchmark.
+
+Fills the cafes table with synthetic cafes scattered over the continental
+US (a million by default, generated inside Postgres), then times
+Cafe.near() lookups around random points and reports their latency. The
+target is a p95 under 50ms.
+
+    DATABASE_URL=postgresql:///flask_cafe_bench FLASK_SECRET_KEY=bench \\
+        python benchmarks/geo.py --points 1000000 --queries 500
+
+Run it against a scratch database: it adds rows to the cafes table. They
+are kept between runs (and topped up if --points grows); pass --reset to
+replace them.
+"""
+
+import argparse
+import os
+import random
+import time
+
+from common import use_app_modules, summarize, report
+
+use_app_modules()
+
+from app import create_app  # noqa: E402
+from models import db, Cafe, City  # noqa: E402
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+
+BENCH_CITY = dict(code="geo-bench", name="Geo Bench", state="US")
+# Roughly the continental US: (south, west, north, east).
+AREA = (24.5, -124.8, 49.4, -66.9)
+BUDGET_MS = 50
+
+INSERT_POINTS = db.text("""
+    INSERT INTO cafes (name, description, url, address, city_code,
+                       image_url, version, like_count, updated_at,
+                       latitude, longitude)
+    SELECT 'Geo Bench ' || i, '', '', '', :city_code,
+           '', 1, 0, now(),
+           :south + random() * (:north - :south),
+           :west + random() * (:east - :west)
+    FROM generate_series(:first, :first + :count - 1) AS i
+    ON CONFLICT ON CONSTRAINT uq_cafes_natural_key DO NOTHING
+""")
+
+
+def load_points(count, reset):
+    """ Make sure there are `count` bench cafes. """
+
+    if not db.session.get(City, BENCH_CITY['code']):
+        db.session.add(City(**BENCH_CITY))
+        db.session.commit()
+
+    bench_cafes = Cafe.query.filter_by(city_code=BENCH_CITY['code'])
+    if reset:
+        bench_cafes.delete()
+        db.session.commit()
+
+    existing = bench_cafes.count()
+    missing = count - existing
+    if missing > 0:
+        start = time.perf_counter()
+        south, west, north, east = AREA
+        db.session.execute(INSERT_POINTS, dict(
+            # Names are unique per city; carry on numbering from the rows
+            # an earlier run left.
+            city_code=BENCH_CITY['code'], first=existing + 1, count=missing,
+            south=south, west=west, north=north, east=east))
+        db.session.commit()
+        print(f"Added {missing} cafes in "
+              f"{time.perf_counter() - start:.1f}s")
+
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(db.text("ANALYZE cafes"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--radius', type=float,
+                        default=app.config['NEAR_RADIUS_KM'])
+    parser.add_argument('--limit', type=int,
+                        default=app.config['NEAR_CAFES_LIMIT'])
+    parser.add_argument('--reset', action='store_true')
+    args = parser.parse_args()
+
+    app.app_context().push()
+    db.create_all()
+    load_points(args.points, args.reset)
+
+    south, west, north, east = AREA
+    rng = random.Random(16)
+    latencies, found = [], 0
+    for _ in range(args.queries):
+        lat = rng.uniform(south, north)
+        lng = rng.uniform(west, east)
+        start = time.perf_counter()
+        query, distance = Cafe.near(lat, lng, args.radius)
+        cafes = query.order_by(distance, Cafe.id).limit(args.limit).all()
+        latencies.append(time.perf_counter() - start)
+        found += len(cafes)
+        db.session.expunge_all()
+
+    summary = summarize(latencies)
+    report({
+        "settings": {
+            "points": args.points,
+            "queries": args.queries,
+            "radius_km": args.radius,
+            "limit": args.limit,
+        },
+        "near": {
+            **summary,
+            "mean_found": round(found / args.queries, 1),
+            "budget_ms": BUDGET_MS,
+            "within_budget": summary["p95_ms"] < BUDGET_MS,
+        },
+    })
+
+
+if __name__ == '__main__':
+    main()
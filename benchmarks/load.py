@@ -0,0 +1,257 @@
+""" End-to-end load benchmark.
+
+Runs virtual users against the app over HTTP for a fixed time. Each one
+logs in as a random generated user and then loops over a weighted mix of
+requests: browsing the cafe list (following its "Next" links), opening
+cafes, viewing their profile, and checking, liking and unliking cafes.
+Reports throughput and p50/p95/p99 latency per route as JSON, for
+comparing runs across commits.
+
+Fill a database with benchmarks/generate.py first, then either point it
+at a running server:
+
+    python benchmarks/load.py --base-url http://127.0.0.1:5000
+
+or let it serve the app itself, on a threaded development server:
+
+    DATABASE_URL=postgresql:///flask_cafe_bench FLASK_SECRET_KEY=bench \\
+        python benchmarks/load.py --serve --duration 30 --concurrency 16
+
+--cafes and --users must not be more than generate.py made.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from common import use_app_modules, summarize, report
+
+PASSWORD = "secret"
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+NEXT_CURSOR = re.compile(r'/cafes\?after=([\w-]+)')
+
+# Route name: relative weight in the mix.
+DEFAULT_MIX = {
+    'cafe_list': 25,
+    'cafe_list_next': 10,
+    'cafe_detail': 30,
+    'profile': 10,
+    'api_likes': 10,
+    'api_like': 8,
+    'api_unlike': 7,
+}
+
+
+class VirtualUser:
+    """ One logged-in browser session, making requests from the mix. """
+
+    def __init__(self, base_url, user_id, max_cafe_id, record):
+        self.base_url = base_url
+        self.user_id = user_id
+        self.max_cafe_id = max_cafe_id
+        self.record = record
+        self.session = requests.Session()
+        self.next_cursor = None
+        self.logged_in = False
+
+    def request(self, route, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(
+                method, self.base_url + path, allow_redirects=False,
+                **kwargs)
+        except requests.RequestException:
+            self.record(route, time.perf_counter() - start, False)
+            return None
+        self.record(route, time.perf_counter() - start, resp.status_code < 400)
+        return resp
+
+    def log_in(self, attempts=10):
+        """ Log in, retrying while the server sheds password checks (503).
+        """
+        resp = self.request('login_form', 'GET', '/login')
+        match = CSRF_TOKEN.search(resp.text) if resp is not None else None
+        data = {"username": f"user{self.user_id}", "password": PASSWORD}
+        if match:
+            data["csrf_token"] = match.group(1)
+        for attempt in range(attempts):
+            resp = self.request('login', 'POST', '/login', data=data)
+            if resp is None or resp.status_code != 503:
+                break
+            time.sleep(0.5 * (attempt + 1))
+        self.logged_in = resp is not None and resp.status_code == 302
+
+    def random_cafe(self):
+        return random.randint(1, self.max_cafe_id)
+
+    def cafe_list(self):
+        resp = self.request('cafe_list', 'GET', '/cafes')
+        self.remember_cursor(resp)
+
+    def cafe_list_next(self):
+        if not self.next_cursor:
+            return self.cafe_list()
+        resp = self.request(
+            'cafe_list_next', 'GET', f'/cafes?after={self.next_cursor}')
+        self.remember_cursor(resp)
+
+    def remember_cursor(self, resp):
+        match = NEXT_CURSOR.search(resp.text) if resp is not None else None
+        self.next_cursor = match.group(1) if match else None
+
+    def cafe_detail(self):
+        self.request('cafe_detail', 'GET', f'/cafes/{self.random_cafe()}')
+
+    def profile(self):
+        self.request('profile', 'GET', '/profile')
+
+    def api_likes(self):
+        ids = ','.join(str(self.random_cafe()) for _ in range(12))
+        self.request('api_likes', 'GET', f'/api/likes?cafe_id={ids}')
+
+    def api_like(self):
+        self.request('api_like', 'POST', '/api/like',
+                     json={"cafe_id": self.random_cafe()})
+
+    def api_unlike(self):
+        self.request('api_unlike', 'POST', '/api/unlike',
+                     json={"cafe_id": self.random_cafe()})
+
+
+def parse_mix(text):
+    """ Parse "route=weight,route=weight" into a dict. """
+
+    mix = {}
+    for part in text.split(','):
+        route, weight = part.split('=')
+        if route not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown route {route!r}')
+        mix[route] = int(weight)
+    return mix
+
+
+def run_threads(fn, users):
+    """ Call fn(user) for each user on its own thread, and wait for all. """
+
+    threads = [threading.Thread(target=fn, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def serve_app():
+    """ Start the app on a threaded server on a free local port, and return
+        its base URL. Login throttling is relaxed: every virtual user logs
+        in from the same address. """
+
+    use_app_modules()
+    from werkzeug.serving import make_server
+    from app import create_app, login_throttle
+
+    app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+    app.config.update(LOGIN_IP_BURST=1000000, LOGIN_IP_PER_MINUTE=1000000)
+    login_throttle.init_app(app)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url')
+    parser.add_argument('--serve', action='store_true',
+                        help='Serve the app in this process.')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to run for.')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Virtual users.')
+    parser.add_argument('--cafes', type=int, default=1000000,
+                        help='Pick cafe ids from 1 to this.')
+    parser.add_argument('--users', type=int, default=100000,
+                        help='Log in as user1 to user<this>.')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Weights, e.g. cafe_list=3,cafe_detail=1.')
+    parser.add_argument('--seed', type=int, default=20)
+    parser.add_argument('--output', help='Also write the JSON here.')
+    args = parser.parse_args()
+
+    if args.serve:
+        base_url = serve_app()
+    elif args.base_url:
+        base_url = args.base_url.rstrip('/')
+    else:
+        parser.error('pass --base-url or --serve')
+
+    random.seed(args.seed)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def record(route, seconds, ok):
+        with lock:
+            latencies[route].append(seconds)
+            if not ok:
+                errors[route] += 1
+
+    users = [VirtualUser(base_url, random.randint(1, args.users),
+                         args.cafes, record)
+             for _ in range(args.concurrency)]
+    # Log everyone in before the clock starts: hashing passwords is slow
+    # on purpose, and would swamp the mix.
+    run_threads(lambda user: user.log_in(), users)
+    logins = {route: {**summarize(latencies.pop(route, [])),
+                      "errors": errors.pop(route, 0)}
+              for route in ('login_form', 'login')}
+
+    routes, weights = zip(*args.mix.items())
+    start = time.perf_counter()
+    deadline = start + args.duration
+
+    def run(user):
+        while user.logged_in and time.perf_counter() < deadline:
+            getattr(user, random.choices(routes, weights)[0])()
+
+    run_threads(run, users)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "settings": {
+            "base_url": base_url,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "cafes": args.cafes,
+            "users": args.users,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "total": {
+            **summarize(
+                [s for samples in latencies.values() for s in samples],
+                elapsed),
+            "errors": sum(errors.values()),
+        },
+        "routes": {
+            route: {**summarize(samples, elapsed), "errors": errors[route]}
+            for route, samples in sorted(latencies.items())
+        },
+        "logins": logins,
+    }
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+""" Login throughput benchmark.
+
+Fires concurrent logins at /login while a prober keeps loading the
+homepage, and reports latency for both. Shows how the bounded bcrypt pool
+keeps cheap pages responsive, and how many logins it sheds with a 503.
+
+    DATABASE_URL=postgresql:///flask_cafe_bench FLASK_SECRET_KEY=bench \\
+        python benchmarks/login_throughput.py --logins 200 --concurrency 32
+
+Try --workers and --max-queue to see the effect of the pool size.
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import use_app_modules, summarize, report
+
+use_app_modules()
+
+from app import create_app, login_throttle  # noqa: E402
+from models import db, User, password_hasher  # noqa: E402
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+
+BENCH_USER = dict(
+    username="bench-login",
+    first_name="Bench",
+    last_name="Login",
+    description="Login benchmark user.",
+    email="bench-login@test.com",
+    password="secret",
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int,
+                        default=app.config['BCRYPT_WORKERS'])
+    parser.add_argument('--max-queue', type=int,
+                        default=app.config['BCRYPT_MAX_QUEUE'])
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.app_context().push()
+    app.config['BCRYPT_WORKERS'] = args.workers
+    app.config['BCRYPT_MAX_QUEUE'] = args.max_queue
+    password_hasher.init_app(app)
+    # Every login here is one user from one address; measure the hashing
+    # pool, not the login throttle.
+    app.config.update(LOGIN_USERNAME_BURST=args.logins,
+                      LOGIN_IP_BURST=args.logins)
+    login_throttle.init_app(app)
+
+    db.create_all()
+    if not User.query.filter_by(username=BENCH_USER['username']).first():
+        User.register(**BENCH_USER)
+
+    login_times, statuses = [], []
+    page_times = []
+    done = threading.Event()
+
+    def log_in(_):
+        with app.test_client() as client:
+            start = time.perf_counter()
+            resp = client.post('/login', data={
+                "username": BENCH_USER['username'], "password": "secret"})
+            login_times.append(time.perf_counter() - start)
+            statuses.append(resp.status_code)
+
+    def probe_homepage():
+        with app.test_client() as client:
+            while not done.is_set():
+                start = time.perf_counter()
+                client.get('/')
+                page_times.append(time.perf_counter() - start)
+                time.sleep(0.005)
+
+    prober = threading.Thread(target=probe_homepage)
+    prober.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(log_in, range(args.logins)))
+    elapsed = time.perf_counter() - start
+
+    done.set()
+    prober.join()
+
+    report({
+        "settings": {
+            "logins": args.logins,
+            "concurrency": args.concurrency,
+            "bcrypt_workers": args.workers,
+            "bcrypt_max_queue": args.max_queue,
+            "bcrypt_rounds": password_hasher.rounds,
+        },
+        "login": {
+            **summarize(login_times, elapsed),
+            "succeeded": statuses.count(302),
+            "shed": statuses.count(503),
+        },
+        "homepage_during_logins": summarize(page_times),
+    })
+
+
+if __name__ == '__main__':
+    main()
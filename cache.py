@@ -0,0 +1,123 @@
+""" In-process caches for Flask Cafe. """
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+class LRUCache:
+    """ A thread-safe, size-bounded, least-recently-used cache.
+
+        Entries optionally expire `ttl` seconds after they're set. Keeps
+        hit/miss counters so the size can be tuned. For a cache per Flask
+        app, see AppCache.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the cached value for key (and mark it recently used), or
+            default if it isn't cached. """
+
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            expires, value = self._data[key]
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """ Cache value under key, evicting the least recently used entries
+            if the cache is full. """
+
+        expires = time.monotonic() + self.ttl if self.ttl is not None \
+            else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """ Drop key from the cache if it's there. """
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Empty the cache and reset the counters. """
+
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Return the counters as a dictionary. """
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+
+class AppCache:
+    """ An LRUCache per Flask app, set up like a Flask extension.
+
+        init_app(app) gives the app its own cache, sized by
+        <config_prefix>_SIZE and <config_prefix>_TTL from app.config, in
+        app.extensions. The methods use the current app's cache; for_app()
+        returns an app's cache outside of an app context.
+    """
+
+    def __init__(self, config_prefix):
+        self.config_prefix = config_prefix
+        self.name = config_prefix.lower()
+
+    def init_app(self, app):
+        """ Give the app a cache sized from app.config. """
+
+        config = app.config
+        app.extensions[self.name] = LRUCache(
+            config[f'{self.config_prefix}_SIZE'],
+            config[f'{self.config_prefix}_TTL'])
+
+    def for_app(self, app=None):
+        """ Return the app's LRUCache (by default, the current app's). """
+
+        return (app or current_app).extensions[self.name]
+
+    def get(self, key, default=None):
+        return self.for_app().get(key, default)
+
+    def set(self, key, value):
+        self.for_app().set(key, value)
+
+    def delete(self, key):
+        self.for_app().delete(key)
+
+    def clear(self):
+        self.for_app().clear()
+
+    def stats(self):
+        return self.for_app().stats()
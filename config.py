@@ -0,0 +1,130 @@
+"""Configuration profiles for Flask Cafe.
+
+Pick one with create_app(config_name) or the FLASK_CONFIG environment
+variable: "development" (the default), "testing" or "production".
+"""
+
+import os
+
+
+def env_int(name, default):
+    """ Return an integer setting from the environment. """
+
+    return int(os.environ.get(name, default))
+
+
+def env_bool(name, default):
+    """ Return a true/false setting from the environment. """
+
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+def env_list(name):
+    """ Return a comma-separated list setting from the environment. """
+
+    return [v.strip() for v in os.environ.get(name, '').split(',')
+            if v.strip()]
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "DATABASE_URL", 'postgresql:///flask_cafe')
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "shhhh")
+    SQLALCHEMY_ECHO = False
+    DEBUG_TB_ENABLED = False
+
+    # Connection pool; see pool.engine_options().
+    DB_POOL_SIZE = env_int("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW = env_int("DB_MAX_OVERFLOW", 10)
+    DB_POOL_TIMEOUT = env_int("DB_POOL_TIMEOUT", 30)
+    DB_POOL_RECYCLE = env_int("DB_POOL_RECYCLE", 1800)
+    DB_POOL_PRE_PING = env_bool("DB_POOL_PRE_PING", True)
+    # Set when a transaction-level pooler (e.g. PgBouncer) fronts Postgres.
+    DB_POOLER_MODE = env_bool("DB_POOLER_MODE", False)
+    # Read replicas, by URL; see replicas.ReplicaRouter.
+    DATABASE_REPLICA_URLS = env_list("DATABASE_REPLICA_URLS")
+    REPLICA_STICKY_SECONDS = env_int("REPLICA_STICKY_SECONDS", 10)
+
+    BCRYPT_LOG_ROUNDS = env_int("BCRYPT_LOG_ROUNDS", 12)
+    BCRYPT_WORKERS = env_int("BCRYPT_WORKERS", os.cpu_count() or 1)
+    BCRYPT_MAX_QUEUE = env_int("BCRYPT_MAX_QUEUE", BCRYPT_WORKERS * 4)
+
+    # How many reverse proxies (load balancers) sit in front of the app and
+    # add X-Forwarded-For; 0 trusts none and uses the peer address.
+    TRUSTED_PROXY_COUNT = env_int("TRUSTED_PROXY_COUNT", 0)
+
+    # Per username from one IP.
+    LOGIN_USERNAME_BURST = 5
+    LOGIN_USERNAME_PER_MINUTE = 5
+    LOGIN_IP_BURST = 20
+    LOGIN_IP_PER_MINUTE = 20
+    LOGIN_FAILURE_CACHE_TTL = 300
+    # Username/IP pairs and IPs tracked by the login throttle, each.
+    LOGIN_THROTTLE_MAX_KEYS = env_int("LOGIN_THROTTLE_MAX_KEYS", 100000)
+
+    CAFES_PER_PAGE = env_int("CAFES_PER_PAGE", 24)
+    POPULAR_CAFES_LIMIT = env_int("POPULAR_CAFES_LIMIT", 10)
+    NEAR_CAFES_LIMIT = env_int("NEAR_CAFES_LIMIT", 20)
+    NEAR_RADIUS_KM = env_int("NEAR_RADIUS_KM", 5)
+    NEAR_MAX_RADIUS_KM = env_int("NEAR_MAX_RADIUS_KM", 100)
+    API_MAX_PAGE_SIZE = env_int("API_MAX_PAGE_SIZE", 100)
+    # In-process caches, per worker. TTLs are seconds; None never expires
+    # (fragments are keyed on the cafe's version, so they needn't).
+    FRAGMENT_CACHE_SIZE = env_int("FRAGMENT_CACHE_SIZE", 2048)
+    FRAGMENT_CACHE_TTL = None
+    # Navbar fields of recently seen users; see models.CurrentUser.
+    USER_SUMMARY_CACHE_SIZE = env_int("USER_SUMMARY_CACHE_SIZE", 4096)
+    USER_SUMMARY_CACHE_TTL = 60
+    # Cities and other form dropdowns; see support.set_dropdown_choices.
+    DROPDOWN_CHOICES_TTL = 300
+
+    # Uploaded images; the folder defaults to instance/uploads.
+    UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER")
+    MAX_CONTENT_LENGTH = env_int("MAX_UPLOAD_BYTES", 8 * 1024 * 1024)
+
+    # Background jobs; see jobs.JobQueue.
+    JOB_POLL_INTERVAL = 1.0
+    JOB_VISIBILITY_TIMEOUT = env_int("JOB_VISIBILITY_TIMEOUT", 300)
+    JOB_MAX_ATTEMPTS = env_int("JOB_MAX_ATTEMPTS", 5)
+    JOB_BACKOFF_BASE = 5
+    JOB_BACKOFF_MAX = 3600
+    # Threads for the Flask views when served by asgi.py.
+    WSGI_THREADS = env_int("WSGI_THREADS", 16)
+
+    # Change on deploy when templates change, so browsers drop old pages.
+    ETAG_SALT = os.environ.get("ETAG_SALT", "")
+
+
+class DevelopmentConfig(Config):
+    """Local development: log SQL and show the debug toolbar."""
+
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+    # DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+
+class TestingConfig(Config):
+    """The test suite: its own database, cheap hashing, no CSRF."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "TEST_DATABASE_URL", 'postgresql:///flaskcafe_test')
+    DATABASE_REPLICA_URLS = []
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+
+
+class ProductionConfig(Config):
+    """Production: no SQL echo, no toolbar, and a real secret key."""
+
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY")
+
+
+configs = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
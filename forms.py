@@ -1,8 +1,11 @@
 """Forms for Flask Cafe."""
 
 from flask_wtf import FlaskForm
-from wtforms import (StringField, TextAreaField, SelectField, PasswordField)
-from wtforms.validators import (InputRequired, Optional, Length, URL, Email)
+from flask_wtf.file import FileField, FileAllowed
+from wtforms import (StringField, TextAreaField, SelectField, PasswordField,
+                     FloatField)
+from wtforms.validators import (InputRequired, Optional, Length, URL, Email,
+                                NumberRange)
 # TODO: import email_validator
 
 
@@ -27,10 +30,22 @@ class CafeForm(FlaskForm):
         "City",
         validators=[InputRequired()])
 
+    latitude = FloatField(
+        "Latitude",
+        validators=[Optional(), NumberRange(min=-90, max=90)])
+
+    longitude = FloatField(
+        "Longitude",
+        validators=[Optional(), NumberRange(min=-180, max=180)])
+
     image_url = StringField(
         "Photo",
         validators=[URL(), Optional()])
 
+    image_file = FileField(
+        "Or upload a photo",
+        validators=[FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'])])
+
 
 class SignupForm(FlaskForm):
     """ Form for adding and editing users """
@@ -83,6 +98,10 @@ class ProfileEditForm(FlaskForm):
         "Photo",
         validators=[URL(), Optional()])
 
+    image_file = FileField(
+        "Or upload a photo",
+        validators=[FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'])])
+
 
 class LoginForm(FlaskForm):
     """ Form for logging in """
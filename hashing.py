@@ -0,0 +1,138 @@
+""" Password hashing off the request thread, for Flask Cafe. """
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+
+class HasherBusy(Exception):
+    """ Raised when too many password hashes are already waiting. """
+
+
+class PasswordHasher:
+    """ Runs bcrypt work in a small, bounded pool of worker threads.
+
+        bcrypt releases the GIL while it hashes, so a few workers keep the
+        CPU busy without letting a burst of logins occupy every request
+        thread. At most BCRYPT_WORKERS hashes run at once and at most
+        BCRYPT_MAX_QUEUE more wait; past that, calls raise HasherBusy
+        instead of queueing. The work factor is flask-bcrypt's
+        BCRYPT_LOG_ROUNDS. Each app gets its own pool (see HasherPool);
+        the methods use the current app's.
+    """
+
+    def __init__(self, bcrypt):
+        self.bcrypt = bcrypt
+
+    def init_app(self, app):
+        """ Give the app its own pool, sized from app.config. """
+
+        self.bcrypt.init_app(app)
+        old = app.extensions.get('password_hasher')
+        if old:
+            old.shutdown()
+        workers = app.config.get('BCRYPT_WORKERS', os.cpu_count() or 1)
+        app.extensions['password_hasher'] = HasherPool(
+            rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            workers=workers,
+            max_queue=app.config.get('BCRYPT_MAX_QUEUE', workers * 4))
+
+    @property
+    def pool(self):
+        """ The current app's HasherPool. """
+
+        return current_app.extensions['password_hasher']
+
+    @property
+    def rounds(self):
+        """ The current app's bcrypt work factor. """
+
+        return self.pool.rounds
+
+    def shutdown(self):
+        """ Stop the current app's worker threads; they restart on the next
+            hash. """
+
+        self.pool.shutdown()
+
+    def hash(self, password):
+        """ Return a bcrypt hash of password, at the configured cost. """
+
+        return self._run(
+            self.bcrypt.generate_password_hash, password, self.rounds
+        ).decode('utf8')
+
+    def check(self, hashed, password):
+        """ Return whether password matches the bcrypt hash. """
+
+        return self._run(self.bcrypt.check_password_hash, hashed, password)
+
+    def check_dummy(self, password):
+        """ Do the same work as check() against a hash nothing matches, so
+            that failing for an unknown user costs as much as failing for a
+            known one. Always returns False. """
+
+        pool = self.pool
+        if pool.dummy_hash is None or self.needs_rehash(pool.dummy_hash):
+            pool.dummy_hash = self.hash(os.urandom(16).hex())
+        self.check(pool.dummy_hash, password)
+        return False
+
+    def needs_rehash(self, hashed):
+        """ Return whether hashed was made at a different cost than the one
+            configured now. Hashes look like $2b$<cost>$<salt+hash>. """
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, fn, *args):
+        return self.pool.run(fn, *args)
+
+
+class HasherPool:
+    """ One app's PasswordHasher settings and worker threads, kept in
+        app.extensions['password_hasher']. """
+
+    def __init__(self, rounds, workers, max_queue):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        self.dummy_hash = None
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def shutdown(self):
+        """ Stop the worker threads; they restart on the next run. """
+
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+            self._executor = None
+            self._slots = None
+
+    def run(self, fn, *args):
+        """ Run fn(*args) on a worker and return its result. Raises
+            HasherBusy if every worker and queue slot is taken. """
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='bcrypt')
+                self._slots = threading.BoundedSemaphore(
+                    self.workers + self.max_queue)
+            executor, slots = self._executor, self._slots
+
+        if not slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        return future.result()
@@ -0,0 +1,155 @@
+""" Uploaded images and their resized variants, for Flask Cafe. """
+
+import os
+import shutil
+import uuid
+
+from flask import current_app
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from jobs import job_queue, enqueue_after_commit
+from models import db, Cafe, User, utcnow
+
+# Widths to make of each variant, smallest first. Pick the variant by where
+# the image is shown; browsers pick the width from the srcset.
+VARIANTS = {
+    'card': (300, 600),
+    'detail': (400, 800),
+    'avatar': (200, 400),
+}
+UPLOAD_FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif',
+                  'WEBP': '.webp'}
+# Models with image_url and image_variants columns.
+IMAGE_OWNERS = {'Cafe': Cafe, 'User': User}
+
+
+class BadImage(ValueError):
+    """ Raised for an upload that isn't an image we accept. """
+
+
+class ImageStore:
+    """ Keeps uploaded images on local disk and resizes them off the
+        request thread.
+
+        save() stores the original under UPLOAD_FOLDER and returns its URL
+        right away. make_variants_later() queues a background job that
+        builds a WebP of each width of each variant, and when they're done
+        records them in the owner's image_variants and bumps its version,
+        so cached pages pick them up. Each app keeps its own upload folder
+        in app.extensions['image_store']; the methods use the current
+        app's.
+    """
+
+    def __init__(self):
+        self.url_path = '/uploads'
+
+    def init_app(self, app):
+        """ Read the upload folder from app.config. """
+
+        app.extensions['image_store'] = app.config.get(
+            'UPLOAD_FOLDER') or os.path.join(app.instance_path, 'uploads')
+
+    @property
+    def folder(self):
+        """ The current app's upload folder. """
+
+        return current_app.extensions['image_store']
+
+    def save(self, upload):
+        """ Store an uploaded file (a werkzeug FileStorage) and return the
+            URL of the original. Raises BadImage if it isn't a JPEG, PNG,
+            GIF or WebP image. """
+
+        try:
+            with Image.open(upload.stream) as image:
+                image_format = image.format
+                image.verify()
+        except (UnidentifiedImageError, OSError, SyntaxError,
+                Image.DecompressionBombError):
+            raise BadImage('Not a readable image.')
+        if image_format not in UPLOAD_FORMATS:
+            raise BadImage('Upload a JPEG, PNG, GIF or WebP image.')
+
+        key = uuid.uuid4().hex
+        name = 'original' + UPLOAD_FORMATS[image_format]
+        folder = self.folder
+        os.makedirs(os.path.join(folder, key))
+        upload.stream.seek(0)
+        upload.save(os.path.join(folder, key, name))
+        return f'{self.url_path}/{key}/{name}'
+
+    def delete(self, url):
+        """ Remove the upload at url, and any variants made of it. For an
+            upload whose owner was never saved. """
+
+        shutil.rmtree(os.path.dirname(self.path_for(url)), ignore_errors=True)
+
+    def is_upload(self, url):
+        """ Return whether url is one that save() returned. """
+
+        return bool(url) and url.startswith(self.url_path + '/')
+
+    def path_for(self, url):
+        """ Return the file path for an upload URL. """
+
+        parts = url[len(self.url_path):].split('/')
+        return os.path.join(self.folder, *parts)
+
+    def make_variants_later(self, obj, *variants):
+        """ Queue a job to make `variants` of obj.image_url, which must be
+            an upload, when the current transaction commits. obj is a Cafe
+            or User with an id (flush it first if it's new). """
+
+        return enqueue_after_commit(
+            'make_image_variants', model=type(obj).__name__, id=obj.id,
+            url=obj.image_url, variants=list(variants))
+
+    def make_variants(self, url, variants):
+        """ Write each width of each variant of the upload at url. Returns
+            {variant: [[width, height, url], ...]}. """
+
+        made = {}
+        base_url = url.rsplit('/', 1)[0]
+        with Image.open(self.path_for(url)) as original:
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+
+            for variant in variants:
+                made[variant] = []
+                for width in VARIANTS[variant]:
+                    # Never scale up; a small image is its own variant.
+                    width = min(width, image.width)
+                    height = round(image.height * width / image.width)
+                    name = f'{variant}-{width}.webp'
+                    resized = image.resize((width, height),
+                                           Image.Resampling.LANCZOS)
+                    resized.save(os.path.join(self.path_for(base_url), name),
+                                 'WEBP', quality=80, method=4)
+                    made[variant].append([width, height,
+                                          f'{base_url}/{name}'])
+                    if width == image.width:
+                        break
+        return made
+
+
+image_store = ImageStore()
+
+
+@job_queue.handler('make_image_variants')
+def make_image_variants(model, id, url, variants):
+    """ Make the variants of an upload, and record them on its owner. """
+
+    made = image_store.make_variants(url, variants)
+
+    model = IMAGE_OWNERS[model]
+    values = {model.image_variants: made}
+    if hasattr(model, 'version'):
+        # Cafes key cached fragments and ETags by version.
+        values.update({model.version: model.version + 1,
+                       model.updated_at: utcnow()})
+    # Skip it if the image changed again while the job waited.
+    (model.query
+     .filter(model.id == id, model.image_url == url)
+     .update(values, synchronize_session=False))
+    db.session.commit()
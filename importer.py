@@ -0,0 +1,222 @@
+""" Bulk imports of cities and cafes, for Flask Cafe. """
+
+import csv
+import json
+import time
+
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.datastructures import MultiDict
+
+from forms import CafeForm
+from models import db, City, Cafe, DEFAULT_CAFE_IMG_PATH, utcnow
+from support import set_dropdown_choices
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class ImportStats:
+    """ Running counts for an import. """
+
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.rejected = 0
+        self.started = time.perf_counter()
+
+    def rate(self):
+        """ Rows read per second so far. """
+
+        elapsed = time.perf_counter() - self.started
+        return self.read / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return (f'{self.read} read, {self.inserted} inserted, '
+                f'{self.updated} updated, {self.unchanged} unchanged, '
+                f'{self.rejected} rejected ({self.rate():.0f} rows/s)')
+
+
+def read_records(lines, fmt):
+    """ Yield (line number, record dict) from an iterable of lines of CSV
+        (with a header row) or JSONL. A JSONL line that isn't a JSON object
+        yields (line number, None). """
+
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_num, record if isinstance(record, dict) else None
+
+
+def validate_city(record):
+    """ Return (values, errors) for a city record. """
+
+    values = {k: str(record.get(k) or '').strip()
+              for k in ('code', 'name', 'state')}
+    errors = {k: ['This field is required.'] for k, v in values.items()
+              if not v}
+    return (None, errors) if errors else (values, None)
+
+
+def validate_cafe(record, form):
+    """ Return (values, errors) for a cafe record, checked by the same
+        rules as the add-cafe form. form is a CafeForm (without CSRF) to
+        reuse; building a new one per row would cost more than the insert.
+    """
+    form.process(MultiDict({k: str(v) for k, v in record.items()
+                            if v is not None}))
+    if not form.validate():
+        return None, form.errors
+
+    return dict(
+        name=form.name.data,
+        description=form.description.data or '',
+        url=form.url.data or '',
+        address=form.address.data,
+        city_code=form.city_code.data,
+        latitude=form.latitude.data,
+        longitude=form.longitude.data,
+        image_url=form.image_url.data or DEFAULT_CAFE_IMG_PATH,
+    ), None
+
+
+def upsert_cities(rows):
+    """ Insert or update a batch of cities by code. A renamed city's cafes
+        get a new version, since their cards and pages show the city name.
+        Returns the number (inserted, updated). """
+
+    stmt = insert(City)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[City.code],
+        set_={'name': stmt.excluded.name, 'state': stmt.excluded.state},
+        where=db.tuple_(City.name, City.state).is_distinct_from(
+            db.tuple_(stmt.excluded.name, stmt.excluded.state)))
+    return _run_upsert(stmt.returning(City.code), rows,
+                       on_updated=_bump_city_cafes)
+
+
+def _bump_city_cafes(connection, updated):
+    codes = [row.code for row in updated]
+    connection.execute(
+        db.update(Cafe)
+        .where(Cafe.city_code.in_(codes))
+        .values(version=Cafe.version + 1, updated_at=utcnow()))
+
+
+CAFE_UPSERT_COLUMNS = ('description', 'url', 'latitude', 'longitude',
+                       'image_url')
+
+
+def upsert_cafes(rows):
+    """ Insert or update a batch of cafes by (name, address, city_code).
+        A changed cafe gets a new version, like an edit. Returns the number
+        (inserted, updated). """
+
+    stmt = insert(Cafe)
+    current = [getattr(Cafe, c) for c in CAFE_UPSERT_COLUMNS]
+    incoming = [stmt.excluded[c] for c in CAFE_UPSERT_COLUMNS]
+    stmt = stmt.on_conflict_do_update(
+        constraint='uq_cafes_natural_key',
+        set_={**dict(zip(CAFE_UPSERT_COLUMNS, incoming)),
+              'version': Cafe.version + 1,
+              'updated_at': utcnow()},
+        where=db.tuple_(*current).is_distinct_from(db.tuple_(*incoming)))
+    return _run_upsert(stmt, rows)
+
+
+def _run_upsert(stmt, rows, on_updated=None):
+    # xmax is 0 for a row this statement inserted; rows left unchanged by
+    # the WHERE aren't returned at all. Executing one statement for many
+    # rows lets SQLAlchemy send them as multi-row VALUES pages ("insertmany
+    # values") from a single cached compilation. on_updated(connection,
+    # updated rows) runs in the same transaction, if any row was updated.
+    stmt = stmt.returning(db.literal_column('xmax = 0').label('inserted'))
+    connection = db.session.connection()
+    inserted = 0
+    updated = []
+    for row in connection.execute(stmt, rows):
+        if row.inserted:
+            inserted += 1
+        else:
+            updated.append(row)
+    if updated and on_updated is not None:
+        on_updated(connection, updated)
+    db.session.commit()
+    return inserted, len(updated)
+
+
+def import_records(records, validate, upsert, key, batch_size=None,
+                   on_reject=None, on_batch=None):
+    """ Validate records and upsert them in batches of batch_size rows.
+
+        records yields (line number, record); validate(record) returns
+        (values, errors); upsert(rows) writes a batch and returns (inserted,
+        updated). key(values) is the natural key; within a batch, the last
+        record for a key wins. on_reject(line number, record, errors) and
+        on_batch(stats) are called as the import goes. Only one batch is
+        held in memory at a time. Returns the ImportStats.
+    """
+    batch_size = batch_size or DEFAULT_BATCH_SIZE
+    stats = ImportStats()
+    batch = {}
+
+    def flush():
+        inserted, updated = upsert(list(batch.values()))
+        stats.inserted += inserted
+        stats.updated += updated
+        stats.unchanged += len(batch) - inserted - updated
+        batch.clear()
+        if on_batch:
+            on_batch(stats)
+
+    for line_num, record in records:
+        stats.read += 1
+        if record is None:
+            values, errors = None, {'line': ['Not a JSON object.']}
+        else:
+            values, errors = validate(record)
+        if errors:
+            stats.rejected += 1
+            if on_reject:
+                on_reject(line_num, record, errors)
+            continue
+
+        if key(values) in batch:
+            stats.unchanged += 1  # superseded by a later line
+        batch[key(values)] = values
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+    return stats
+
+
+def import_cities(records, **kwargs):
+    """ Import city records; see import_records for the arguments. """
+
+    return import_records(
+        records, validate_city, upsert_cities,
+        key=lambda values: values['code'], **kwargs)
+
+
+def import_cafes(records, **kwargs):
+    """ Import cafe records; see import_records for the arguments. Each
+        cafe's city must exist already. """
+
+    form = CafeForm(formdata=None, meta={'csrf': False})
+    form.city_code.choices = set_dropdown_choices(City, 'code', 'name')
+    return import_records(
+        records, lambda record: validate_cafe(record, form),
+        upsert_cafes,
+        key=lambda v: (v['name'], v['address'], v['city_code']), **kwargs)
@@ -0,0 +1,201 @@
+""" A job queue kept in Postgres, for work that can wait until after the
+response. """
+
+import random
+import threading
+import traceback
+from datetime import timedelta
+
+from flask import current_app
+
+from models import db, Job, utcnow
+
+
+class JobQueue:
+    """ Runs registered handlers for rows of the jobs table.
+
+        Views queue jobs with enqueue_after_commit(), so a job commits or
+        rolls back with the rest of the request's writes. Workers (`flask
+        worker`) claim ready jobs with SELECT ... FOR UPDATE SKIP LOCKED, so
+        any number of them can share the table without handing out a job
+        twice. A claimed job is leased for JOB_VISIBILITY_TIMEOUT seconds;
+        if its worker dies, it is run again after that. A job that raises
+        is retried with exponential backoff, and after its max_attempts it
+        is left in the "dead" state with its last error for a person to
+        look at. Handlers are shared; each app keeps its own settings (see
+        QueueSettings), and the methods use the current app's.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def init_app(self, app):
+        """ Give the app its own queue settings, read from app.config. """
+
+        app.extensions['job_queue'] = QueueSettings(app.config)
+
+    @property
+    def settings(self):
+        """ The current app's QueueSettings. """
+
+        return current_app.extensions['job_queue']
+
+    def handler(self, name):
+        """ Decorator: run the function for jobs called `name`. It gets the
+            job's arguments as keyword arguments, inside an app context. """
+
+        def register(fn):
+            self.handlers[name] = fn
+            return fn
+        return register
+
+    def enqueue(self, name, run_at=None, max_attempts=None, **kwargs):
+        """ Add a job to the current session, and return it. kwargs must
+            be JSON-serializable. """
+
+        if name not in self.handlers:
+            raise LookupError(f'No handler for job {name!r}')
+        job = Job(name=name, args=kwargs, run_at=run_at or utcnow(),
+                  max_attempts=max_attempts or self.settings.max_attempts)
+        db.session.add(job)
+        return job
+
+    def claim(self):
+        """ Lease the oldest ready job, or return None if there isn't one.
+            Commits. """
+
+        while True:
+            now = utcnow()
+            job = (Job.query
+                   .filter(db.or_(
+                       db.and_(Job.state == 'queued', Job.run_at <= now),
+                       db.and_(Job.state == 'running',
+                               Job.locked_until <= now)))
+                   .order_by(Job.run_at)
+                   .with_for_update(skip_locked=True)
+                   .limit(1)
+                   .first())
+            if job is None:
+                db.session.rollback()
+                return None
+
+            if job.state == 'running' and job.attempts >= job.max_attempts:
+                # Its last worker died or hung; don't try it again.
+                job.state = 'dead'
+                job.locked_until = None
+                job.last_error = 'Lease expired on the last attempt.'
+                db.session.commit()
+                continue
+
+            job.state = 'running'
+            job.attempts += 1
+            job.locked_until = now + timedelta(
+                seconds=self.settings.visibility_timeout)
+            db.session.commit()
+            return job
+
+    def run(self, job):
+        """ Run a claimed job: delete it if it succeeds, otherwise schedule
+            a retry or mark it dead. Returns whether it succeeded. """
+
+        job_id, attempts = job.id, job.attempts
+        name, args, max_attempts = job.name, job.args, job.max_attempts
+        try:
+            handler = self.handlers.get(name)
+            if handler is None:
+                raise LookupError(f'No handler for job {name!r}')
+            handler(**args)
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception('Job %s (%s) failed', job_id, name)
+            error = traceback.format_exc()
+            if attempts >= max_attempts:
+                values = {'state': 'dead'}
+            else:
+                values = {'state': 'queued',
+                          'run_at': utcnow() + self.backoff(attempts)}
+            Job.query.filter_by(id=job_id).update(
+                {**values, 'locked_until': None, 'last_error': error})
+            db.session.commit()
+            return False
+
+        Job.query.filter_by(id=job_id).delete()
+        db.session.commit()
+        return True
+
+    def stats(self):
+        """ Return the number of jobs in each state. """
+
+        counts = dict(db.session.query(Job.state, db.func.count())
+                      .group_by(Job.state))
+        return {state: counts.get(state, 0)
+                for state in ('queued', 'running', 'dead')}
+
+    def backoff(self, attempts):
+        """ Return how long to wait before retrying after `attempts`
+            failures: doubling each time, with jitter, up to a cap. """
+
+        settings = self.settings
+        delay = min(settings.backoff_max,
+                    settings.backoff_base * 2 ** (attempts - 1))
+        return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+    def work(self, app, threads=1, burst=False, stop=None):
+        """ Claim and run jobs on `threads` threads until `stop` (an Event)
+            is set, or, with burst, until no job is ready. Returns how many
+            jobs ran. """
+
+        stop = stop or threading.Event()
+        poll_interval = app.extensions['job_queue'].poll_interval
+        counts = []
+
+        def loop():
+            ran = 0
+            while not stop.is_set():
+                with app.app_context():
+                    job = self.claim()
+                    if job is not None:
+                        self.run(job)
+                        ran += 1
+                        continue
+                if burst:
+                    break
+                stop.wait(poll_interval)
+            counts.append(ran)
+
+        workers = [threading.Thread(target=loop, name=f'worker-{i}')
+                   for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(0.5)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        return sum(counts)
+
+
+class QueueSettings:
+    """ One app's JobQueue settings, kept in app.extensions['job_queue'].
+    """
+
+    def __init__(self, config):
+        self.poll_interval = config.get('JOB_POLL_INTERVAL', 1.0)
+        self.visibility_timeout = config.get('JOB_VISIBILITY_TIMEOUT', 300)
+        self.max_attempts = config.get('JOB_MAX_ATTEMPTS', 5)
+        self.backoff_base = config.get('JOB_BACKOFF_BASE', 5)
+        self.backoff_max = config.get('JOB_BACKOFF_MAX', 3600)
+
+
+job_queue = JobQueue()
+
+
+def enqueue_after_commit(name, **kwargs):
+    """ Queue a job to run in the background once the current transaction
+        commits; if it rolls back, so does the job. See JobQueue.enqueue.
+    """
+
+    return job_queue.enqueue(name, **kwargs)
@@ -0,0 +1,237 @@
+""" Per-route request metrics in Prometheus text format, for Flask Cafe. """
+
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from flask import request
+from sqlalchemy import event
+
+# Upper bounds of the histogram buckets; +Inf is implied.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+SQL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Series:
+    """ Counts for one (endpoint, method). Buckets hold non-cumulative
+        counts; rendering adds them up. """
+
+    __slots__ = ('seconds', 'latency', 'sql_statements',
+                 'sql_seconds', 'sql_counts', 'errors')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.sql_counts = [0] * (len(SQL_COUNT_BUCKETS) + 1)
+        self.errors = 0
+
+    def add(self, other):
+        self.seconds += other.seconds
+        self.sql_statements += other.sql_statements
+        self.sql_seconds += other.sql_seconds
+        self.errors += other.errors
+        for i, n in enumerate(other.latency):
+            self.latency[i] += n
+        for i, n in enumerate(other.sql_counts):
+            self.sql_counts[i] += n
+
+
+class RequestMetrics:
+    """ Records each request's latency, SQL statement count and SQL time,
+        per endpoint and method, and renders them for a Prometheus scrape.
+
+        Recording takes no locks: every thread counts into its own shard of
+        series, and only a scrape takes the lock, to add the shards up. A
+        request's running counts live in thread-local attributes, so the
+        hot path allocates nothing once a thread has seen an endpoint.
+        When a thread ends, its shard is folded into a retired shard, so
+        one-thread-per-request servers don't pile them up.
+
+        SQL is counted from the engines' cursor events, between the start
+        of a request and its after_request hooks; statements a streamed
+        response body runs are not included.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = {}
+        self._retired = {}
+
+    def init_app(self, app):
+        """ Add the request hooks, and listen to the app's engines. Call
+            after connect_db(app). """
+
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        with app.app_context():
+            engines = list(app.extensions['sqlalchemy'].engines.values())
+        for engine in engines:
+            if not event.contains(engine, 'before_cursor_execute',
+                                  self._before_cursor_execute):
+                event.listen(engine, 'before_cursor_execute',
+                             self._before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute',
+                             self._after_cursor_execute)
+
+    def reset(self):
+        """ Zero every counter. """
+
+        with self._lock:
+            for shard in self._shards.values():
+                shard.clear()
+            self._retired.clear()
+
+    def _start_request(self):
+        local = self._local
+        local.sql_statements = 0
+        local.sql_seconds = 0.0
+        local.in_request = True
+        local.started = time.perf_counter()
+
+    def _end_request(self, response):
+        local = self._local
+        if not getattr(local, 'in_request', False):
+            return response
+        seconds = time.perf_counter() - local.started
+        local.in_request = False
+
+        key = (request.endpoint or 'none', request.method)
+        shard = getattr(local, 'shard', None)
+        if shard is None:
+            shard = local.shard = self._new_shard()
+        series = shard.get(key)
+        if series is None:
+            series = shard[key] = _Series()
+
+        series.seconds += seconds
+        series.latency[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        statements = local.sql_statements
+        series.sql_statements += statements
+        series.sql_seconds += local.sql_seconds
+        series.sql_counts[bisect_left(SQL_COUNT_BUCKETS, statements)] += 1
+        if response.status_code >= 500:
+            series.errors += 1
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        self._local.sql_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        local = self._local
+        if getattr(local, 'in_request', False):
+            local.sql_statements += 1
+            local.sql_seconds += time.perf_counter() - local.sql_started
+
+    def _new_shard(self):
+        shard = {}
+        with self._lock:
+            self._shards[id(shard)] = shard
+        weakref.finalize(threading.current_thread(), self._retire, shard)
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._merge(self._retired, shard)
+            del self._shards[id(shard)]
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, series in list(shard.items()):
+            into.setdefault(key, _Series()).add(series)
+
+    def totals(self):
+        """ Return {(endpoint, method): _Series} summed over every thread.
+        """
+        totals = {}
+        with self._lock:
+            self._merge(totals, self._retired)
+            for shard in self._shards.values():
+                self._merge(totals, shard)
+        return totals
+
+    def render(self):
+        """ Return the request metrics in Prometheus text format. """
+
+        totals = sorted(self.totals().items())
+        rows = [({'endpoint': endpoint, 'method': method}, series)
+                for (endpoint, method), series in totals]
+
+        return ''.join([
+            format_histogram(
+                'flask_cafe_request_duration_seconds',
+                'Time to handle a request, to the end of its hooks.',
+                LATENCY_BUCKETS,
+                [(ls, s.latency, s.seconds) for ls, s in rows]),
+            format_histogram(
+                'flask_cafe_request_sql_statements',
+                'SQL statements run per request.',
+                SQL_COUNT_BUCKETS,
+                [(ls, s.sql_counts, s.sql_statements)
+                 for ls, s in rows]),
+            format_metric(
+                'flask_cafe_request_sql_seconds_total', 'counter',
+                'Time spent running SQL in requests.',
+                [(ls, s.sql_seconds) for ls, s in rows]),
+            format_metric(
+                'flask_cafe_request_errors_total', 'counter',
+                'Requests answered with a 5xx status.',
+                [(ls, s.errors) for ls, s in rows]),
+        ])
+
+
+def format_labels(labels):
+    """ Return a Prometheus label set, e.g. {bind="default"}. """
+
+    if not labels:
+        return ''
+    pairs = ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+    return '{' + pairs + '}'
+
+
+def format_metric(name, kind, help, samples):
+    """ Return the text for one metric: `samples` is a list of
+        (labels dict, value). """
+
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+    for labels, value in samples:
+        lines.append(f'{name}{format_labels(labels)} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_histogram(name, help, bounds, samples):
+    """ Return the text for a histogram: `samples` is a list of (labels
+        dict, per-bucket counts with +Inf last, sum of observations). """
+
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+    for labels, counts, total in samples:
+        cumulative = 0
+        for bound, count in zip((*bounds, '+Inf'), counts):
+            cumulative += count
+            le = format_labels({**labels, 'le': _number(bound)})
+            lines.append(f'{name}_bucket{le} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {_number(total)}')
+        lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
@@ -1,13 +1,35 @@
 """Data models for Flask Cafe"""
 
+import math
+from datetime import datetime, timezone
+
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert, TSVECTOR
 from sqlalchemy.exc import IntegrityError
 
+from cache import AppCache
+from hashing import PasswordHasher
+from pool import engine_options
+from replicas import RoutingSession, replica_binds
+
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+password_hasher = PasswordHasher(bcrypt)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+# Navbar fields of recently seen users, keyed by user id.
+user_summary_cache = AppCache(config_prefix='USER_SUMMARY_CACHE')
 DEFAULT_CAFE_IMG_PATH = "/static/images/default-store.png"
 DEFAULT_USER_IMG_PATH = "/static/images/default-pic.png"
+# Mean radius of the earth.
+EARTH_RADIUS_KM = 6371.0088
+# Ids are Postgres integers (int4).
+MAX_ID = 2 ** 31 - 1
+
+
+def utcnow():
+    """ Return the current time as an aware UTC datetime. """
+
+    return datetime.now(timezone.utc)
 
 
 class City(db.Model):
@@ -44,6 +66,17 @@ class Cafe(db.Model):
     """Cafe information."""
 
     __tablename__ = 'cafes'
+    __table_args__ = (
+        # Keyset pagination on the cafe list walks this index.
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+        # Most-liked lists read this index backwards.
+        db.Index('ix_cafes_like_count_id', 'like_count', 'id'),
+        db.Index('ix_cafes_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+        # One cafe per name and address in a city; imports upsert on it.
+        db.UniqueConstraint('name', 'address', 'city_code',
+                            name='uq_cafes_natural_key'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -82,10 +115,67 @@ class Cafe(db.Model):
         default=DEFAULT_CAFE_IMG_PATH,
     )
 
+    # Resized copies of an uploaded image, once they're made; see images.py.
+    image_variants = db.Column(
+        db.JSON,
+    )
+
+    # Bumped whenever the cafe is edited; keys cached HTML fragments.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    # Kept in step with the likes table by Like.add() and Like.remove().
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set on insert and by cafe_edit; served as Last-Modified.
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+    )
+
+    # Postgres keeps this up to date whenever a cafe is added or edited.
+    # Names weigh most, then descriptions, then addresses.
+    search_vector = db.Column(
+        TSVECTOR,
+        db.Computed(
+            "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(description, '')), "
+            "'B') || "
+            "setweight(to_tsvector('english', coalesce(address, '')), 'C')",
+            persisted=True),
+    )
+
+    # Set by search queries: how well the cafe matched. See Cafe.search().
+    search_rank = db.query_expression()
+
+    # Degrees; optional, but a cafe without them is never "near" anything.
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
+
+    # Set by location queries, in km. See Cafe.near().
+    distance_km = db.query_expression()
+
     city = db.relationship("City", backref='cafes')
 
+    # Read-only: likes change through Like.add and Like.remove, which keep
+    # like_count in step.
     liking_users = db.relationship('User', secondary='likes',
-                                   backref='cafes')
+                                   back_populates='liked_cafes',
+                                   viewonly=True)
 
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
@@ -96,6 +186,54 @@ class Cafe(db.Model):
         city = self.city
         return f'{city.name}, {city.state}'
 
+    @classmethod
+    def search(cls, terms, query=None):
+        """ Filter query (Cafe.query by default) to cafes matching the
+            search terms, using the GIN index on search_vector. Terms use
+            web search syntax: words, "quoted phrases", or, -not.
+        Returns (query, rank), where rank is a relevance expression labeled
+        search_rank, for ordering and for Cafe.search_rank.
+        """
+        if query is None:
+            query = cls.query
+        tsquery = db.func.websearch_to_tsquery('english', terms)
+        # ts_rank returns a float4; widen it so the value survives a round
+        # trip through a page cursor exactly.
+        rank = db.cast(db.func.ts_rank(cls.search_vector, tsquery),
+                       db.Double).label('search_rank')
+        return query.filter(cls.search_vector.op('@@')(tsquery)), rank
+
+    @classmethod
+    def near(cls, lat, lng, radius_km, query=None):
+        """ Filter query (Cafe.query by default) to cafes within radius_km
+            of (lat, lng).
+        A bounding box around the circle is looked up in the location
+        index first; only the cafes inside it get the exact (haversine)
+        distance check. Returns (query, distance), where distance is the
+        great-circle distance in km labeled distance_km, for ordering and
+        for Cafe.distance_km.
+        """
+        if query is None:
+            query = cls.query
+
+        location = db.func.point(cls.longitude, cls.latitude)
+        in_boxes = db.or_(*[
+            location.op('<@')(db.func.box(db.func.point(west, south),
+                                          db.func.point(east, north)))
+            for west, south, east, north
+            in bounding_boxes(lat, lng, radius_km)])
+
+        half_dlat = db.func.radians(cls.latitude - lat) / 2
+        half_dlng = db.func.radians(cls.longitude - lng) / 2
+        a = (db.func.power(db.func.sin(half_dlat), 2)
+             + math.cos(math.radians(lat))
+             * db.func.cos(db.func.radians(cls.latitude))
+             * db.func.power(db.func.sin(half_dlng), 2))
+        distance = (2 * EARTH_RADIUS_KM * db.func.asin(
+            db.func.least(1.0, db.func.sqrt(a)))).label('distance_km')
+
+        return query.filter(in_boxes, distance <= radius_km), distance
+
     def serialize(self):
         """ Serialize to dictionary. """
 
@@ -106,10 +244,45 @@ class Cafe(db.Model):
             "url": self.url,
             "address": self.address,
             "city_code": self.city_code,
-            "image_url": self.image_url
+            "image_url": self.image_url,
+            "like_count": self.like_count,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
         }
 
 
+# Cafe.near() looks up bounding boxes in this index. Postgres's built-in
+# point type is enough for that; there's no need for PostGIS.
+db.Index('ix_cafes_location',
+         db.func.point(Cafe.longitude, Cafe.latitude),
+         postgresql_using='gist')
+
+
+def bounding_boxes(lat, lng, radius_km):
+    """ Return boxes, as (west, south, east, north) in degrees, that
+        together hold every point within radius_km of (lat, lng).
+    There are two boxes when the circle crosses the antimeridian.
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(angle)
+    south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+
+    # Near a pole, or for a huge circle, every longitude is in range.
+    cos_lat = math.cos(math.radians(lat))
+    if south == -90 or north == 90 or math.sin(angle) >= cos_lat:
+        return [(-180.0, south, 180.0, north)]
+
+    dlng = math.degrees(math.asin(math.sin(angle) / cos_lat))
+    west, east = lng - dlng, lng + dlng
+    if west < -180:
+        return [(west + 360, south, 180.0, north),
+                (-180.0, south, east, north)]
+    if east > 180:
+        return [(west, south, 180.0, north),
+                (-180.0, south, east - 360, north)]
+    return [(west, south, east, north)]
+
+
 class User(db.Model):
     """User information."""
 
@@ -158,6 +331,11 @@ class User(db.Model):
         default=DEFAULT_USER_IMG_PATH,
     )
 
+    # Resized copies of an uploaded image, once they're made; see images.py.
+    image_variants = db.Column(
+        db.JSON,
+    )
+
     hashed_password = db.Column(
         db.Text,
         nullable=False
@@ -171,15 +349,18 @@ class User(db.Model):
 
         return f'{self.first_name} {self.last_name}'
 
+    # Read-only, like Cafe.liking_users.
     liked_cafes = db.relationship('Cafe', secondary='likes',
-                                  backref='users')
+                                  back_populates='liking_users',
+                                  viewonly=True)
 
     @classmethod
     def register(self, username, first_name, last_name, description, email,
                  password, image_url=None, admin=False):
         """ Register a new user and handle password hashing. Returns the
-            new user object on success or False on failure. """
-        hash = bcrypt.generate_password_hash(password).decode('utf8')
+            new user object on success or False on failure. Raises
+            HasherBusy if the password hashing pool is full. """
+        hash = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -200,13 +381,23 @@ class User(db.Model):
 
     @classmethod
     def authenticate(self, username, password):
+        """ Return the user if the password is right, else False. Re-hashes
+            the password if it was stored at an outdated cost. Raises
+            HasherBusy if the password hashing pool is full. """
         user = User.query.filter(User.username == username).first()
         try:
             hashed_pw = user.hashed_password
         except AttributeError:  # query turned up nothing
+            # Take as long as a wrong password, so timing and CPU cost
+            # don't reveal which usernames exist.
+            return password_hasher.check_dummy(password)
+        if not password_hasher.check(hashed_pw, password):
             return False
-        return user if bcrypt.check_password_hash(
-            hashed_pw, password) else False
+
+        if password_hasher.needs_rehash(hashed_pw):
+            user.hashed_password = password_hasher.hash(password)
+            db.session.commit()
+        return user
 
     def serialize(self):
         """ Serialize to dictionary. """
@@ -224,6 +415,72 @@ class User(db.Model):
         }
 
 
+class CurrentUser:
+    """ Lazy stand-in for the logged-in User, for g.user.
+
+        Knows the user's id without a query. Truthiness and the fields in
+        SUMMARY_FIELDS (what the navbar shows) come from user_summary_cache,
+        so most pages make no user query at all. Any other attribute, and
+        any assignment, loads the real User row on first use.
+    """
+
+    SUMMARY_FIELDS = ('username', 'first_name', 'last_name')
+
+    def __init__(self, user_id):
+        object.__setattr__(self, 'id', user_id)
+        object.__setattr__(self, '_user', None)
+
+    def __repr__(self):
+        return f'<CurrentUser id={self.id}>'
+
+    def __bool__(self):
+        """ False if the logged-in user no longer exists. """
+
+        return self._get_summary() is not None
+
+    def __getattr__(self, name):
+        if name in self.SUMMARY_FIELDS and self._user is None:
+            summary = self._get_summary()
+            if summary is not None:
+                return summary[name]
+        return getattr(self._get_user(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_user(), name, value)
+
+    def _get_summary(self):
+        summary = user_summary_cache.get(self.id)
+        if summary is None:
+            row = db.session.execute(self.summary_stmt(self.id)).first()
+            if row is None:
+                return None
+            summary = self.summary_from_row(row)
+            user_summary_cache.set(self.id, summary)
+        return summary
+
+    def _get_user(self):
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self.id))
+        return self._user
+
+    @classmethod
+    def summary_stmt(cls, user_id):
+        return db.select(*[getattr(User, f) for f in cls.SUMMARY_FIELDS]
+                         ).where(User.id == user_id)
+
+    @classmethod
+    def summary_from_row(cls, row):
+        """ Return the summary dict for a summary_stmt row. """
+
+        return dict(zip(cls.SUMMARY_FIELDS, row))
+
+    @staticmethod
+    def forget(user_id):
+        """ Drop a user's cached summary; call after changing the user. """
+
+        user_summary_cache.delete(user_id)
+
+
 class Like(db.Model):
     """ A table for tracking which users like which cafes. """
 
@@ -246,13 +503,188 @@ class Like(db.Model):
     def __repr__(self):
         return f'<Like user_id={self.user_id} cafe_id={self.cafe_id}>'
 
+    @classmethod
+    def exists(cls, user_id, cafe_id):
+        """ Return whether the user likes the cafe; a single primary-key
+            probe, without loading either side of the relationship. """
+
+        return db.session.execute(cls.exists_stmt(user_id, cafe_id)).scalar()
+
+    @classmethod
+    def liked_cafe_ids(cls, user_id, cafe_ids):
+        """ Return the set of the given cafe ids that the user likes. """
+
+        rows = db.session.execute(cls.liked_cafe_ids_stmt(user_id, cafe_ids))
+        return set(rows.scalars())
+
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """ Make the user like the cafe with a single
+            INSERT ... ON CONFLICT DO NOTHING, so repeats and races are
+            harmless, and bump the cafe's like_count if the like is new.
+            Returns True if the like is new. Raises IntegrityError if the
+            cafe doesn't exist. """
+
+        result = db.session.execute(cls.add_stmt(user_id, cafe_id))
+        added = result.first() is not None
+        if added:
+            db.session.execute(cls.like_count_stmt(cafe_id, 1))
+        return added
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """ Make the user un-like the cafe with a single DELETE.
+            Lowers the cafe's like_count if there was a like to remove.
+            Returns True if there was a like to remove. """
+
+        result = db.session.execute(cls.remove_stmt(user_id, cafe_id))
+        removed = result.first() is not None
+        if removed:
+            db.session.execute(cls.like_count_stmt(cafe_id, -1))
+        return removed
+
+    # The statements behind the methods above, shared with the async views
+    # in asgi.py, which run them on their own session.
+
+    @classmethod
+    def exists_stmt(cls, user_id, cafe_id):
+        return db.select(
+            db.exists().where(cls.user_id == user_id, cls.cafe_id == cafe_id))
+
+    @classmethod
+    def liked_cafe_ids_stmt(cls, user_id, cafe_ids):
+        return db.select(cls.cafe_id).where(
+            cls.user_id == user_id, cls.cafe_id.in_(cafe_ids))
+
+    @classmethod
+    def add_stmt(cls, user_id, cafe_id):
+        return (insert(cls)
+                .values(user_id=user_id, cafe_id=cafe_id)
+                .on_conflict_do_nothing()
+                .returning(cls.cafe_id))
+
+    @classmethod
+    def remove_stmt(cls, user_id, cafe_id):
+        return (db.delete(cls)
+                .where(cls.user_id == user_id, cls.cafe_id == cafe_id)
+                .returning(cls.cafe_id))
+
+    @staticmethod
+    def like_count_stmt(cafe_id, delta):
+        """ Add delta to the cafe's like_count in the database; run it in
+            the same transaction as the like itself. """
+
+        return (db.update(Cafe)
+                .where(Cafe.id == cafe_id)
+                .values(like_count=Cafe.like_count + delta))
+
+    @classmethod
+    def backfill_like_counts(cls, batch_size=10000):
+        """ Recount cafes.like_count from the likes table, committing every
+            batch_size cafes to keep locks short. Returns the number of
+            cafes whose count changed. """
+
+        count = db.select(db.func.count()).where(
+            cls.cafe_id == Cafe.id).scalar_subquery()
+        max_id = db.session.query(db.func.max(Cafe.id)).scalar() or 0
+
+        changed = 0
+        for start in range(0, max_id + 1, batch_size):
+            result = db.session.execute(
+                db.update(Cafe)
+                .where(Cafe.id >= start,
+                       Cafe.id < start + batch_size,
+                       Cafe.like_count != count)
+                .values(like_count=count)
+                .execution_options(synchronize_session=False))
+            changed += result.rowcount
+            db.session.commit()
+        return changed
+
+
+class Job(db.Model):
+    """ Work queued for a background worker; see jobs.py. """
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # Workers look for the oldest ready job in one state or another.
+        db.Index('ix_jobs_state_run_at', 'state', 'run_at'),
+    )
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    # Which registered handler runs the job, and its keyword arguments.
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # "queued", "running" or "dead"; finished jobs are deleted.
+    state = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Not before; pushed back after each failure.
+    run_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+    )
+
+    # A running job whose worker hasn't finished by then is run again.
+    locked_until = db.Column(
+        db.DateTime(timezone=True),
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=utcnow,
+    )
+
+    def __repr__(self):
+        return f'<Job id={self.id} name="{self.name}" state={self.state}>'
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    create_app() calls this. Scripts that use the database outside of a
+    request should push an app context themselves.
     """
 
-    app.app_context().push()
-    db.app = app
+    app.config.setdefault(
+        'SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    # Each of DATABASE_REPLICA_URLS becomes a replica_<n> bind, with the
+    # same engine options; see replicas.ReplicaRouter.
+    replicas = replica_binds(app.config.get('DATABASE_REPLICA_URLS', ()))
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for key, url in replicas.items():
+        binds.setdefault(key, url)
     db.init_app(app)
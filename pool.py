@@ -0,0 +1,127 @@
+""" Database connection pool settings and statistics for Flask Cafe. """
+
+import threading
+import time
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import NullPool, QueuePool, AsyncAdaptedQueuePool
+
+
+class PoolStats:
+    """ Counters for one engine's connection pool. """
+
+    def __init__(self):
+        self.checked_out = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def record_checkout(self):
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+
+    def record_checkin(self):
+        with self._lock:
+            self.checked_out -= 1
+
+
+class InstrumentedPoolMixin:
+    """ Keeps PoolStats for a pool: how many connections are checked out,
+        and how long each checkout waited for one. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except PoolTimeout:
+            self.stats.record_wait(time.perf_counter() - start, True)
+            raise
+        self.stats.record_wait(time.perf_counter() - start)
+        self.stats.record_checkout()
+        return record
+
+    def _do_return_conn(self, record):
+        self.stats.record_checkin()
+        super()._do_return_conn(record)
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    """ A QueuePool that keeps PoolStats. """
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin,
+                                 AsyncAdaptedQueuePool):
+    """ An AsyncAdaptedQueuePool, for asyncio engines, that keeps PoolStats.
+    """
+
+
+class InstrumentedNullPool(InstrumentedPoolMixin, NullPool):
+    """ A NullPool that keeps PoolStats. It never waits; every checkout
+        opens a new connection. """
+
+
+def engine_options(config, asyncio=False):
+    """ Build SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* settings. With
+        asyncio, build them for create_async_engine() instead.
+
+        With DB_POOLER_MODE on, the app expects a transaction-level pooler
+        such as PgBouncer in front of Postgres: it holds no connections of
+        its own (NullPool) and turns off the driver's server-side prepared
+        statements, which don't survive moving between server connections.
+    """
+
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+
+    if config['DB_POOLER_MODE']:
+        options['poolclass'] = InstrumentedNullPool
+        driver = make_url(config['SQLALCHEMY_DATABASE_URI']).get_driver_name()
+        if driver == 'psycopg':
+            options['connect_args'] = {'prepare_threshold': None}
+        elif driver == 'asyncpg':
+            options['connect_args'] = {'statement_cache_size': 0,
+                                       'prepared_statement_cache_size': 0}
+        # psycopg2 never prepares statements on the server.
+        return options
+
+    options.update(
+        poolclass=InstrumentedAsyncQueuePool if asyncio
+        else InstrumentedQueuePool,
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+        pool_recycle=config['DB_POOL_RECYCLE'],
+    )
+    return options
+
+
+def pool_status(engine):
+    """ Return a dictionary describing the engine's pool right now. """
+
+    pool = engine.pool
+    stats = getattr(pool, 'stats', None) or PoolStats()
+    status = {
+        "pool": type(pool).__name__,
+        "checked_out": stats.checked_out,
+        "checkouts": stats.checkouts,
+        "timeouts": stats.timeouts,
+        "wait_seconds_total": round(stats.wait_seconds, 6),
+        "wait_seconds_max": round(stats.max_wait_seconds, 6),
+    }
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), overflow=max(pool.overflow(), 0))
+    return status
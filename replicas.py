@@ -0,0 +1,114 @@
+""" Read-replica routing for Flask Cafe. """
+
+import random
+import time
+
+from flask import request, session, current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+
+# Replicas are binds named replica_0, replica_1, ...
+REPLICA_BIND_PREFIX = 'replica_'
+# Session key: read from the primary until this time (a Unix timestamp).
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+
+def replica_binds(urls):
+    """ Return SQLALCHEMY_BINDS entries for a list of replica URLs. """
+
+    return {f'{REPLICA_BIND_PREFIX}{i}': url for i, url in enumerate(urls)}
+
+
+def read_replica(view):
+    """ Decorator: let a view's reads go to a replica. Mark only views
+        that don't write, and that can show data a moment old. """
+
+    view.read_replica = True
+    return view
+
+
+class RoutingSession(Session):
+    """ A session that sends plain SELECTs to the replica bind that
+        ReplicaRouter picked for the request (session.info['read_bind']),
+        and everything else to the primary.
+
+        Once the session writes, by flushing or running an INSERT, UPDATE
+        or DELETE, it reads from the primary too, and records that in
+        session.info['wrote'] for ReplicaRouter.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info['wrote'] = True
+            elif (isinstance(clause, Select)
+                  and clause._for_update_arg is None
+                  and not self.info.get('wrote')):
+                read_bind = self.info.get('read_bind')
+                if read_bind is not None:
+                    return self._db.engines[read_bind]
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+def _db():
+    return current_app.extensions['sqlalchemy']
+
+
+class ReplicaRouter:
+    """ Picks a replica for each GET or HEAD of a @read_replica view, with
+        read-your-writes stickiness.
+
+        When a request writes, the visitor's session cookie gets a
+        PRIMARY_UNTIL_KEY REPLICA_STICKY_SECONDS ahead, and until then
+        every request of theirs reads from the primary, so they see their
+        own changes while the replicas catch up. Set the window above your
+        usual replication lag. With no replicas configured, everything
+        uses the primary.
+    """
+
+    def init_app(self, app):
+        """ Find the app's replica binds, and add the request hooks. Call
+            after connect_db(app). """
+
+        app.extensions['replicas'] = sorted(
+            key for key in app.config.get('SQLALCHEMY_BINDS', {})
+            if key and key.startswith(REPLICA_BIND_PREFIX))
+        app.before_request(self._choose_read_bind)
+        app.after_request(self._stick_to_primary_after_writes)
+
+    def _choose_read_bind(self):
+        binds = current_app.extensions['replicas']
+        if not binds:
+            return
+        # Start afresh, even on a session left over from an app context
+        # that outlives the request (as in tests).
+        info = _db().session.info
+        info.pop('read_bind', None)
+        info.pop('wrote', None)
+        if request.method not in ('GET', 'HEAD'):
+            return
+        view = current_app.view_functions.get(request.endpoint)
+        if not getattr(view, 'read_replica', False):
+            return
+        if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+            return
+        info['read_bind'] = random.choice(binds)
+
+    def _stick_to_primary_after_writes(self, response):
+        if (current_app.extensions['replicas']
+                and _db().session.info.get('wrote')):
+            session[PRIMARY_UNTIL_KEY] = self.primary_until(current_app)
+        return response
+
+    @staticmethod
+    def uses_replicas(app):
+        """ Return whether the app has any replicas. """
+
+        return bool(app.extensions.get('replicas'))
+
+    @staticmethod
+    def primary_until(app):
+        """ Return the PRIMARY_UNTIL_KEY value for a write made now. """
+
+        return round(time.time() + app.config['REPLICA_STICKY_SECONDS'], 1)
@@ -2,7 +2,10 @@
 
 from models import City, Cafe, User, Like, db
 
-from app import app
+from app import create_app
+
+app = create_app()
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -30,6 +33,8 @@ c1 = Cafe(
                 ' and write Rithm exercises.',
     address="3966 24th St",
     city_code='sf',
+    latitude=37.7517,
+    longitude=-122.4314,
     url='https://www.yelp.com/biz/bernies-san-francisco',
     image_url='https://s3-media4.fl.yelpcdn.com/bphoto/'
               'bVCa2JefOCqxQsM6yWrC-A/o.jpg'
@@ -41,6 +46,8 @@ c2 = Cafe(
                 ' around Oakland.',
     address='440 Grand Ave',
     city_code='oak',
+    latitude=37.8114,
+    longitude=-122.2585,
     url='https://perchoffee.com',
     image_url='https://s3-media4.fl.yelpcdn.com/bphoto/'
               '0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
@@ -79,9 +86,10 @@ db.session.commit()
 #######################################
 # add likes
 
-u1.liked_cafes.append(c1)
-u1.liked_cafes.append(c2)
-ua.liked_cafes.append(c1)
+# Like.add keeps the cafes' like_count in step.
+Like.add(u1.id, c1.id)
+Like.add(u1.id, c2.id)
+Like.add(ua.id, c1.id)
 
 db.session.commit()
 
@@ -1,33 +1,46 @@
 'use strict';
 
-const API_BASE_URL = 'http://localhost:5000/api';
-const cafe_id = document.URL.slice(document.URL.lastIndexOf('/') + 1);
+const API_BASE_URL = '/api';
 
 /**
- *  If the current user likes this cafe, then show a filled star.
- *  Otherwise, show an empty star
+ *  Show a filled star if the user likes this cafe, or an empty one.
  */
-async function showCafeLikeStar() {
-  const likeData = await fetch(`${API_BASE_URL}/likes?cafe_id=${cafe_id}`);
-  const likeDataJSON = await likeData.json();
-  const userLikesThisCafe = likeDataJSON.likes;
+function showCafeLikeStar($star, likes) {
+  $star.data('likes', likes);
+  $star.find('i')
+    .toggleClass('bi-star-fill', likes)
+    .toggleClass('bi-star', !likes)
+    .attr('title', likes ? 'Unlike' : 'Like');
+}
 
-  if (userLikesThisCafe) {
-    $('#like-star > i').addClass('bi bi-star-fill')
-  } else {
-    $('#like-star > i').addClass('bi bi-star');
-  }
+/**
+ *  The page arrives with the star already showing whether the user likes
+ *  this cafe (data-likes). A click likes or unlikes it, and the star shows
+ *  the state the API answers with, so there's no need to ask again.
+ */
+function setUpCafeLikeStar() {
+  const $star = $('#like-star');
+  if (!$star.length) return;
 
-  const likeOrUnlike = userLikesThisCafe ? 'unlike' : 'like';
-  $('#like-star > i').on('click', async function(e) {
-    await fetch(`${API_BASE_URL}/${likeOrUnlike}`, {
+  let busy = false;
+  $star.on('click', 'i', async function(e) {
+    if (busy) return;
+    busy = true;
+    const likeOrUnlike = $star.data('likes') ? 'unlike' : 'like';
+    try {
+      const resp = await fetch(`${API_BASE_URL}/${likeOrUnlike}`, {
         headers: {'Content-Type': 'application/json'},
-        method: "POST",
-        body: `{"cafe_id": ${cafe_id}}`}
-    );
+        method: 'POST',
+        body: JSON.stringify({cafe_id: $star.data('cafe-id')}),
+      });
+      if (resp.ok) {
+        const respJSON = await resp.json();
+        showCafeLikeStar($star, respJSON.likes);
+      }
+    } finally {
+      busy = false;
+    }
   });
-
-  return userLikesThisCafe;
 }
 
-showCafeLikeStar();
\ No newline at end of file
+setUpCafeLikeStar();
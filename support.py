@@ -1,5 +1,22 @@
 """ Supporting functions for the app. """
 
+import base64
+import hashlib
+import json
+import threading
+import time
+
+from flask import current_app, request, make_response
+from sqlalchemy import event, tuple_
+from sqlalchemy.orm import Session
+
+
+_choices_cache = {}
+# Bumped per model (None for all) on each invalidation, so a query that
+# raced a commit doesn't cache what it read from before it.
+_choices_generations = {}
+_choices_lock = threading.Lock()
+
 
 def set_dropdown_choices(model, value, label):
     """ Set the choices for a WTForm SelectField (aka, dropdown).
@@ -7,10 +24,231 @@ def set_dropdown_choices(model, value, label):
         - value: the values, usually the primary key in the table
         - label: the lables, usually the human-readable version of the value
     Returns a list of tuples [(value_1, label_1) ... (value_n, label_n)]
+
+    Choices are cached per process for DROPDOWN_CHOICES_TTL seconds, and
+    dropped as soon as a commit inserts, updates or deletes a `model` row.
+    """
+    key = (model, value, label)
+    now = time.monotonic()
+
+    with _choices_lock:
+        cached = _choices_cache.get(key)
+        generation = _choices_generation(model)
+    if cached and cached[0] > now:
+        return list(cached[1])
+
+    label_col = getattr(model, label)
+    rows = model.query.with_entities(
+        getattr(model, value), label_col).order_by(label_col).all()
+    choices = tuple((r[0], r[1]) for r in rows)
+
+    ttl = current_app.config['DROPDOWN_CHOICES_TTL']
+    with _choices_lock:
+        if _choices_generation(model) == generation:
+            _choices_cache[key] = (now + ttl, choices)
+    return list(choices)
+
+
+def _choices_generation(model):
+    # Call with _choices_lock held.
+    return (_choices_generations.get(model, 0),
+            _choices_generations.get(None, 0))
+
+
+def _forget_choices(models):
+    # Call with _choices_lock held. models may include None, for all.
+    for model in models:
+        _choices_generations[model] = _choices_generations.get(model, 0) + 1
+    for key in list(_choices_cache):
+        if None in models or key[0] in models:
+            del _choices_cache[key]
+
+
+def invalidate_dropdown_choices(model=None):
+    """ Forget cached dropdown choices for `model`, or for every model. """
+
+    with _choices_lock:
+        _forget_choices({model})
+
+
+def _changed_models(session):
+    return session.info.setdefault('dropdown_changed_models', set())
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_flushed_models(session, flush_context):
+    """ Remember which models a flush touched, to invalidate on commit. """
+
+    changed = _changed_models(session)
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        changed.add(type(obj))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _note_bulk_models(orm_execute_state):
+    """ Bulk Model.query.delete()/update() skip the flush; note them too. """
+
+    if not orm_execute_state.is_select:
+        changed = _changed_models(orm_execute_state.session)
+        for mapper in orm_execute_state.all_mappers:
+            changed.add(mapper.class_)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_models(session):
+    changed = session.info.pop('dropdown_changed_models', set())
+    if changed:
+        with _choices_lock:
+            _forget_choices(changed)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_rolled_back_models(session, previous_transaction):
+    session.info.pop('dropdown_changed_models', None)
+
+
+#######################################
+# keyset pagination
+
+
+def encode_cursor(values):
+    """ Encode a list of sort-key values as an opaque, URL-safe cursor. """
+
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size, types=None):
+    """ Decode a cursor made by encode_cursor. Raises ValueError if the
+        cursor is malformed or doesn't hold `size` values, or if `types`
+        (a python type per value, or None to skip one) are given and a
+        value isn't of its type. """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, UnicodeError) as exc:
+        raise ValueError(f'Bad cursor: {cursor!r}') from exc
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError(f'Bad cursor: {cursor!r}')
+    for value, kind in zip(values, types or ()):
+        if kind is not None and not _is_a(value, kind):
+            raise ValueError(f'Bad cursor: {cursor!r}')
+    return values
+
+
+def _is_a(value, kind):
+    # bool is a subclass of int; a float value may arrive as an int.
+    if isinstance(value, bool):
+        return kind is bool
+    if kind is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, kind)
+
+
+def column_python_type(column):
+    """ Return the python type of a column's values, or None if unknown. """
+
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return None
+
+
+def keyset_query(query, columns, after=None, before=None, descending=False):
+    """ Order a query by `columns` and start it just past a cursor.
+        - after: cursor of the last row already seen; walk forward from it
+        - before: cursor of the first row already seen; walk backward
+        - descending: sort by the columns high-to-low instead of low-to-high
+    When walking backward the rows come out in reverse order; the caller
+    should flip them (paginate_keyset does this).
+    """
+    backward = before is not None
+    cursor = before if backward else after
+
+    if cursor is not None:
+        key = tuple_(*columns)
+        types = [column_python_type(c) for c in columns]
+        values = tuple_(*decode_cursor(cursor, len(columns), types))
+        query = query.filter(
+            key < values if backward != descending else key > values)
+
+    if backward != descending:
+        return query.order_by(*[c.desc() for c in columns])
+    return query.order_by(*columns)
+
+
+def paginate_keyset(query, columns, per_page, after=None, before=None,
+                    descending=False):
+    """ Fetch one page of a query using keyset (a.k.a. cursor) pagination.
+    Each page costs one index range scan no matter how deep it is.
+
+    `columns` must be unique together (end with the primary key) and each
+    row must expose them as attributes of the same name.
+    Returns (items, prev_cursor, next_cursor); a cursor is None if there
+    is no page in that direction.
     """
-    records = [r.serialize() for r in model.query.order_by(label).all()]
-    choices = [(r[value], r[label]) for r in records]
-    return choices
+    rows = keyset_query(query, columns, after, before, descending).limit(
+        per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+
+    if before is not None:
+        items.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    def cursor_for(item):
+        return encode_cursor(getattr(item, c.key) for c in columns)
+
+    prev_cursor = cursor_for(items[0]) if items and has_prev else None
+    next_cursor = cursor_for(items[-1]) if items and has_next else None
+    return items, prev_cursor, next_cursor
+
+
+#######################################
+# conditional GET
+
+
+def make_etag(*parts):
+    """ Build a strong ETag value from everything a response depends on. """
+
+    raw = '|'.join(str(p) for p in parts).encode('utf8')
+    return hashlib.sha1(raw).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    """ Return an empty 304 response if the request's validators show the
+        client already has this version of the page, or None if it needs
+        the full page. If-None-Match wins over If-Modified-Since, and
+        matches weakly (RFC 9110), as proxies that compress the page may
+        have weakened the ETag. """
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        fresh = last_modified.replace(microsecond=0) <= \
+            request.if_modified_since
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    return add_validators(make_response('', 304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified):
+    """ Set ETag, Last-Modified and caching headers on a response.
+        Pages vary with the logged-in user, so caches key on the cookie and
+        must revalidate before reuse. """
+
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Cookie')
+    return response
 
 
 def ultra_print(message):
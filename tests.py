@@ -1,26 +1,48 @@
 """Tests for Flask Cafe."""
 
 
+import asyncio
+import gc
+import io
+import json
 import os
-
-os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
-
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Barrier, Event, Thread
+from unittest.mock import patch
+from werkzeug.middleware.proxy_fix import ProxyFix
 from unittest import TestCase
+import pool
 import support
 
-from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User, Like
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
+from sqlalchemy import event
+from sqlalchemy.exc import DataError, OperationalError
 
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+from flask import session
+from PIL import Image
+from asgi import LikesApp, Request
+from app import (create_app, CURR_USER_KEY, NOT_LOGGED_IN_MSG, fragment_cache,
+                 login_throttle, request_metrics)
+from hashing import HasherBusy
+from cache import LRUCache
+from config import ProductionConfig, TestingConfig
+from images import image_store
+from jobs import job_queue, enqueue_after_commit
+from models import (db, Cafe, City, connect_db, User, Like, Job,
+                    password_hasher, user_summary_cache, bounding_boxes,
+                    utcnow)
+from replicas import PRIMARY_UNTIL_KEY
+
+# The testing profile uses the flaskcafe_test database, makes Flask errors
+# be real errors, and turns off CSRF and the debug toolbar.
+app = create_app('testing')
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -45,6 +67,36 @@ def login_for_test(client, user_id):
         sess[CURR_USER_KEY] = user_id
 
 
+@contextmanager
+def count_queries():
+    """Count the SQL statements run inside the block.
+        Yields a list that fills with one entry per statement."""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+@contextmanager
+def assert_max_queries(test_case, budget):
+    """Fail test_case if the block runs more than `budget` SQL statements.
+        Yields the list of statements, as count_queries() does."""
+
+    with count_queries() as statements:
+        yield statements
+    test_case.assertLessEqual(
+        len(statements), budget,
+        f"{len(statements)} queries, over the budget of {budget}:\n"
+        + "\n\n".join(statements))
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -529,93 +581,2258 @@ ADMIN_USER_DATA = dict(
 
 
 #######################################
-# likes
+# cafe list pagination
 
 
-class LikeViewsTestCase(TestCase):
-    """Tests for views on likes."""
+class CafeListPaginationTestCase(TestCase):
+    """Tests for keyset pagination on the cafe list."""
 
     def setUp(self):
-        """ Add a few users, cafes, and likes """
+        """Add a city and enough cafes for a few pages."""
 
         Like.query.delete()
         Cafe.query.delete()
         City.query.delete()
-        User.query.delete()
 
-        sf = City(**CITY_DATA)
-        db.session.add(sf)
+        db.session.add(City(**CITY_DATA))
+        for i in range(7):
+            db.session.add(Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}))
+        db.session.commit()
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        app.config['CAFES_PER_PAGE'] = 3
 
-        cafe = Cafe(**CAFE_DATA)
-        db.session.add(cafe)
+    def tearDown(self):
+        """Remove the cafes and reset the page size."""
 
-        # user_2 = User.register(**TEST_USER_DATA_2)
-        # db.session.add(user_2)
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
 
+        app.config['CAFES_PER_PAGE'] = 24
+
+    def test_first_page(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            html = resp.data.decode('utf8')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Cafe 0", html)
+            self.assertIn("Cafe 2", html)
+            self.assertNotIn("Cafe 3", html)
+            self.assertIn("Next", html)
+            self.assertNotIn("Previous", html)
+
+    def test_walk_forward_and_back(self):
+        cursor_pattern = re.compile(r'/cafes\?(after|before)=([\w-]+)')
+
+        with app.test_client() as client:
+            html = client.get("/cafes").data.decode('utf8')
+            after = dict(cursor_pattern.findall(html))['after']
+
+            html = client.get(f"/cafes?after={after}").data.decode('utf8')
+            self.assertIn("Cafe 3", html)
+            self.assertIn("Cafe 5", html)
+            self.assertNotIn("Cafe 2", html)
+            self.assertNotIn("Cafe 6", html)
+            after = dict(cursor_pattern.findall(html))['after']
+
+            html = client.get(f"/cafes?after={after}").data.decode('utf8')
+            self.assertIn("Cafe 6", html)
+            self.assertNotIn("Next", html)
+            before = dict(cursor_pattern.findall(html))['before']
+
+            html = client.get(f"/cafes?before={before}").data.decode('utf8')
+            self.assertIn("Cafe 3", html)
+            self.assertIn("Cafe 5", html)
+            self.assertNotIn("Cafe 6", html)
+            self.assertIn("Next", html)
+            self.assertIn("Previous", html)
+
+    def test_bad_cursor(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes?after=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_cursor_round_trip(self):
+        cursor = support.encode_cursor(["Bernie's Cafe", 12])
+        self.assertEqual(support.decode_cursor(cursor, 2),
+                         ["Bernie's Cafe", 12])
+        with self.assertRaises(ValueError):
+            support.decode_cursor(cursor, 3)
+
+    def test_cursor_value_types(self):
+        cursor = support.encode_cursor(["Bernie's Cafe", 12])
+        self.assertEqual(support.decode_cursor(cursor, 2, [str, int]),
+                         ["Bernie's Cafe", 12])
+        for values in (["a", "x"], [1, "x"], ["a", True], ["a", 1.5]):
+            with self.assertRaises(ValueError):
+                support.decode_cursor(
+                    support.encode_cursor(values), 2, [str, int])
+
+        bad = support.encode_cursor(["a", "x"])
+        with app.test_client() as client:
+            for url in (f"/cafes?after={bad}",
+                        f"/cafes/search?q=cafe&after={bad}",
+                        f"/api/cafes/search?q=cafe&after={bad}"):
+                self.assertEqual(client.get(url).status_code, 400, url)
+
+
+#######################################
+# eager loading of cafe cities
+
+
+class CafeCityLoadingTestCase(TestCase):
+    """Tests that cafe pages load cities in the same query as cafes."""
+
+    def setUp(self):
+        """Add a user and some cities; tests add the cafes."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        for i in range(6):
+            db.session.add(City(code=f"c{i}", name=f"City {i}", state="CA"))
+        user = User.register(**TEST_USER_DATA)
         db.session.commit()
 
         self.user_id = user.id
-        # self.user_2_id = user_2.id
-        self.cafe_id = cafe.id
 
     def tearDown(self):
-        """ Remove those users, cafes, and likes """
+        """Remove the likes, cafes, cities and user."""
 
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
         User.query.delete()
+        db.session.commit()
+
+    def add_liked_cafes(self, count):
+        """Add `count` cafes, each in its own city, all liked by the user."""
+
+        start = Cafe.query.count()
+        for i in range(count):
+            cafe = Cafe(**{**CAFE_DATA,
+                           "name": f"Cafe {start + i}",
+                           "city_code": f"c{i % 6}"})
+            db.session.add(cafe)
+            db.session.flush()
+            db.session.add(Like(user_id=self.user_id, cafe_id=cafe.id))
+        db.session.commit()
+        db.session.expire_all()
+
+    def queries_for(self, url):
+        """Return how many SQL statements a GET of `url` takes, once the
+        per-process caches are warm."""
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get(url)
+            with count_queries() as statements:
+                resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def test_list_query_count_is_fixed(self):
+        self.add_liked_cafes(1)
+        one = self.queries_for("/cafes")
+
+        self.add_liked_cafes(6)
+        self.assertEqual(self.queries_for("/cafes"), one)
+
+    def test_profile_query_count_is_fixed(self):
+        self.add_liked_cafes(1)
+        one = self.queries_for("/profile")
+
+        self.add_liked_cafes(6)
+        self.assertEqual(self.queries_for("/profile"), one)
+
+    def test_detail_loads_city_with_cafe(self):
+        self.add_liked_cafes(1)
+        cafe_id = Cafe.query.one().id
+        db.session.expire_all()
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get(f"/cafes/{cafe_id}")
+            self.assertIn(b"City 0, CA", resp.data)
+        self.assertFalse(
+            [s for s in statements if s.lstrip().startswith("SELECT cities")])
+
+
+#######################################
+# city dropdown cache
+
+
+class DropdownChoicesCacheTestCase(TestCase):
+    """Tests for the cached city dropdown choices."""
+
+    def setUp(self):
+        """Add a city and start with an empty choices cache."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+        support.invalidate_dropdown_choices()
+
+    def tearDown(self):
+        """Remove the cities."""
+
         Cafe.query.delete()
         City.query.delete()
+        db.session.commit()
+
+    def test_get_choices_vocab(self):
+        self.assertEqual(support.set_dropdown_choices(City, 'code', 'name'),
+                         [('sf', 'San Francisco')])
+        self.assertEqual(support.set_dropdown_choices(City, 'code', 'state'),
+                         [('sf', 'CA')])
+
+    def test_cached_choices_skip_the_database(self):
+        support.set_dropdown_choices(City, 'code', 'name')
+
+        with count_queries() as statements:
+            choices = support.set_dropdown_choices(City, 'code', 'name')
+        self.assertEqual(choices, [('sf', 'San Francisco')])
+        self.assertEqual(statements, [])
+
+    def test_insert_and_update_invalidate(self):
+        support.set_dropdown_choices(City, 'code', 'name')
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+        self.assertEqual(support.set_dropdown_choices(City, 'code', 'name'),
+                         [('oak', 'Oakland'), ('sf', 'San Francisco')])
+
+        City.query.get('oak').name = "Oaktown"
+        db.session.commit()
+        self.assertEqual(support.set_dropdown_choices(City, 'code', 'name'),
+                         [('oak', 'Oaktown'), ('sf', 'San Francisco')])
+
+    def test_delete_invalidates(self):
+        support.set_dropdown_choices(City, 'code', 'name')
+
+        City.query.filter(City.code == 'sf').delete()
+        db.session.commit()
+        self.assertEqual(support.set_dropdown_choices(City, 'code', 'name'),
+                         [])
+
+    def test_commit_during_query_skips_cache(self):
+        # Another thread commits a city change while this query runs.
+        def commit_elsewhere(state):
+            support.invalidate_dropdown_choices(City)
+
+        event.listen(db.session, 'do_orm_execute', commit_elsewhere)
+        try:
+            support.set_dropdown_choices(City, 'code', 'name')
+        finally:
+            event.remove(db.session, 'do_orm_execute', commit_elsewhere)
+
+        with count_queries() as statements:
+            support.set_dropdown_choices(City, 'code', 'name')
+        self.assertEqual(len(statements), 1)
+
+    def test_rollback_keeps_cache(self):
+        support.set_dropdown_choices(City, 'code', 'name')
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.flush()
+        db.session.rollback()
+
+        with count_queries() as statements:
+            support.set_dropdown_choices(City, 'code', 'name')
+        self.assertEqual(statements, [])
+
+
+#######################################
+# fragment cache
+
+
+class FragmentCacheTestCase(TestCase):
+    """Tests for cached cafe card and detail fragments."""
+
+    def setUp(self):
+        """Add a city and a cafe, and start with an empty cache."""
+
         Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
         db.session.commit()
 
-    def test_profile_zero_likes_view(self):
+        self.cafe_id = cafe.id
+        fragment_cache.clear()
+
+    def tearDown(self):
+        """Remove the cafes and cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_list_reuses_cards(self):
         with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.get('/profile', follow_redirects=True)
-            self.assertIn(b'You don\'t like anything', resp.data)
+            client.get("/cafes")
+            self.assertEqual(fragment_cache.stats()["misses"], 1)
 
-    def test_profile_likes_view(self):
-        test_like_data = dict(
-            user_id=self.user_id,
-            cafe_id=self.cafe_id
-        )
-        self.assertTrue(True)
-        like = Like(**test_like_data)
-        db.session.add(like)
+            resp = client.get("/cafes")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertEqual(fragment_cache.stats()["hits"], 1)
+
+    def test_edit_bumps_version(self):
+        with app.test_client() as client:
+            client.get(f"/cafes/{self.cafe_id}")
+
+            resp = client.post(
+                f"/cafes/{self.cafe_id}/edit/",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b"new-description", resp.data)
+            self.assertNotIn(b"Test description", resp.data)
+            self.assertEqual(Cafe.query.get(self.cafe_id).version, 2)
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats(),
+                         {"hits": 2, "misses": 1, "size": 2, "maxsize": 2})
+
+
+#######################################
+# conditional GET
+
+
+class ConditionalGetTestCase(TestCase):
+    """Tests for ETag / Last-Modified handling on cafe pages."""
+
+    def setUp(self):
+        """Add a city and a cafe."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """Remove the cafes and cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
+
+    def test_detail_not_modified(self):
         with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.get('/profile')
-            self.assertIn(b'Test Cafe', resp.data)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            etag = resp.headers["ETag"]
+            self.assertIn("Last-Modified", resp.headers)
+
+            with count_queries() as statements:
+                resp = client.get(f"/cafes/{self.cafe_id}",
+                                  headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+            self.assertEqual(len(statements), 1)
+
+    def test_weak_etag_matches(self):
+        with app.test_client() as client:
+            for path in (f"/cafes/{self.cafe_id}", "/cafes"):
+                with self.subTest(path=path):
+                    etag = client.get(path).headers["ETag"]
+                    resp = client.get(
+                        path, headers={"If-None-Match": f"W/{etag}"})
+                    self.assertEqual(resp.status_code, 304)
+
+    def test_list_has_no_last_modified(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertIn("ETag", resp.headers)
+            self.assertNotIn("Last-Modified", resp.headers)
 
-    def test_get_likes_none(self):
+            # Whatever the client's date, only the ETag can make a 304.
+            resp = client.get(
+                "/cafes", headers={"If-Modified-Since":
+                                   "Fri, 01 Jan 2100 00:00:00 GMT"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_detail_if_modified_since(self):
         with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.get(f'/api/likes?cafe_id={self.cafe_id}')
-            self.assertDictEqual({'likes': False}, resp.json)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            resp = client.get(
+                f"/cafes/{self.cafe_id}",
+                headers={"If-Modified-Since": resp.headers["Last-Modified"]})
+            self.assertEqual(resp.status_code, 304)
 
-    def test_get_likes_one(self):
-        test_like_data = dict(
-            user_id=self.user_id,
-            cafe_id=self.cafe_id
-        )
+    def test_edit_changes_etag(self):
         with app.test_client() as client:
-            like = Like(**test_like_data)
-            db.session.add(like)
+            etag = client.get(f"/cafes/{self.cafe_id}").headers["ETag"]
+
+            client.post(f"/cafes/{self.cafe_id}/edit/", data=CAFE_DATA_EDIT)
+
+            # The first view after the edit carries a flash message.
+            resp = client.get(f"/cafes/{self.cafe_id}",
+                              headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"edited", resp.data)
+
+            resp = client.get(f"/cafes/{self.cafe_id}",
+                              headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_list_not_modified(self):
+        with app.test_client() as client:
+            etag = client.get("/cafes").headers["ETag"]
+
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            db.session.add(Cafe(**{**CAFE_DATA, "name": "Another Cafe"}))
             db.session.commit()
-            login_for_test(client, self.user_id)
-            resp = client.get(f'/api/likes?cafe_id={self.cafe_id}')
-            self.assertDictEqual({'likes': True}, resp.json)
 
-    def test_like(self):
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Another Cafe", resp.data)
+
+
+#######################################
+# cafes API
+
+
+class CafeApiTestCase(TestCase):
+    """Tests for the JSON cafe API."""
+
+    def setUp(self):
+        """Add a city and a few cafes."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        for i in range(5):
+            db.session.add(Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}))
+        db.session.commit()
+
+        self.cafe_id = Cafe.query.filter_by(name="Cafe 0").one().id
+
+    def tearDown(self):
+        """Remove the cafes and cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_list_pages(self):
         with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.post(
-                '/api/like',
-                json={"cafe_id": self.cafe_id})
-            self.assertDictEqual({"liked": self.cafe_id}, resp.json)
+            resp = client.get("/api/cafes?limit=3&fields=id,name")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([c["name"] for c in resp.json["cafes"]],
+                             ["Cafe 0", "Cafe 1", "Cafe 2"])
+            self.assertEqual(resp.json["cafes"][0],
+                             {"id": self.cafe_id, "name": "Cafe 0"})
+
+            resp = client.get(
+                f"/api/cafes?limit=3&fields=id&after={resp.json['next']}")
+            self.assertEqual(len(resp.json["cafes"]), 2)
+            self.assertEqual(set(resp.json["cafes"][0]), {"id"})
+            self.assertIsNone(resp.json["next"])
+
+    def test_list_is_streamed(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes")
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(len(resp.json["cafes"]), 5)
+
+    def test_detail_with_city(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes/{self.cafe_id}?fields=name,city")
+            self.assertDictEqual(
+                {"cafe": {"name": "Cafe 0", "city": CITY_DATA}}, resp.json)
+
+    def test_detail_default_fields(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes/{self.cafe_id}")
+            cafe = Cafe.query.get(self.cafe_id)
+            self.assertDictEqual(
+                {**cafe.serialize(), "city": cafe.city.serialize()},
+                resp.json["cafe"])
+
+    def test_bad_requests(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes?fields=id,password")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("password", resp.json["error"])
+
+            resp = client.get("/api/cafes?after=nope")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/api/cafes/0")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_bad_limit(self):
+        with app.test_client() as client:
+            for url in ("/api/cafes", "/api/cafes/popular",
+                        "/api/cafes/near?lat=37.77&lng=-122.42",
+                        "/api/cafes/search?q=cafe", "/cafes/popular",
+                        "/cafes/near?lat=37.77&lng=-122.42"):
+                with self.subTest(url=url):
+                    sep = "&" if "?" in url else "?"
+                    resp = client.get(f"{url}{sep}limit=abc")
+                    self.assertEqual(resp.status_code, 400)
+
+    def test_blank_field_names_ignored(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes?limit=1&fields=id,,name,")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(set(resp.json["cafes"][0]), {"id", "name"})
+
+    def test_list_errors_before_streaming(self):
+        bad = support.encode_cursor(["Cafe 0", "x"])
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes?after={bad}")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("cursor", resp.json["error"])
+
+        # A query that fails fails in the view, before there's a response
+        # with a status, not partway through the body.
+        def failing_query(fields):
+            return db.session.query(
+                Cafe.name, Cafe.id, db.literal_column("1/0").label("x"))
+
+        with app.test_request_context("/api/cafes"):
+            with patch("app.cafe_api_query", failing_query):
+                with self.assertRaises(DataError):
+                    app.view_functions["cafe.api_cafe_list"]()
+        db.session.rollback()
+
+
+#######################################
+# like counts
+
+
+class LikeCountTestCase(TestCase):
+    """Tests for the denormalized cafe like counts."""
+
+    def setUp(self):
+        """Add a city, two cafes and two users."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        cafe_2 = Cafe(**{**CAFE_DATA, "name": "Other Cafe"})
+        db.session.add_all([cafe, cafe_2])
+        user = User.register(**TEST_USER_DATA)
+        user_2 = User.register(**TEST_USER_DATA_2)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.cafe_2_id = cafe_2.id
+        self.user_id = user.id
+        self.user_2_id = user_2.id
+
+    def tearDown(self):
+        """Remove the likes, cafes, cities and users."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def like_count(self, cafe_id):
+        return db.session.query(Cafe.like_count).filter(
+            Cafe.id == cafe_id).scalar()
+
+    def test_like_and_unlike_keep_count(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.post('/api/like', json={"cafe_id": self.cafe_id})
+            client.post('/api/like', json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.like_count(self.cafe_id), 1)
+
+            client.post('/api/unlike', json={"cafe_id": self.cafe_id})
+            client.post('/api/unlike', json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.like_count(self.cafe_id), 0)
+
+    def test_popular(self):
+        for user_id in (self.user_id, self.user_2_id):
+            Like.add(user_id, self.cafe_2_id)
+        Like.add(self.user_id, self.cafe_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get('/api/cafes/popular?fields=name,like_count')
+            self.assertDictEqual(
+                {"cafes": [{"name": "Other Cafe", "like_count": 2},
+                           {"name": "Test Cafe", "like_count": 1}]},
+                resp.json)
+
+            resp = client.get('/cafes/popular?limit=1')
+            self.assertIn(b"Other Cafe", resp.data)
+            self.assertIn(b"2 likes", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+    def test_backfill(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.add(Like(user_id=self.user_2_id, cafe_id=self.cafe_id))
+        db.session.commit()
+        self.assertEqual(self.like_count(self.cafe_id), 0)
+
+        result = app.test_cli_runner().invoke(args=['backfill-like-counts'])
+        self.assertIn("Updated like counts for 1 cafes.", result.output)
+        self.assertEqual(self.like_count(self.cafe_id), 2)
+        self.assertEqual(self.like_count(self.cafe_2_id), 0)
+
+    def test_relationships_are_read_only(self):
+        user = db.session.get(User, self.user_id)
+        cafe = db.session.get(Cafe, self.cafe_id)
+        user.liked_cafes.append(cafe)
+        db.session.commit()
+        self.assertEqual(Like.query.count(), 0)
+
+        Like.add(self.user_id, self.cafe_id)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual([c.id for c in user.liked_cafes], [self.cafe_id])
+        self.assertEqual([u.id for u in cafe.liking_users], [self.user_id])
+
+
+#######################################
+# lazy current user
+
+
+class CurrentUserTestCase(TestCase):
+    """Tests for the lazily loaded g.user."""
+
+    def setUp(self):
+        """Add a user and a city."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """Remove the user and city."""
+
+        User.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_anonymous_page_makes_no_queries(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(statements, [])
+
+    def test_navbar_uses_cached_summary(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get("/")
+
+            with count_queries() as statements:
+                resp = client.get("/")
+            self.assertIn(b"Testy MacTest", resp.data)
+            self.assertEqual(statements, [])
+
+    def test_profile_edit_refreshes_navbar(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get("/")
+
+            client.post("/profile/edit", data=TEST_USER_DATA_EDIT)
+            resp = client.get("/")
+            self.assertIn(b"new-fn new-ln", resp.data)
+
+    def test_deleted_user_is_logged_out(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            User.query.delete()
+            db.session.commit()
+
+            resp = client.get("/")
+            self.assertIn(b"Log In", resp.data)
+
+    def test_cache_entries_expire(self):
+        cache = LRUCache(ttl=0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+#######################################
+# password hashing
+
+
+class PasswordHashingTestCase(TestCase):
+    """Tests for pooled bcrypt hashing."""
+
+    def setUp(self):
+        """Add a user."""
+
+        Like.query.delete()
+        User.query.delete()
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """Remove the users and put the hasher settings back."""
+
+        User.query.delete()
+        db.session.commit()
+        password_hasher.init_app(app)
+
+    def test_register_uses_configured_cost(self):
+        user = User.query.get(self.user_id)
+        self.assertEqual(user.hashed_password[:7], "$2b$04$")
+
+    def test_rehash_on_login(self):
+        password_hasher.pool.rounds = 5
+
+        self.assertFalse(User.authenticate("test", "WRONG"))
+        self.assertEqual(
+            User.query.get(self.user_id).hashed_password[:7], "$2b$04$")
+
+        self.assertTrue(User.authenticate("test", "secret"))
+        self.assertEqual(
+            User.query.get(self.user_id).hashed_password[:7], "$2b$05$")
+        self.assertTrue(User.authenticate("test", "secret"))
+
+    def test_full_pool_sheds_logins(self):
+        saved = {k: app.config[k]
+                 for k in ('BCRYPT_WORKERS', 'BCRYPT_MAX_QUEUE')}
+        app.config['BCRYPT_WORKERS'] = 1
+        app.config['BCRYPT_MAX_QUEUE'] = 0
+        password_hasher.init_app(app)
+
+        started, release = Event(), Event()
+
+        def hog():
+            started.set()
+            release.wait()
+
+        hogger = Thread(target=password_hasher.pool.run, args=(hog,))
+        hogger.start()
+        started.wait()
+        try:
+            with self.assertRaises(HasherBusy):
+                User.authenticate("test", "secret")
+
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login", data={"username": "test", "password": "secret"})
+                self.assertEqual(resp.status_code, 503)
+        finally:
+            release.set()
+            hogger.join()
+            app.config.update(saved)
+
+        self.assertTrue(User.authenticate("test", "secret"))
+
+
+#######################################
+# login throttle
+
+
+class LoginThrottleTestCase(TestCase):
+    """Tests for shedding login attempts before they reach bcrypt."""
+
+    def setUp(self):
+        """Add a user and clear the throttle."""
+
+        Like.query.delete()
+        User.query.delete()
+        User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        login_throttle.reset()
+
+    def tearDown(self):
+        """Remove the users and clear the throttle."""
+
+        User.query.delete()
+        db.session.commit()
+        login_throttle.reset()
+
+    def log_in(self, client, username="test", password="secret"):
+        return client.post(
+            "/login", data={"username": username, "password": password})
+
+    def test_repeated_failure_skips_bcrypt(self):
+        with app.test_client() as client, \
+                patch.object(password_hasher, 'check',
+                             wraps=password_hasher.check) as check:
+            self.log_in(client, password="WRONG")
+            resp = self.log_in(client, password="WRONG")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(check.call_count, 1)
+            self.assertEqual(login_throttle.stats()["cached_failures"], 1)
+
+            resp = self.log_in(client)
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(check.call_count, 2)
+
+    def test_unknown_user_costs_a_check(self):
+        with patch.object(password_hasher, 'check',
+                          wraps=password_hasher.check) as check:
+            self.assertFalse(User.authenticate("no-such-user", "secret"))
+            self.assertEqual(check.call_count, 1)
+
+    def test_username_rate_limit(self):
+        burst = app.config['LOGIN_USERNAME_BURST']
+
+        with app.test_client() as client:
+            for i in range(burst):
+                resp = self.log_in(client, password=f"WRONG-{i}")
+                self.assertEqual(resp.status_code, 302)
+
+            resp = self.log_in(client)
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn(b"Too many login attempts", resp.data)
+
+            # other usernames still get through
+            resp = self.log_in(client, username="someone-else")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(login_throttle.stats(), {
+            "attempts": burst + 2,
+            "throttled": 1,
+            "cached_failures": 0,
+            "bcrypt_checks_shed": 1,
+        })
+
+    def test_success_resets_username_limit(self):
+        burst = app.config['LOGIN_USERNAME_BURST']
+
+        with app.test_client() as client:
+            for i in range(burst - 1):
+                self.log_in(client, password=f"WRONG-{i}")
+            resp = self.log_in(client)
+            self.assertEqual(resp.location, "/cafes")
+
+            for i in range(burst):
+                resp = self.log_in(client, password=f"WRONG-AGAIN-{i}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(login_throttle.stats()["throttled"], 0)
+
+    def test_guesses_elsewhere_dont_lock_out_user(self):
+        burst = app.config['LOGIN_USERNAME_BURST']
+
+        with app.test_client() as client:
+            for i in range(burst + 1):
+                client.post("/login", data={
+                    "username": "test", "password": f"WRONG-{i}"},
+                    environ_base={"REMOTE_ADDR": "198.51.100.7"})
+
+            resp = self.log_in(client)
+            self.assertEqual(resp.location, "/cafes")
+
+    def test_counters_under_threads(self):
+        def attempt(i):
+            with app.app_context():
+                login_throttle.allow(f"user-{i}", "203.0.113.9")
+
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(attempt, range(2000)))
+        self.assertEqual(login_throttle.stats()["attempts"], 2000)
+
+
+#######################################
+# app factory
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests for create_app() and its config profiles."""
+
+    # Seconds that importing the app and creating it may take.
+    STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", 2.0))
+
+    def test_production_profile(self):
+        with patch.object(ProductionConfig, 'SECRET_KEY', 'prod'):
+            prod = create_app('production')
+        self.assertFalse(prod.config['SQLALCHEMY_ECHO'])
+        self.assertFalse(prod.config['DEBUG'])
+        self.assertNotIn('debugtoolbar', prod.blueprints)
+
+    def test_production_needs_secret_key(self):
+        with patch.object(ProductionConfig, 'SECRET_KEY', None):
+            with self.assertRaises(RuntimeError):
+                create_app('production')
+
+    def test_trusted_proxies(self):
+        self.assertNotIsInstance(app.wsgi_app, ProxyFix)
+
+        with patch.object(TestingConfig, 'TRUSTED_PROXY_COUNT', 1), \
+                patch.object(TestingConfig, 'LOGIN_IP_BURST', 1):
+            proxied = create_app('testing')
+
+        def log_in(client, ip):
+            return client.post(
+                "/login", data={"username": "nobody", "password": "x"},
+                headers={"X-Forwarded-For": ip})
+
+        # Each client behind the proxy gets its own per-IP bucket.
+        with proxied.test_client() as client:
+            self.assertEqual(log_in(client, "203.0.113.1").status_code, 302)
+            self.assertEqual(log_in(client, "203.0.113.1").status_code, 429)
+            self.assertEqual(log_in(client, "203.0.113.2").status_code, 302)
+
+    def test_apps_keep_their_own_extension_state(self):
+        with patch.object(TestingConfig, 'BCRYPT_LOG_ROUNDS', 5), \
+                patch.object(TestingConfig, 'FRAGMENT_CACHE_SIZE', 7):
+            other = create_app('testing')
+
+        self.assertEqual(password_hasher.rounds, 4)
+        self.assertEqual(fragment_cache.stats()["maxsize"],
+                         app.config['FRAGMENT_CACHE_SIZE'])
+        with other.app_context():
+            self.assertEqual(password_hasher.rounds, 5)
+            self.assertEqual(fragment_cache.stats()["maxsize"], 7)
+            login_throttle.allow("test", "127.0.0.1")
+            self.assertEqual(login_throttle.stats()["attempts"], 1)
+        self.assertIsNot(other.extensions['login_throttle'],
+                         app.extensions['login_throttle'])
+        self.assertIsNot(other.extensions['user_summary_cache'],
+                         app.extensions['user_summary_cache'])
+
+        with patch.object(TestingConfig, 'UPLOAD_FOLDER', '/elsewhere'), \
+                patch.object(TestingConfig, 'JOB_MAX_ATTEMPTS', 9):
+            create_app('testing')
+        self.assertNotEqual(image_store.folder, '/elsewhere')
+        self.assertEqual(job_queue.settings.max_attempts,
+                         app.config['JOB_MAX_ATTEMPTS'])
+
+    def test_development_profile(self):
+        dev = create_app('development')
+        self.assertTrue(dev.config['SQLALCHEMY_ECHO'])
+        self.assertIn('debugtoolbar', dev.blueprints)
+
+    def test_startup_time(self):
+        script = (
+            "import time\n"
+            "start = time.perf_counter()\n"
+            "import app\n"
+            "app.create_app('production')\n"
+            "print(time.perf_counter() - start)\n")
+        env = {**os.environ, "FLASK_SECRET_KEY": "startup-test"}
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env, capture_output=True, text=True, check=True)
+
+        self.assertLess(float(result.stdout), self.STARTUP_BUDGET)
+
+
+#######################################
+# connection pool
+
+
+class ConnectionPoolTestCase(TestCase):
+    """Tests for pool settings and statistics."""
+
+    def pool_config(self, **overrides):
+        return {**app.config, **overrides}
+
+    def test_queue_pool_settings(self):
+        options = pool.engine_options(self.pool_config(
+            DB_POOL_SIZE=3, DB_MAX_OVERFLOW=2, DB_POOL_RECYCLE=60))
+        self.assertIs(options['poolclass'], pool.InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertEqual(options['pool_recycle'], 60)
+        self.assertTrue(options['pool_pre_ping'])
+
+    def test_pooler_mode(self):
+        options = pool.engine_options(self.pool_config(
+            DB_POOLER_MODE=True,
+            SQLALCHEMY_DATABASE_URI='postgresql+psycopg:///flask_cafe'))
+        self.assertIs(options['poolclass'], pool.InstrumentedNullPool)
+        self.assertNotIn('pool_size', options)
+        self.assertEqual(options['connect_args'], {'prepare_threshold': None})
+
+    def test_status(self):
+        with app.test_client() as client:
+            with db.engine.connect():
+                resp = client.get('/status/db-pool')
+
+        status = resp.json["default"]
+        self.assertEqual(status["pool"], "InstrumentedQueuePool")
+        self.assertGreaterEqual(status["checked_out"], 1)
+        self.assertEqual(status["size"], app.config['DB_POOL_SIZE'])
+        for key in ("overflow", "checkouts", "timeouts", "wait_seconds_total",
+                    "wait_seconds_max"):
+            self.assertIn(key, status)
+
+
+#######################################
+# search
+
+
+class SearchTestCase(TestCase):
+    """Tests for full-text search over cafes."""
+
+    def setUp(self):
+        """Add a city and cafes that mention espresso in different places."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add_all([
+            Cafe(**{**CAFE_DATA, "name": "Quiet Tea House"}),
+            Cafe(**{**CAFE_DATA, "name": "Corner Cafe",
+                    "description": "Strong espresso all day"}),
+            Cafe(**{**CAFE_DATA, "name": "Espresso Bar"}),
+            Cafe(**{**CAFE_DATA, "name": "Bean Counter",
+                    "address": "1 Espresso Way"}),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        """Remove the cafes and cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_ranked_by_weight(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/search?q=espresso&fields=name")
+            self.assertEqual([c["name"] for c in resp.json["cafes"]],
+                             ["Espresso Bar", "Corner Cafe", "Bean Counter"])
+            self.assertIsNone(resp.json["next"])
+
+    def test_pages(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/search?q=espresso&limit=2")
+            self.assertEqual(len(resp.json["cafes"]), 2)
+
+            resp = client.get("/api/cafes/search?q=espresso&limit=2"
+                              f"&after={resp.json['next']}")
+            self.assertEqual([c["name"] for c in resp.json["cafes"]],
+                             ["Bean Counter"])
+            self.assertIsNone(resp.json["next"])
+
+    def test_html(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes/search?q=tea")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Quiet Tea House", resp.data)
+            self.assertNotIn(b"Espresso Bar", resp.data)
+
+            resp = client.get("/api/cafes/search?q=")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_edit_updates_vector(self):
+        cafe = Cafe.query.filter_by(name="Quiet Tea House").one()
+        cafe.description = "Now serving espresso"
+        db.session.commit()
+
+        query, rank = Cafe.search("espresso")
+        self.assertEqual(query.count(), 4)
+        self.assertEqual(Cafe.search("tea")[0].count(), 1)
+
+
+#######################################
+# nearby cafes
+
+
+class NearbyTestCase(TestCase):
+    """Tests for finding cafes near a point."""
+
+    def setUp(self):
+        """Add a city and cafes in San Francisco, Oakland and nowhere."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add_all([
+            Cafe(**{**CAFE_DATA, "name": "Mission Cafe",
+                    "latitude": 37.7517, "longitude": -122.4314}),
+            Cafe(**{**CAFE_DATA, "name": "Grand Cafe",
+                    "latitude": 37.8114, "longitude": -122.2585}),
+            Cafe(**{**CAFE_DATA, "name": "Dateline Cafe",
+                    "latitude": 0.0, "longitude": 179.99}),
+            Cafe(**{**CAFE_DATA, "name": "Unmapped Cafe"}),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        """Remove the cafes and cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_nearest_first(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/near?lat=37.75&lng=-122.43"
+                              "&radius=20&fields=name")
+            cafes = resp.json["cafes"]
+            self.assertEqual([c["name"] for c in cafes],
+                             ["Mission Cafe", "Grand Cafe"])
+            self.assertAlmostEqual(cafes[0]["distance_km"], 0.23, delta=0.01)
+            self.assertAlmostEqual(cafes[1]["distance_km"], 16.5, delta=0.5)
+
+            resp = client.get("/api/cafes/near?lat=37.75&lng=-122.43"
+                              "&radius=5&fields=name")
+            self.assertEqual([c["name"] for c in resp.json["cafes"]],
+                             ["Mission Cafe"])
+
+    def test_across_antimeridian(self):
+        self.assertEqual(len(bounding_boxes(0, -179.99, 5)), 2)
+        [(west, _, east, north)] = bounding_boxes(89.99, 0, 5)
+        self.assertEqual((west, east, north), (-180, 180, 90))
+
+        query, distance = Cafe.near(0, -179.99, 5)
+        self.assertEqual([c.name for c in query], ["Dateline Cafe"])
+
+    def test_html_and_bad_args(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes/near?lat=37.81&lng=-122.26")
+            self.assertIn(b"Grand Cafe", resp.data)
+            self.assertNotIn(b"Mission Cafe", resp.data)
+
+            resp = client.get("/cafes/near")
+            self.assertEqual(resp.status_code, 200)
+
+            for args in ("lat=37.8", "lat=91&lng=0", "lat=0&lng=0&radius=0",
+                         "lat=0&lng=0&radius=100000"):
+                resp = client.get(f"/api/cafes/near?{args}")
+                self.assertEqual(resp.status_code, 400, args)
+
+    def test_uses_location_index(self):
+        query, distance = Cafe.near(37.75, -122.43, 5)
+        sql = query.statement.compile(
+            db.engine, compile_kwargs={"literal_binds": True})
+        db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+        plan = db.session.execute(db.text(f"EXPLAIN {sql}")).scalars().all()
+        db.session.rollback()
+        self.assertIn("ix_cafes_location", "\n".join(plan))
+
+
+#######################################
+# image uploads
+
+
+def make_image_file(width, height, name='photo.png'):
+    """Return (file, name) for posting a PNG of the given size."""
+
+    data = io.BytesIO()
+    Image.new('RGB', (width, height), 'brown').save(data, 'PNG')
+    data.seek(0)
+    return data, name
+
+
+class ImageUploadTestCase(TestCase):
+    """Tests for uploading images and making their variants."""
+
+    def setUp(self):
+        """Upload to a scratch folder; add a city."""
+
+        self.folder = tempfile.mkdtemp()
+        uploads = patch.dict(app.extensions, image_store=self.folder)
+        uploads.start()
+        self.addCleanup(uploads.stop)
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+    def tearDown(self):
+        """Remove the uploads, cafes and cities."""
+
+        Job.query.delete()
+        shutil.rmtree(self.folder)
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def add_cafe(self, client, image_file):
+        data = {**CAFE_DATA, "image_url": "", "image_file": image_file}
+        return client.post("/cafes/add", data=data,
+                           content_type="multipart/form-data")
+
+    def test_upload_makes_variants(self):
+        with app.test_client() as client:
+            resp = self.add_cafe(client, make_image_file(1000, 500))
+            self.assertEqual(resp.status_code, 302)
+            job_queue.work(app, burst=True)  # make the variants
+
+            cafe = Cafe.query.one()
+            self.assertTrue(cafe.image_url.startswith("/uploads/"))
+            self.assertEqual(cafe.version, 2)
+            self.assertEqual([v[:2] for v in cafe.image_variants["card"]],
+                             [[300, 150], [600, 300]])
+            self.assertEqual([v[:2] for v in cafe.image_variants["detail"]],
+                             [[400, 200], [800, 400]])
+
+            resp = client.get("/cafes")
+            html = resp.get_data(as_text=True)
+            self.assertIn('loading="lazy"', html)
+            self.assertIn('width="300" height="150"', html)
+            self.assertIn(f'{cafe.image_variants["card"][1][2]} 600w', html)
+
+            resp = client.get(cafe.image_variants["card"][0][2])
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "image/webp")
+            self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+
+    def test_small_image_not_scaled_up(self):
+        with app.test_client() as client:
+            self.add_cafe(client, make_image_file(120, 90))
+            job_queue.work(app, burst=True)
+
+        cafe = Cafe.query.one()
+        self.assertEqual([v[:2] for v in cafe.image_variants["card"]],
+                         [[120, 90]])
+
+    def test_not_an_image(self):
+        with app.test_client() as client:
+            resp = self.add_cafe(client, (io.BytesIO(b"not a png"), "x.png"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Not a readable image.", resp.data)
+            self.assertEqual(Cafe.query.count(), 0)
+
+    def test_duplicate_cafe_removes_upload(self):
+        with app.test_client() as client:
+            self.add_cafe(client, make_image_file(400, 300))
+            resp = self.add_cafe(client, make_image_file(400, 300))
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(Cafe.query.count(), 1)
+        self.assertEqual(len(os.listdir(self.folder)), 1)
+
+    def test_edit_keeps_upload(self):
+        with app.test_client() as client:
+            self.add_cafe(client, make_image_file(400, 300))
+            job_queue.work(app, burst=True)
+            cafe = Cafe.query.one()
+            url, variants = cafe.image_url, cafe.image_variants
+
+            resp = client.post(f"/cafes/{cafe.id}/edit/",
+                               data={**CAFE_DATA, "image_url": ""})
+            self.assertEqual(resp.status_code, 302)
+
+        db.session.expire_all()
+        self.assertEqual(cafe.image_url, url)
+        self.assertEqual(cafe.image_variants, variants)
+
+
+#######################################
+# background jobs
+
+
+class JobQueueTestCase(TestCase):
+    """Tests for the background job queue."""
+
+    def setUp(self):
+        """Register handlers that record their calls."""
+
+        Job.query.delete()
+        db.session.commit()
+        self.calls = []
+
+        @job_queue.handler('test-record')
+        def record(n):
+            self.calls.append(n)
+
+        @job_queue.handler('test-fail')
+        def fail():
+            raise RuntimeError('Broken on purpose')
+
+    def tearDown(self):
+        """Remove the jobs and handlers."""
+
+        db.session.rollback()
+        Job.query.delete()
+        db.session.commit()
+        del job_queue.handlers['test-record'], job_queue.handlers['test-fail']
+
+    def test_runs_only_after_commit(self):
+        enqueue_after_commit('test-record', n=1)
+        db.session.rollback()
+        enqueue_after_commit('test-record', n=2)
+        db.session.commit()
+
+        self.assertEqual(job_queue.work(app, burst=True), 1)
+        self.assertEqual(self.calls, [2])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_each_job_runs_once(self):
+        for n in range(40):
+            enqueue_after_commit('test-record', n=n)
+        db.session.commit()
+
+        job_queue.work(app, threads=4, burst=True)
+        self.assertEqual(sorted(self.calls), list(range(40)))
+
+    def test_retry_then_dead(self):
+        enqueue_after_commit('test-fail', max_attempts=2)
+        db.session.commit()
+
+        job_queue.work(app, burst=True)
+        job = Job.query.one()
+        self.assertEqual((job.state, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, utcnow())
+        self.assertIn('Broken on purpose', job.last_error)
+
+        job.run_at = utcnow()
+        db.session.commit()
+        job_queue.work(app, burst=True)
+        db.session.refresh(job)
+        self.assertEqual((job.state, job.attempts), ('dead', 2))
+
+    def test_expired_lease_is_claimed_again(self):
+        enqueue_after_commit('test-record', n=1)
+        db.session.commit()
+
+        job = job_queue.claim()
+        self.assertIsNone(job_queue.claim())
+
+        job.locked_until = utcnow()
+        db.session.commit()
+        self.assertEqual(job_queue.claim().attempts, 2)
+
+
+#######################################
+# bulk imports
+
+
+CAFES_CSV = """name,description,url,address,city_code,latitude,longitude
+Cafe A,First,http://a.com/,1 A St,sf,37.75,-122.43
+Cafe B,Second,,2 B St,sf,,
+"""
+
+
+class ImportTestCase(TestCase):
+    """Tests for the import-cities and import-cafes commands."""
+
+    def setUp(self):
+        """Start with no cafes or cities."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+        self.runner = app.test_cli_runner()
+
+        result = self.runner.invoke(
+            args=['import-cities', '--format', 'jsonl'],
+            input=json.dumps(CITY_DATA) + "\n")
+        self.assertIn("Done: 1 read, 1 inserted", result.output)
+
+    def tearDown(self):
+        """Remove the cafes and cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def import_cafes(self, text, *args):
+        return self.runner.invoke(
+            args=['import-cafes', '--format', 'csv', *args], input=text)
+
+    def test_import_cafes(self):
+        result = self.import_cafes(CAFES_CSV)
+        self.assertIn("Done: 2 read, 2 inserted, 0 updated", result.output)
+
+        a = Cafe.query.filter_by(name="Cafe A").one()
+        self.assertEqual((a.latitude, a.url), (37.75, "http://a.com/"))
+        b = Cafe.query.filter_by(name="Cafe B").one()
+        self.assertIsNone(b.latitude)
+        self.assertEqual(b.image_url, "/static/images/default-store.png")
+
+    def test_upsert_on_natural_key(self):
+        self.import_cafes(CAFES_CSV)
+        changed = CAFES_CSV.replace("First", "Changed")
+        result = self.import_cafes(changed, '--batch-size', '1')
+        self.assertIn("2 read, 0 inserted, 1 updated, 1 unchanged",
+                      result.output)
+
+        versions = dict(db.session.query(Cafe.name, Cafe.version))
+        self.assertEqual(versions, {"Cafe A": 2, "Cafe B": 1})
+
+    def test_renamed_city_bumps_its_cafes(self):
+        self.import_cafes(CAFES_CSV)
+        with app.test_client() as client:
+            cafe_id = Cafe.query.filter_by(name="Cafe A").one().id
+            etag = client.get(f"/cafes/{cafe_id}").headers["ETag"]
+
+            same = json.dumps(CITY_DATA) + "\n"
+            renamed = json.dumps({**CITY_DATA, "name": "San Fran"}) + "\n"
+            self.runner.invoke(args=['import-cities', '--format', 'jsonl'],
+                               input=same)
+            versions = dict(db.session.query(Cafe.name, Cafe.version))
+            self.assertEqual(versions, {"Cafe A": 1, "Cafe B": 1})
+
+            result = self.runner.invoke(
+                args=['import-cities', '--format', 'jsonl'], input=renamed)
+            self.assertIn("1 updated", result.output)
+            versions = dict(db.session.query(Cafe.name, Cafe.version))
+            self.assertEqual(versions, {"Cafe A": 2, "Cafe B": 2})
+
+            resp = client.get(f"/cafes/{cafe_id}",
+                              headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"San Fran", resp.data)
+
+    def test_rejects(self):
+        bad = CAFES_CSV + (",No name,,3 C St,sf,,\n"
+                           "Cafe D,,not-a-url,4 D St,sf,,\n"
+                           "Cafe E,,,5 E St,nowhere,,\n"
+                           "Cafe F,,,6 F St,sf,91,0\n")
+        with tempfile.NamedTemporaryFile('r', suffix='.jsonl') as rejects:
+            result = self.import_cafes(bad, '--rejects', rejects.name)
+            rejected = [json.loads(line) for line in rejects]
+
+        self.assertIn("6 read, 2 inserted, 0 updated, 0 unchanged, "
+                      "4 rejected", result.output)
+        self.assertEqual([r["line"] for r in rejected], [4, 5, 6, 7])
+        self.assertEqual([list(r["errors"]) for r in rejected],
+                         [["name"], ["url"], ["city_code"], ["latitude"]])
+
+    def test_add_form_rejects_duplicate(self):
+        self.import_cafes(CAFES_CSV)
+        with app.test_client() as client:
+            resp = client.post("/cafes/add", data={
+                "name": "Cafe A", "address": "1 A St", "city_code": "sf"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"already a cafe with this name", resp.data)
+
+
+#######################################
+# query budgets
+
+
+BUDGET_CAFES = 60
+BUDGET_LIKES = 40
+
+
+class QueryBudgetTestCase(TestCase):
+    """Per-route limits on SQL statements, with enough cafes and likes that
+    a query per row would go over them. Caches start cold, so these are
+    worst cases."""
+
+    def setUp(self):
+        """Add cities, many cafes, and users who like many of them."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add_all(City(code=f"c{i}", name=f"City {i}", state="CA")
+                           for i in range(3))
+        cafes = [Cafe(**{**CAFE_DATA,
+                         "name": f"Latte House {i}",
+                         "address": f"{i} Main St",
+                         "city_code": f"c{i % 3}",
+                         "latitude": 37.77 + i / 10000,
+                         "longitude": -122.42})
+                 for i in range(BUDGET_CAFES)]
+        db.session.add_all(cafes)
+        user = User.register(**TEST_USER_DATA)
+        other = User.register(**TEST_USER_DATA_2)
+        db.session.add_all(Like(user_id=u.id, cafe_id=cafe.id)
+                           for u in (user, other)
+                           for cafe in cafes[:BUDGET_LIKES])
+        db.session.commit()
+        Like.backfill_like_counts()
+
+        self.user_id = user.id
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        self.clear_caches()
+
+    def tearDown(self):
+        """Remove the likes, cafes, cities and users."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def clear_caches(self):
+        fragment_cache.clear()
+        user_summary_cache.clear()
+        support.invalidate_dropdown_choices()
+        login_throttle.reset()
+        db.session.expire_all()
+
+    def routes(self):
+        """Return (method, url, request arguments, budget) for every route.
+        """
+        cafe_id = self.cafe_ids[0]
+        max_ids = app.config['API_MAX_PAGE_SIZE']
+        cafe_form = {"description": "", "url": "", "image_url": "",
+                     "latitude": "", "longitude": ""}
+        near = "lat=37.77&lng=-122.42"
+        return [
+            ("GET", "/", {}, 1),
+            ("GET", "/cafes", {}, 3),
+            ("GET", "/cafes/popular", {}, 2),
+            ("GET", f"/cafes/near?{near}", {}, 2),
+            ("GET", "/cafes/search?q=latte", {}, 2),
+            ("GET", f"/cafes/{cafe_id}", {}, 3),
+            ("GET", "/cafes/add", {}, 2),
+            ("POST", "/cafes/add", {"data": {
+                **cafe_form, "name": "New Cafe", "address": "1 New St",
+                "city_code": "c0"}}, 3),
+            ("GET", f"/cafes/{cafe_id}/edit/", {}, 3),
+            ("POST", f"/cafes/{cafe_id}/edit/", {"data": {
+                **cafe_form, "name": "Edited Cafe", "address": "1 Edit St",
+                "city_code": "c1"}}, 4),
+            ("GET", "/signup", {}, 1),
+            ("POST", "/signup", {"data": {
+                **TEST_USER_DATA_NEW, "username": "budget",
+                "email": "budget@test.com"}}, 2),
+            ("GET", "/login", {}, 1),
+            ("POST", "/login", {"data": {
+                "username": "test", "password": "secret"}}, 1),
+            ("POST", "/logout", {}, 1),
+            ("GET", "/profile", {}, 3),
+            ("GET", "/profile/edit", {}, 2),
+            ("POST", "/profile/edit", {"data": {
+                **TEST_USER_DATA_EDIT, "password": "secret"}}, 3),
+            ("GET", "/api/cafes", {}, 1),
+            ("GET", "/api/cafes/popular", {}, 1),
+            ("GET", f"/api/cafes/near?{near}", {}, 1),
+            ("GET", "/api/cafes/search?q=latte", {}, 1),
+            ("GET", f"/api/cafes/{cafe_id}", {}, 1),
+            ("GET", "/api/likes?cafe_id=" + ",".join(
+                str(i) for i in self.cafe_ids[:max_ids]), {}, 2),
+            # The last cafe isn't liked yet, so this really adds a like.
+            ("POST", "/api/like", {"json": {"cafe_id": self.cafe_ids[-1]}},
+             3),
+            ("POST", "/api/unlike", {"json": {"cafe_id": cafe_id}}, 3),
+            ("GET", "/uploads/missing.png", {}, 0),
+            ("GET", "/status/db-pool", {}, 0),
+            ("GET", "/metrics", {}, 1),
+        ]
+
+    def test_every_route_is_budgeted(self):
+        budgeted = {url.split("?")[0] for method, url, kwargs, budget
+                    in self.routes()}
+        cafe_id = self.cafe_ids[0]
+        for rule in app.url_map.iter_rules():
+            if rule.endpoint == "static":
+                continue
+            url = rule.rule.replace("<int:cafe_id>", str(cafe_id)).replace(
+                "<path:filename>", "missing.png")
+            self.assertIn(url, budgeted)
+
+    def test_route_budgets(self):
+        for method, url, kwargs, budget in self.routes():
+            with self.subTest(method=method, url=url):
+                self.clear_caches()
+                with app.test_client() as client:
+                    login_for_test(client, self.user_id)
+                    with assert_max_queries(self, budget):
+                        resp = client.open(url, method=method, **kwargs)
+                        resp.get_data()
+                self.assertLess(resp.status_code, 400 if budget else 500)
+
+    def test_budgets_hold_with_more_rows(self):
+        more = [Cafe(**{**CAFE_DATA, "name": f"Latte Bar {i}",
+                        "address": f"{i} Side St", "city_code": "c2"})
+                for i in range(BUDGET_CAFES)]
+        db.session.add_all(more)
+        db.session.flush()
+        db.session.add_all(Like(user_id=self.user_id, cafe_id=cafe.id)
+                           for cafe in more)
+        db.session.commit()
+        self.cafe_ids += [cafe.id for cafe in more]
+
+        for method, url, kwargs, budget in self.routes():
+            if method == "GET":
+                with self.subTest(url=url):
+                    self.clear_caches()
+                    with app.test_client() as client:
+                        login_for_test(client, self.user_id)
+                        with assert_max_queries(self, budget):
+                            client.get(url).get_data()
+
+
+#######################################
+# metrics
+
+
+def metric_value(text, name, **labels):
+    """Return the value of one sample in Prometheus text, or None."""
+
+    label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+    pattern = re.escape(f'{name}{{{label_text}}}' if labels else name)
+    match = re.search(rf'^{pattern} (\S+)$', text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+
+class MetricsTestCase(TestCase):
+    """Tests for per-route request metrics and /metrics."""
+
+    def setUp(self):
+        """Add a cafe, and zero the counters."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+        self.cafe_id = cafe.id
+        request_metrics.reset()
+
+    def tearDown(self):
+        """Remove the cafe."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_latency_and_sql_per_endpoint(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                client.get(f"/api/cafes/{self.cafe_id}")
+                client.get(f"/api/cafes/{self.cafe_id}")
+            text = client.get("/metrics").get_data(as_text=True)
+
+        labels = dict(endpoint="cafe.api_cafe_detail", method="GET")
+        self.assertEqual(metric_value(
+            text, "flask_cafe_request_duration_seconds_count", **labels), 2)
+        self.assertEqual(metric_value(
+            text, "flask_cafe_request_duration_seconds_bucket",
+            **labels, le="+Inf"), 2)
+        self.assertEqual(metric_value(
+            text, "flask_cafe_request_sql_statements_sum", **labels),
+            len(statements))
+        self.assertGreater(metric_value(
+            text, "flask_cafe_request_sql_seconds_total", **labels), 0)
+        self.assertEqual(metric_value(
+            text, "flask_cafe_request_errors_total", **labels), 0)
+
+    def test_unmatched_urls_share_a_label(self):
+        with app.test_client() as client:
+            client.get("/no/such/page")
+            client.get("/nor/this")
+            text = client.get("/metrics").get_data(as_text=True)
+
+        self.assertEqual(metric_value(
+            text, "flask_cafe_request_duration_seconds_count",
+            endpoint="none", method="GET"), 2)
+
+    def test_counts_from_finished_threads_are_kept(self):
+        def get_cafe():
+            with app.test_client() as client:
+                client.get(f"/api/cafes/{self.cafe_id}")
+
+        threads = [Thread(target=get_cafe) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        del threads, thread
+        gc.collect()
+
+        totals = request_metrics.totals()
+        self.assertEqual(
+            sum(totals[("cafe.api_cafe_detail", "GET")].latency), 4)
+
+    def test_metrics_endpoint(self):
+        with app.test_client() as client:
+            resp = client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        text = resp.get_data(as_text=True)
+        self.assertIn("# TYPE flask_cafe_request_duration_seconds histogram",
+                      text)
+        self.assertIsNotNone(metric_value(
+            text, "flask_cafe_db_pool_checkouts_total", bind="default"))
+        self.assertIsNotNone(metric_value(
+            text, "flask_cafe_cache_hits_total", cache="fragment"))
+        self.assertEqual(metric_value(
+            text, "flask_cafe_jobs", state="dead"), 0)
+
+
+#######################################
+# async likes API
+
+
+async def asgi_request(asgi_app, method, path, json_body=None, cookies=()):
+    """Send one HTTP request, with a Cookie header for each of `cookies`, to
+    an ASGI app; return (status, parsed JSON or text body)."""
+
+    path, _, query = path.partition("?")
+    headers = []
+    body = b""
+    if json_body is not None:
+        body = json.dumps(json_body).encode()
+        headers.append((b"content-type", b"application/json"))
+    for cookie in cookies:
+        headers.append((b"cookie", cookie.encode()))
+    scope = {"type": "http", "asgi": {"version": "3.0"},
+             "http_version": "1.1", "method": method, "scheme": "http",
+             "path": path, "raw_path": path.encode(), "root_path": "",
+             "query_string": query.encode(), "headers": headers,
+             "server": ("localhost", 80), "client": ("127.0.0.1", 1234)}
+    messages = [{"type": "http.request", "body": body}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    status = sent[0]["status"]
+    data = b"".join(m.get("body", b"") for m in sent[1:])
+    content_type = dict(sent[0]["headers"]).get(b"content-type", b"")
+    if content_type.startswith(b"application/json"):
+        return status, json.loads(data)
+    return status, data.decode()
+
+
+class AsyncLikesTestCase(TestCase):
+    """Tests for the async likes views in asgi.py."""
+
+    def setUp(self):
+        """Add a user and a cafe, and log the user in."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+        self.asgi_app = LikesApp(app)
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            self.cookie = client.get_cookie("session").value
+
+    def tearDown(self):
+        """Remove the likes, cafe, city and user."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def run_requests(self, *requests, cookies=None):
+        """Send (method, path, JSON body) requests in order, on one event
+        loop; return their (status, body) results. The Cookie headers are
+        just the session cookie unless `cookies` are given."""
+
+        if cookies is None:
+            cookies = [f"session={self.cookie}"]
+
+        async def run():
+            try:
+                return [await asgi_request(
+                    self.asgi_app, method, path, body, cookies)
+                    for method, path, body in requests]
+            finally:
+                await self.asgi_app.dispose()
+
+        return asyncio.run(run())
+
+    def test_like_and_unlike(self):
+        cafe_id = self.cafe_id
+        results = self.run_requests(
+            ("POST", "/api/like", {"cafe_id": cafe_id}),
+            ("POST", "/api/like", {"cafe_id": cafe_id}),
+            ("GET", f"/api/likes?cafe_id={cafe_id}", None),
+            ("GET", f"/api/likes?cafe_id={cafe_id},0", None))
+        self.assertEqual(results, [
+            (200, {"liked": cafe_id, "likes": True}),
+            (200, {"liked": cafe_id, "likes": True}),
+            (200, {"likes": True}),
+            (200, {"likes": {str(cafe_id): True, "0": False}}),
+        ])
+        self.assertEqual(db.session.get(Cafe, cafe_id).like_count, 1)
+
+        results = self.run_requests(
+            ("POST", "/api/unlike", {"cafe_id": cafe_id}),
+            ("GET", f"/api/likes?cafe_id={cafe_id}", None))
+        self.assertEqual(results, [
+            (200, {"unliked": cafe_id, "likes": False}),
+            (200, {"likes": False}),
+        ])
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Cafe, cafe_id).like_count, 0)
+
+    def test_errors_match_sync_views(self):
+        requests = [("GET", f"/api/likes?cafe_id={self.cafe_id}", None),
+                    ("GET", "/api/likes?cafe_id=one", None),
+                    ("POST", "/api/like", {}),
+                    ("POST", "/api/like", {"cafe_id": 0}),
+                    ("POST", "/api/like", {"cafe_id": self.cafe_id + 1}),
+                    ("POST", "/api/like", {"cafe_id": 10 ** 12}),
+                    ("POST", "/api/like", {"cafe_id": True}),
+                    ("POST", "/api/like", {"cafe_id": self.cafe_id + 0.5}),
+                    ("GET", f"/api/likes?cafe_id=1,{2 ** 31}", None),
+                    ("GET", "/api/likes?cafe_id=" + "1," * 100 + "1", None),
+                    ("POST", "/api/unlike", None)]
+        async_results = self.run_requests(*requests)
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            sync_results = [
+                (resp.status_code, resp.json) for resp in (
+                    client.open(path, method=method, json=body)
+                    for method, path, body in requests)]
+        self.assertEqual(async_results, sync_results)
+
+    def test_needs_login(self):
+        results = self.run_requests(
+            ("POST", "/api/like", {"cafe_id": self.cafe_id}),
+            ("GET", f"/api/likes?cafe_id={self.cafe_id}", None),
+            cookies=[])
+        self.assertEqual([status for status, body in results], [401, 401])
+
+        self.cookie = self.cookie[:-2] + "xx"
+        status, body = self.run_requests(
+            ("POST", "/api/unlike", {"cafe_id": self.cafe_id}))[0]
+        self.assertEqual(status, 401)
+
+    def test_deleted_user(self):
+        User.query.filter_by(id=self.user_id).delete()
+        db.session.commit()
+        user_summary_cache.clear()
+
+        results = self.run_requests(
+            ("POST", "/api/like", {"cafe_id": self.cafe_id}),
+            ("POST", "/api/unlike", {"cafe_id": self.cafe_id}),
+            ("GET", f"/api/likes?cafe_id={self.cafe_id}", None))
+        self.assertEqual(results, [(401, {"error": NOT_LOGGED_IN_MSG})] * 3)
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_unusual_cookies(self):
+        session = f"session={self.cookie}"
+        for cookies in ([f'json={{"a":1}}; {session}'],
+                        [f"x=a b; {session}"],
+                        [f"_ga=GA1.2; bad; {session}"],
+                        [f"$Foo=bar; {session}"],
+                        [session, "_ga=GA1.2"],
+                        ["_ga=GA1.2", session]):
+            with self.subTest(cookies=cookies):
+                results = self.run_requests(
+                    ("GET", f"/api/likes?cafe_id={self.cafe_id}", None),
+                    cookies=cookies)
+                self.assertEqual(results, [(200, {"likes": False})])
+
+    def test_other_routes_go_to_flask(self):
+        results = self.run_requests(
+            ("GET", f"/api/cafes/{self.cafe_id}", None),
+            ("GET", "/api/like", None))
+        self.assertEqual(results[0][0], 200)
+        self.assertEqual(results[0][1]["cafe"]["name"], "Test Cafe")
+        self.assertEqual(results[1][0], 405)
+
+
+#######################################
+# read replicas
+
+
+class ReadReplicaTestCase(TestCase):
+    """Tests for sending reads to a replica (replicas.ReplicaRouter), with
+    a second local database standing in for the replica."""
+
+    REPLICA_URL = os.environ.get(
+        "TEST_REPLICA_DATABASE_URL", 'postgresql:///flaskcafe_test_replica')
+
+    def setUp(self):
+        """Make an app with one replica, and give it the primary's rows,
+        except that the cafe has another name there."""
+
+        with patch.object(TestingConfig, 'DATABASE_REPLICA_URLS',
+                          [self.REPLICA_URL]):
+            self.app = create_app('testing')
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        try:
+            db.metadata.create_all(db.engines['replica_0'])
+        except OperationalError:
+            self.skipTest(f"no replica database at {self.REPLICA_URL}")
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+        self.copy_to_replica()
+        with db.engines['replica_0'].begin() as conn:
+            conn.execute(Cafe.__table__.update().values(name="Replica Cafe"))
+
+    def tearDown(self):
+        """Remove the rows from the primary."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def copy_to_replica(self):
+        """Replace the replica's rows with the primary's, as replication
+        would."""
+
+        tables = db.metadata.sorted_tables
+        with db.engine.connect() as primary, \
+                db.engines['replica_0'].begin() as replica:
+            for table in reversed(tables):
+                replica.execute(table.delete())
+            for table in tables:
+                columns = [c for c in table.columns if c.computed is None]
+                rows = primary.execute(db.select(*columns)).mappings()
+                rows = [dict(row) for row in rows]
+                if rows:
+                    replica.execute(table.insert(), rows)
+
+    def replica_likes(self):
+        with db.engines['replica_0'].connect() as conn:
+            return conn.execute(
+                db.select(db.func.count()).select_from(Like)).scalar()
+
+    def test_reads_use_replica(self):
+        with self.app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"Replica Cafe", resp.data)
+            resp = client.get(f"/api/cafes/{self.cafe_id}")
+            self.assertEqual(resp.json["cafe"]["name"], "Replica Cafe")
+
+            # Views that aren't marked @read_replica use the primary.
+            login_for_test(client, self.user_id)
+            resp = client.get(f"/cafes/{self.cafe_id}/edit/")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertNotIn(PRIMARY_UNTIL_KEY, session)
+
+    def test_writes_use_primary_then_stick(self):
+        with self.app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post("/api/like", json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(Like.query.count(), 1)
+            self.assertEqual(self.replica_likes(), 0)
+            self.assertGreater(session[PRIMARY_UNTIL_KEY], time.time())
+
+            # The replica hasn't caught up, but this visitor sees the like.
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+            resp = client.get("/profile")
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_stickiness_ends(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+        with self.app.test_client() as client:
+            login_for_test(client, self.user_id)
+            with client.session_transaction() as change_session:
+                change_session[PRIMARY_UNTIL_KEY] = time.time() - 1
+
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": False})
+
+            self.copy_to_replica()
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+
+    def test_async_writes_stick(self):
+        asgi_app = LikesApp(self.app)
+        with self.app.test_client() as client:
+            login_for_test(client, self.user_id)
+            cookie = client.get_cookie("session").value
+        scope = {"query_string": b"",
+                 "headers": [(b"cookie", f"session={cookie}".encode())]}
+        request = Request(scope, None)
+
+        asgi_app.stick_to_primary(request)
+        value = request.set_cookie.split(";")[0].partition("=")[2]
+        stuck = asgi_app.session_serializer.loads(value)
+        self.assertEqual(stuck[CURR_USER_KEY], self.user_id)
+        self.assertGreater(stuck[PRIMARY_UNTIL_KEY], time.time())
+
+
+#######################################
+# like state on cafe detail
+
+
+class CafeDetailLikeStateTestCase(TestCase):
+    """Tests for rendering whether the viewer likes a cafe into its page."""
+
+    def setUp(self):
+        """Add a user and a cafe."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+    def tearDown(self):
+        """Remove the likes, cafe, city and user."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_star_shows_like_state(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn('data-likes="false"', html)
+            self.assertIn('class="bi bi-star"', html)
+            self.assertIn("/static/script.js", html)
+
+            client.post("/api/like", json={"cafe_id": self.cafe_id})
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn('data-likes="true"', html)
+            self.assertIn('class="bi bi-star-fill"', html)
+
+    def test_no_star_when_logged_out(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertNotIn(b"like-star", resp.data)
+            self.assertNotIn(b"script.js", resp.data)
+            self.assertIn("Last-Modified", resp.headers)
+
+    def test_like_changes_etag(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            etag = resp.headers["ETag"]
+            self.assertNotIn("Last-Modified", resp.headers)
+
+            with count_queries() as statements:
+                resp = client.get(f"/cafes/{self.cafe_id}",
+                                  headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(len(statements), 1)
+
+            resp = client.post("/api/like", json={"cafe_id": self.cafe_id})
+            self.assertIs(resp.json["likes"], True)
+            resp = client.get(f"/cafes/{self.cafe_id}",
+                              headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'data-likes="true"', resp.data)
+
+
+#######################################
+# likes
+
+
+class LikeViewsTestCase(TestCase):
+    """Tests for views on likes."""
+
+    def setUp(self):
+        """ Add a few users, cafes, and likes """
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        # user_2 = User.register(**TEST_USER_DATA_2)
+        # db.session.add(user_2)
+
+        db.session.commit()
+
+        self.user_id = user.id
+        # self.user_2_id = user_2.id
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """ Remove those users, cafes, and likes """
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        Like.query.delete()
+        db.session.commit()
+
+    def test_profile_zero_likes_view(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get('/profile', follow_redirects=True)
+            self.assertIn(b'You don\'t like anything', resp.data)
+
+    def test_profile_likes_view(self):
+        test_like_data = dict(
+            user_id=self.user_id,
+            cafe_id=self.cafe_id
+        )
+        self.assertTrue(True)
+        like = Like(**test_like_data)
+        db.session.add(like)
+        db.session.commit()
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get('/profile')
+            self.assertIn(b'Test Cafe', resp.data)
+
+    def test_get_likes_none(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get(f'/api/likes?cafe_id={self.cafe_id}')
+            self.assertDictEqual({'likes': False}, resp.json)
+
+    def test_get_likes_one(self):
+        test_like_data = dict(
+            user_id=self.user_id,
+            cafe_id=self.cafe_id
+        )
+        with app.test_client() as client:
+            like = Like(**test_like_data)
+            db.session.add(like)
+            db.session.commit()
+            login_for_test(client, self.user_id)
+            resp = client.get(f'/api/likes?cafe_id={self.cafe_id}')
+            self.assertDictEqual({'likes': True}, resp.json)
+
+    def test_get_likes_many(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get(f'/api/likes?cafe_id={self.cafe_id},0')
+            self.assertDictEqual(
+                {'likes': {str(self.cafe_id): True, '0': False}}, resp.json)
+
+    def test_get_likes_bad_request(self):
+        with app.test_client() as client:
+            resp = client.get(f'/api/likes?cafe_id={self.cafe_id}')
+            self.assertEqual(resp.status_code, 401)
+
+            login_for_test(client, self.user_id)
+            resp = client.get('/api/likes?cafe_id=one')
+            self.assertEqual(resp.status_code, 400)
+
+            max_ids = app.config['API_MAX_PAGE_SIZE']
+            ids = ",".join([str(self.cafe_id)] * max_ids)
+            resp = client.get(f'/api/likes?cafe_id={ids}')
+            self.assertEqual(resp.status_code, 200)
+            resp = client.get(f'/api/likes?cafe_id={ids},{self.cafe_id}')
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn(str(max_ids), resp.json["error"])
+
+    def test_like(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post(
+                '/api/like',
+                json={"cafe_id": self.cafe_id})
+            self.assertDictEqual(
+                {"liked": self.cafe_id, "likes": True}, resp.json)
+
+            # liking again is a no-op, not an error
+            resp = client.post(
+                '/api/like',
+                json={"cafe_id": self.cafe_id})
+            self.assertDictEqual(
+                {"liked": self.cafe_id, "likes": True}, resp.json)
+            self.assertEqual(Like.query.count(), 1)
+
+    def test_like_missing_cafe(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post(
+                '/api/like', json={"cafe_id": self.cafe_id + 1})
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.post('/api/like', json={})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_cafe_id_out_of_range(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            for cafe_id in (0, -1, 2 ** 31, 10 ** 12, 1e999, float('nan'),
+                            True, self.cafe_id + 0.5):
+                for url in ('/api/like', '/api/unlike'):
+                    resp = client.post(url, json={"cafe_id": cafe_id})
+                    self.assertEqual(resp.status_code, 400, (url, cafe_id))
+
+            self.assertEqual(Like.query.count(), 0)
+
+            # No cafe has these ids, so no one likes them.
+            resp = client.get(f'/api/likes?cafe_id={2 ** 31}')
+            self.assertEqual(resp.json, {"likes": False})
+            resp = client.get(f'/api/likes?cafe_id={self.cafe_id},{2 ** 31}')
+            self.assertEqual(
+                resp.json["likes"], {str(self.cafe_id): False,
+                                     str(2 ** 31): False})
 
     def test_unlike(self):
         test_like_data = dict(
@@ -630,7 +2847,9 @@ class LikeViewsTestCase(TestCase):
             resp = client.post(
                 '/api/unlike',
                 json={"cafe_id": self.cafe_id})
-            self.assertDictEqual({"unliked": self.cafe_id}, resp.json)
+            self.assertDictEqual(
+                {"unliked": self.cafe_id, "likes": False}, resp.json)
+            self.assertEqual(Like.query.count(), 0)
 
     def test_unlike_when_not_already_liked(self):
         with app.test_client() as client:
@@ -638,5 +2857,31 @@ class LikeViewsTestCase(TestCase):
             resp = client.post(
                 '/api/unlike',
                 json={"cafe_id": 1})
-            self.assertDictEqual({"unliked": 1}, resp.json)
+            self.assertDictEqual({"unliked": 1, "likes": False}, resp.json)
+
+    def test_parallel_toggles(self):
+        threads = 8
+        barrier = Barrier(threads)
+
+        def toggle(n):
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+                barrier.wait()
+                statuses = []
+                for i in range(20):
+                    url = '/api/like' if (n + i) % 2 else '/api/unlike'
+                    resp = client.post(url, json={"cafe_id": self.cafe_id})
+                    statuses.append(resp.status_code)
+                # finish with every thread liking at once
+                barrier.wait()
+                resp = client.post(
+                    '/api/like', json={"cafe_id": self.cafe_id})
+                statuses.append(resp.status_code)
+                return statuses
+
+        with ThreadPoolExecutor(threads) as pool:
+            results = list(pool.map(toggle, range(threads)))
+
+        self.assertEqual({s for r in results for s in r}, {200})
+        self.assertEqual(Like.query.count(), 1)
 
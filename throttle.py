@@ -0,0 +1,170 @@
+""" Login throttling for Flask Cafe. """
+
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from cache import LRUCache
+
+
+class TokenBucketLimiter:
+    """ Per-key token buckets: each key may spend `burst` attempts at once,
+        refilled at `per_minute` attempts a minute. Only the `max_keys` most
+        recently seen keys are tracked, so memory stays bounded. """
+
+    def __init__(self, burst, per_minute, max_keys=100000):
+        self.burst = burst
+        self.per_second = per_minute / 60
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """ Spend a token for key. Returns False if its bucket is empty. """
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def forget(self, key):
+        """ Drop key's bucket, so it starts full again. """
+
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class LoginThrottle:
+    """ Sheds login attempts before they cost a bcrypt check.
+
+        Attempts are rate-limited per username from each client IP, and
+        per client IP, and a username/password pair that just failed is
+        remembered for LOGIN_FAILURE_CACHE_TTL seconds so retrying it fails
+        without hashing. Pairs are stored as HMACs, never as plain passwords.
+        Each app gets its own limits and counters (see ThrottleState); the
+        methods use the current app's.
+    """
+
+    def init_app(self, app):
+        """ Give the app its own limits, read from app.config. """
+
+        app.extensions['login_throttle'] = ThrottleState(app.config)
+
+    @property
+    def state(self):
+        """ The current app's ThrottleState. """
+
+        return current_app.extensions['login_throttle']
+
+    def allow(self, username, ip):
+        """ Return whether this attempt is within both rate limits. """
+
+        state = self.state
+        # Spend from both buckets, so guessing one username's password and
+        # trying many usernames from one IP are both limited. The username
+        # bucket is per IP, so guesses from elsewhere can't lock its owner
+        # out.
+        username_ok = state.by_username.allow((username.lower(), ip))
+        ip_ok = state.by_ip.allow(ip)
+        allowed = username_ok and ip_ok
+        state.record_attempt(allowed)
+        return allowed
+
+    def succeeded(self, username, ip):
+        """ Note a successful login or signup: the username's earlier
+            failed attempts from this IP stop counting against it. """
+
+        self.state.by_username.forget((username.lower(), ip))
+
+    def recently_failed(self, username, password):
+        """ Return whether this exact pair failed within the TTL. """
+
+        state = self.state
+        if state.failures.get(state.pair_key(username, password)):
+            state.record_cached_failure()
+            return True
+        return False
+
+    def record_failure(self, username, password):
+        state = self.state
+        state.failures.set(state.pair_key(username, password), True)
+
+    def reset(self):
+        """ Forget all buckets, failures and counters. """
+
+        self.state.reset()
+
+    def stats(self):
+        """ Return the counters as a dictionary. bcrypt_checks_shed is how
+            many attempts were turned away without hashing. """
+
+        with self.state.lock:
+            attempts = self.state.attempts
+            throttled = self.state.throttled
+            cached_failures = self.state.cached_failures
+        return {
+            "attempts": attempts,
+            "throttled": throttled,
+            "cached_failures": cached_failures,
+            "bcrypt_checks_shed": throttled + cached_failures,
+        }
+
+
+class ThrottleState:
+    """ One app's LoginThrottle buckets, failures and counters, kept in
+        app.extensions['login_throttle']. """
+
+    def __init__(self, config):
+        self.key = config['SECRET_KEY'].encode('utf8')
+        max_keys = config['LOGIN_THROTTLE_MAX_KEYS']
+        self.by_username = TokenBucketLimiter(
+            config['LOGIN_USERNAME_BURST'],
+            config['LOGIN_USERNAME_PER_MINUTE'],
+            max_keys)
+        self.by_ip = TokenBucketLimiter(
+            config['LOGIN_IP_BURST'], config['LOGIN_IP_PER_MINUTE'], max_keys)
+        self.failures = LRUCache(
+            maxsize=max_keys, ttl=config['LOGIN_FAILURE_CACHE_TTL'])
+        self.lock = threading.Lock()
+        self._reset_counters()
+
+    def pair_key(self, username, password):
+        message = f'{username}\0{password}'.encode('utf8')
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def record_attempt(self, allowed):
+        with self.lock:
+            self.attempts += 1
+            if not allowed:
+                self.throttled += 1
+
+    def record_cached_failure(self):
+        with self.lock:
+            self.cached_failures += 1
+
+    def reset(self):
+        self.by_username.clear()
+        self.by_ip.clear()
+        self.failures.clear()
+        with self.lock:
+            self._reset_counters()
+
+    def _reset_counters(self):
+        self.attempts = 0
+        self.throttled = 0
+        self.cached_failures = 0